@@ -0,0 +1,154 @@
+# backend/acl.py
+import os, sys, threading, time, queue
+from collections import OrderedDict
+import logs
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api")
+if API_DIR not in sys.path:
+    sys.path.insert(0, API_DIR)
+from models import list_accepted_chats, is_chat_allowed
+
+log = logs.get("ACL")
+
+class AclCache:
+    """
+    Who may DM whom, held in memory so the chat servers can check every
+    private frame without a round trip to the API. The accepted pairs are
+    bulk-loaded at startup and kept current by 'chat_changed' events.
+    A pair that is not in the set is re-checked against the database at
+    most once per neg_ttl, so a lost notification heals itself; the check
+    runs on the cache's own thread, never on a connection's reader. The
+    negative cache is LRU-capped at max_denied pairs and drops expired
+    entries as it goes, since its keys come from client-chosen targets.
+    Group permissions are membership in GroupCache, which is preloaded too.
+    """
+    def __init__(self, loader=list_accepted_chats, checker=is_chat_allowed, neg_ttl=30.0,
+                 max_denied=100000, max_waiting=10000):
+        self.loader = loader
+        self.checker = checker
+        self.neg_ttl = neg_ttl
+        self.max_denied = max_denied
+        self.max_waiting = max_waiting
+        self.peers = {}              # user -> set of users they may DM
+        self.denied = OrderedDict()  # (u1, u2) -> time a database re-check said no, oldest first
+        self.pending = {}            # (u1, u2) -> callbacks waiting for its database check
+        self.waiting = 0             # callbacks in pending
+        self.checks = queue.Queue()  # pairs for the checker thread
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "denied": 0, "pairs": 0,
+                      "deferred": 0, "overflow": 0, "evicted": 0}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def load(self):
+        peers = {}
+        for a, b in self.loader():
+            peers.setdefault(a, set()).add(b)
+            peers.setdefault(b, set()).add(a)
+        with self.lock:
+            self.peers = peers
+            self.denied.clear()
+            self.stats["pairs"] = sum(len(s) for s in peers.values()) // 2
+        return self
+
+    def _allow(self, a, b):
+        # called with the lock held
+        if b not in self.peers.get(a, ()):
+            self.peers.setdefault(a, set()).add(b)
+            self.peers.setdefault(b, set()).add(a)
+            self.stats["pairs"] += 1
+        self.denied.pop((a, b), None)
+        self.denied.pop((b, a), None)
+
+    def _deny(self, a, b, now):
+        # called with the lock held; oldest first, so expired entries and
+        # anything over the cap come off the front
+        self.denied.pop((a, b), None)
+        self.denied[(a, b)] = now
+        while self.denied:
+            key, t = next(iter(self.denied.items()))
+            if now - t < self.neg_ttl and len(self.denied) <= self.max_denied:
+                break
+            del self.denied[key]
+            self.stats["evicted"] += 1
+
+    def dm_allowed(self, a, b, then):
+        """
+        True or False when the answer is in memory. Otherwise returns None
+        and then(ok) is called from the checker thread once the database
+        has answered; later frames for the same pair queue behind it, so
+        they keep their order.
+        """
+        if b in self.peers.get(a, ()):
+            self.stats["hits"] += 1
+            return True
+        with self.lock:
+            waiting = self.pending.get((a, b))
+            if waiting is None:
+                t = self.denied.get((a, b))
+                if t is not None and time.time() - t < self.neg_ttl:
+                    self.stats["hits"] += 1
+                    self.stats["denied"] += 1
+                    return False
+            if self.waiting >= self.max_waiting:
+                self.stats["overflow"] += 1
+                self.stats["denied"] += 1
+                return False
+            if waiting is None:
+                waiting = self.pending[(a, b)] = []
+                self.stats["misses"] += 1
+                self.checks.put((a, b))
+            waiting.append(then)
+            self.waiting += 1
+            self.stats["deferred"] += 1
+        return None
+
+    def _run(self):
+        while True:
+            a, b = self.checks.get()
+            try:
+                ok = self.checker(a, b)
+                failed = False
+            except Exception as e:
+                log.error("check %s -> %s failed: %s", a, b, e)
+                ok, failed = False, True      # not cached: the next frame asks again
+            # run the waiting frames before the answer is cached, so a newer
+            # frame for this pair cannot pass them on the fast path
+            done = 0
+            while True:
+                with self.lock:
+                    callbacks = self.pending[(a, b)][done:]
+                    if not callbacks:
+                        del self.pending[(a, b)]
+                        if ok:
+                            self._allow(a, b)
+                        else:
+                            self.stats["denied"] += 1
+                            if not failed:
+                                self._deny(a, b, time.time())
+                        break
+                    done += len(callbacks)
+                    self.waiting -= len(callbacks)
+                for fn in callbacks:
+                    try:
+                        fn(ok)
+                    except Exception as e:
+                        log.error("deferred frame %s -> %s failed: %s", a, b, e)
+
+    def on_event(self, ev):
+        if ev.get("event") != "chat_changed":
+            return
+        a, b = ev.get("users") or (None, None)
+        if a is None:
+            return
+        with self.lock:
+            self.stats["invalidations"] += 1
+            if ev.get("status") == "accepted":
+                self._allow(a, b)
+            else:
+                if b in self.peers.get(a, ()):
+                    self.stats["pairs"] -= 1
+                self.peers.get(a, set()).discard(b)
+                self.peers.get(b, set()).discard(a)
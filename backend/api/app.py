@@ -1,22 +1,47 @@
 # backend/api/app.py
-from flask import Flask, request, jsonify
+import json, os, time
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
 from models import (
-    init_db, create_user, validate_user, list_verified_users,
+    init_db, create_user, validate_user, users_page, groups_page,
     create_chat_request, set_chat_request_status, list_incoming_requests,
-    is_chat_allowed, create_group, list_groups, create_group_request,
-    list_group_requests_for_admin, accept_group_request
+    is_chat_allowed, create_group, create_group_request,
+    list_group_requests_for_admin, accept_group_request,
+    dm_history, group_history, parse_cursor, HISTORY_MAX_PAGE
 )
+from directory import DirectoryCache
+import events
+import metrics      # backend/, put on the path by events
 
 app = Flask(__name__)
 CORS(app)
 init_db()
+directory = DirectoryCache()
+metrics.expose("webtalk_directory", directory.snapshot)
+
+@app.before_request
+def start_timer():
+    g.t0 = time.perf_counter()
+
+@app.after_request
+def observe(resp):
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.histogram("webtalk_api_request_seconds", "Handler time per endpoint",
+                      endpoint=rule, method=request.method).since(g.t0)
+    metrics.counter("webtalk_api_responses_total", "Responses per endpoint and status",
+                    endpoint=rule, status=resp.status_code).inc()
+    return resp
+
+@app.get("/metrics")
+def metrics_text():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.post("/signup")
 def signup():
     data = request.get_json(force=True)
     try:
         create_user(data["username"], data["password"])
+        directory.bump("users")
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 400
@@ -28,10 +53,31 @@ def login():
         return jsonify({"ok": True})
     return jsonify({"ok": False, "error": "Invalid credentials"}), 401
 
+def directory_page(kind, loader, exclude=None):
+    """
+    One page of a directory listing: ?q= name prefix, ?after= cursor from the
+    previous page's "next", ?limit= (max DIRECTORY_MAX_PAGE). Answers 304 when
+    the client's ETag is still current, without loading anything. exclude
+    is passed on to the loader (users: the caller's own name).
+    """
+    query = (request.args.get("q", ""), request.args.get("after") or None,
+             request.args.get("limit", 50, type=int))
+    if exclude is not None:
+        query += (exclude,)          # filtered by the loader's SQL; part of the cache key and ETag
+    tag = directory.etag(kind, *query)
+    if request.if_none_match.contains_weak(tag):
+        directory.stats["not_modified"] += 1
+        resp = Response(status=304)
+    else:
+        items, nxt = directory.page(kind, query, loader)
+        resp = jsonify({kind: items, "next": nxt})
+    resp.set_etag(tag)
+    resp.headers["Cache-Control"] = "no-cache"     # always revalidate, usually a 304
+    return resp
+
 @app.get("/users")
 def users():
-    me = request.args.get("me")
-    return jsonify({"users": list_verified_users(exclude=me)})
+    return directory_page("users", users_page, exclude=request.args.get("me"))
 
 @app.get("/chat/requests/incoming")
 def incoming():
@@ -42,13 +88,17 @@ def incoming():
 def chat_request():
     data = request.get_json(force=True)
     req_id = create_chat_request(data["from_user"], data["to_user"])
+    events.publish("chat_request", users=[data["to_user"]],
+                   request={"id": req_id, "from_user": data["from_user"], "to_user": data["to_user"], "status": "pending"})
     return jsonify({"ok": True, "request_id": req_id})
 
 @app.post("/chat/accept")
 def chat_accept():
     data = request.get_json(force=True)
-    set_chat_request_status(data["request_id"], "accepted")
-    return jsonify({"ok": True})
+    pair = set_chat_request_status(data["request_id"], "accepted")
+    if pair:
+        events.publish("chat_changed", users=list(pair), status="accepted")
+    return jsonify({"ok": pair is not None})
 
 @app.get("/chat/allowed")
 def chat_allowed():
@@ -60,16 +110,25 @@ def chat_allowed():
 def group_create():
     data = request.get_json(force=True)
     gid = create_group(data["name"], data["created_by"])
+    directory.bump("groups")
+    events.publish("group_changed", group_id=gid)
     return jsonify({"ok": True, "group_id": gid})
 
 @app.get("/groups")
 def groups_list():
-    return jsonify({"groups": list_groups()})
+    return directory_page("groups", groups_page)
+
+@app.get("/directory/stats")
+def directory_stats():
+    return jsonify(directory.snapshot())
 
 @app.post("/group/join-request")
 def group_join_request():
     data = request.get_json(force=True)
-    rid = create_group_request(data["group_id"], data["user"])
+    rid, group = create_group_request(data["group_id"], data["user"])
+    if group:
+        events.publish("group_request", users=[group["created_by"]],
+                       request={"id": rid, "group_id": data["group_id"], "group_name": group["name"], "user": data["user"]})
     return jsonify({"ok": True, "request_id": rid})
 
 @app.get("/group/requests")
@@ -80,8 +139,10 @@ def group_requests():
 @app.post("/group/accept")
 def group_accept():
     data = request.get_json(force=True)
-    ok = accept_group_request(data["request_id"])
-    return jsonify({"ok": ok})
+    gid = accept_group_request(data["request_id"])
+    if gid is not None:
+        events.publish("group_changed", group_id=gid)
+    return jsonify({"ok": gid is not None})
 
 @app.get("/group/members")
 def group_members():
@@ -91,6 +152,42 @@ def group_members():
     from models import list_group_members
     return jsonify({"members": list_group_members(gid)})
 
+def stream_page(rows, limit):
+    """Stream a history page as JSON lines; the last line carries the next cursor."""
+    def gen():
+        last, n = None, 0
+        for row in rows:
+            last, n = row, n + 1
+            yield json.dumps(row) + "\n"
+        full = n >= min(max(limit, 1), HISTORY_MAX_PAGE)
+        nxt = f"{last['lamport']}:{last['id']}" if last and full else None
+        yield json.dumps({"next": nxt}) + "\n"
+    return Response(gen(), mimetype="application/x-ndjson")
+
+@app.get("/history/dm")
+def history_dm():
+    u1, u2 = request.args.get("u1"), request.args.get("u2")
+    if not u1 or not u2:
+        return jsonify({"ok": False, "error": "u1 and u2 are required"}), 400
+    try:
+        before = parse_cursor(request.args.get("before"))
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad cursor"}), 400
+    limit = request.args.get("limit", 50, type=int)
+    return stream_page(dm_history(u1, u2, before, limit), limit)
+
+@app.get("/history/group")
+def history_group():
+    gid = request.args.get("group_id", type=int)
+    if not gid:
+        return jsonify({"ok": False, "error": "group_id is required"}), 400
+    try:
+        before = parse_cursor(request.args.get("before"))
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad cursor"}), 400
+    limit = request.args.get("limit", 50, type=int)
+    return stream_page(group_history(gid, before, limit), limit)
+
 
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=7000, debug=True)
+    app.run(host="127.0.0.1", port=7000 + events.PORT_OFFSET, debug=os.environ.get("WEBTALK_DEBUG", "1") == "1")
@@ -0,0 +1,52 @@
+# backend/api/directory.py
+import os, threading, zlib
+from collections import OrderedDict
+
+# In-process cache for the /users and /groups directory pages.
+# Every listing has a version that create_user/create_group bump; pages are
+# cached under (kind, version, query), so a bump makes all older pages
+# unreachable at once. The version is also the ETag, which lets a client
+# that already has a page revalidate it without touching the database.
+BOOT = os.urandom(4).hex()      # a restarted API never repeats an old ETag
+MAX_PAGES = int(os.environ.get("WEBTALK_DIRECTORY_PAGES", "1024"))
+
+class DirectoryCache:
+    def __init__(self, max_pages=MAX_PAGES):
+        self.max_pages = max_pages
+        self.versions = {"users": 0, "groups": 0}
+        self.pages = OrderedDict()       # (kind, version, query) -> (items, next), LRU order
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "invalidations": 0}
+
+    def bump(self, kind):
+        with self.lock:
+            self.versions[kind] += 1
+            self.stats["invalidations"] += 1
+            for key in [k for k in self.pages if k[0] == kind]:
+                del self.pages[key]
+
+    def etag(self, kind, *query):
+        """Opaque tag for one response; changes whenever the listing does."""
+        crc = zlib.crc32(repr(query).encode())
+        return f"{kind}-{BOOT}-{self.versions[kind]}-{crc:08x}"
+
+    def page(self, kind, query, loader):
+        """(items, next) for query, from the cache or loader(*query)."""
+        key = (kind, self.versions[kind], query)
+        with self.lock:
+            hit = self.pages.get(key)
+            if hit is not None:
+                self.pages.move_to_end(key)
+                self.stats["hits"] += 1
+                return hit
+        # a bump while loading only strands this entry under the old version
+        result = loader(*query)
+        with self.lock:
+            self.stats["misses"] += 1
+            self.pages[key] = result
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        return result
+
+    def snapshot(self):
+        return dict(self.stats, pages=len(self.pages), versions=dict(self.versions))
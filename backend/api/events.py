@@ -0,0 +1,56 @@
+# backend/api/events.py
+import socket, json, os, sys, threading
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+import handoff
+import logs
+
+log = logs.get("EVENTS")
+
+# Change notifications from the API to the chat tier (fire-and-forget UDP).
+# Subscribers keep their own caches and treat these as invalidation hints;
+# a lost datagram only means a cache entry lives until its TTL.
+# The frontend relays chat_request/group_request to the target user's browser.
+PORT_OFFSET = int(os.environ.get("WEBTALK_PORT_OFFSET", "0"))
+DEFAULT_SUBSCRIBERS = ",".join(f"127.0.0.1:{p + PORT_OFFSET}" for p in (6200, 6202, 6210))   # primary, replica, frontend
+
+def _parse(spec):
+    out = []
+    for item in spec.split(","):
+        item = item.strip()
+        if item:
+            host, port = item.rsplit(":", 1)
+            out.append((host, int(port)))
+    return out
+
+SUBSCRIBERS = _parse(os.environ.get("WEBTALK_EVENT_SUBSCRIBERS", DEFAULT_SUBSCRIBERS))
+_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+def publish(event, **fields):
+    fields["event"] = event
+    payload = json.dumps(fields).encode()
+    for addr in SUBSCRIBERS:
+        try:
+            _sock.sendto(payload, addr)
+        except OSError:
+            pass
+
+def listen(addr, handler):
+    """Receive published events on addr in a background thread."""
+    s = handoff.bind(addr, socket.SOCK_DGRAM, reuse_addr=True)
+    s.settimeout(handoff.POLL)
+
+    def loop():
+        while not handoff.handed_off.is_set():
+            try:
+                data, _ = s.recvfrom(65536)
+            except socket.timeout:
+                continue
+            try:
+                handler(json.loads(data))
+            except Exception as e:
+                log.warning("bad event: %s", e)
+    threading.Thread(target=loop, daemon=True).start()
+    return s
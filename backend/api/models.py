@@ -1,10 +1,37 @@
 # backend/api/models.py
 import sqlite3
 import os
+import queue
 from contextlib import contextmanager
 from werkzeug.security import generate_password_hash, check_password_hash
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "webtalk.sqlite")
+DB_PATH = os.environ.get("WEBTALK_DB") or os.path.join(os.path.dirname(__file__), "webtalk.sqlite")
+POOL_SIZE = 16            # idle connections kept open
+STATEMENT_CACHE = 128     # prepared statements cached per connection
+
+# Schema changes applied in order on top of the base tables; PRAGMA user_version
+# records how many have run.
+MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS idx_chat_requests_to_status ON chat_requests(to_user, status)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_requests_pair ON chat_requests(from_user, to_user)",
+        "CREATE INDEX IF NOT EXISTS idx_group_members_group_user ON group_members(group_id, user)",
+        "CREATE INDEX IF NOT EXISTS idx_group_requests_group_status ON group_requests(group_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_recipient_lamport ON messages(recipient, lamport)",
+    ],
+    [
+        # canonical "a\x00b" key for a DM pair so both directions share one index range
+        "ALTER TABLE messages ADD COLUMN peer_key TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_messages_peer_lamport ON messages(peer_key, lamport, id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_group_lamport ON messages(group_id, lamport, id)",
+    ],
+    [
+        # covering index for the user directory: verified=1 AND username range, no table lookups
+        "CREATE INDEX IF NOT EXISTS idx_users_verified_username ON users(verified, username)",
+    ],
+]
+HISTORY_MAX_PAGE = 500
+DIRECTORY_MAX_PAGE = 200
 
 def init_db():
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
@@ -53,17 +80,54 @@ def init_db():
             lamport INTEGER NOT NULL,
             ts INTEGER NOT NULL
         )""")
+        conn.execute("PRAGMA journal_mode=WAL")
+        migrate(conn)
         conn.commit()
 
-@contextmanager
-def db():
-    conn = sqlite3.connect(DB_PATH)
+def migrate(conn):
+    # the API and the chat servers start together: take the write lock before
+    # reading user_version so only one of them applies each migration
+    conn.execute("BEGIN IMMEDIATE")
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for i, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        for sql in statements:
+            conn.execute(sql)
+        conn.execute(f"PRAGMA user_version={i}")
+    conn.commit()
+
+# ---------------- connection pool ----------------
+
+_pool = queue.LifoQueue()
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=STATEMENT_CACHE)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+@contextmanager
+def db(readonly=False):
+    """
+    Borrow a pooled connection. Writers commit on success and roll back on
+    error; readonly=True skips the commit entirely.
+    """
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
     try:
         yield conn
+        if not readonly:
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
     finally:
-        conn.commit()
-        conn.close()
+        if _pool.qsize() < POOL_SIZE:
+            _pool.put(conn)
+        else:
+            conn.close()
 
 def create_user(username, password):
     with db() as conn:
@@ -73,14 +137,14 @@ def create_user(username, password):
         return cur.lastrowid
 
 def validate_user(username, password):
-    with db() as conn:
+    with db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT password_hash FROM users WHERE username=?", (username,))
         row = cur.fetchone()
         return row and check_password_hash(row["password_hash"], password)
 
 def list_verified_users(exclude=None):
-    with db() as conn:
+    with db(readonly=True) as conn:
         cur = conn.cursor()
         if exclude:
             cur.execute("SELECT username FROM users WHERE verified=1 AND username!=? ORDER BY username", (exclude,))
@@ -88,6 +152,40 @@ def list_verified_users(exclude=None):
             cur.execute("SELECT username FROM users WHERE verified=1 ORDER BY username")
         return [r["username"] for r in cur.fetchall()]
 
+def _directory_page(select, column, where, prefix, after, limit, where_args=()):
+    # keyset pagination over a unique text column, optionally limited to a prefix;
+    # one extra row tells whether there is a next page
+    limit = max(1, min(int(limit), DIRECTORY_MAX_PAGE))
+    where, args = list(where), list(where_args)
+    if after is not None and after >= (prefix or ""):
+        where.append(f"{column} > ?")
+        args.append(after)
+    elif prefix:
+        where.append(f"{column} >= ?")
+        args.append(prefix)
+    if prefix:
+        where.append(f"{column} < ?")
+        args.append(prefix + "\U0010ffff")
+    sql = select + (" WHERE " + " AND ".join(where) if where else "") + f" ORDER BY {column} LIMIT ?"
+    with db(readonly=True) as conn:
+        rows = [dict(r) for r in conn.execute(sql, args + [limit + 1])]
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, (rows[-1][column] if more else None)
+
+def users_page(prefix="", after=None, limit=50, exclude=None):
+    """(usernames, next) - verified users in name order starting with prefix, after the cursor, without exclude."""
+    where, args = ["verified=1"], []
+    if exclude is not None:
+        where.append("username != ?")       # in SQL, so a page still holds `limit` names
+        args.append(exclude)
+    rows, nxt = _directory_page("SELECT username FROM users", "username", where, prefix, after, limit, args)
+    return [r["username"] for r in rows], nxt
+
+def groups_page(prefix="", after=None, limit=50):
+    """(groups, next) - like users_page, over group names."""
+    return _directory_page("SELECT id, name, created_by FROM groups", "name", [], prefix, after, limit)
+
 def create_chat_request(from_user, to_user):
     with db() as conn:
         cur = conn.cursor()
@@ -96,17 +194,24 @@ def create_chat_request(from_user, to_user):
         return cur.lastrowid
 
 def set_chat_request_status(req_id, status):
+    """Returns (from_user, to_user) of the request, or None if it doesn't exist."""
     with db() as conn:
-        conn.execute("UPDATE chat_requests SET status=? WHERE id=?", (status, req_id))
+        cur = conn.cursor()
+        cur.execute("UPDATE chat_requests SET status=? WHERE id=?", (status, req_id))
+        if cur.rowcount == 0:
+            return None
+        cur.execute("SELECT from_user, to_user FROM chat_requests WHERE id=?", (req_id,))
+        r = cur.fetchone()
+        return (r["from_user"], r["to_user"])
 
 def list_incoming_requests(user):
-    with db() as conn:
+    with db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT * FROM chat_requests WHERE to_user=? AND status='pending'", (user,))
         return [dict(r) for r in cur.fetchall()]
 
 def is_chat_allowed(u1, u2):
-    with db() as conn:
+    with db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("""SELECT 1 FROM chat_requests
                        WHERE ((from_user=? AND to_user=?)
@@ -114,6 +219,12 @@ def is_chat_allowed(u1, u2):
                          AND status='accepted'""", (u1, u2, u2, u1))
         return cur.fetchone() is not None
 
+def list_accepted_chats():
+    """Every (from_user, to_user) pair allowed to DM; bulk-loaded by the chat tier's ACL cache."""
+    with db(readonly=True) as conn:
+        return [(r["from_user"], r["to_user"])
+                for r in conn.execute("SELECT from_user, to_user FROM chat_requests WHERE status='accepted'")]
+
 def create_group(name, created_by):
     with db() as conn:
         cur = conn.cursor()
@@ -123,17 +234,19 @@ def create_group(name, created_by):
         return gid
 
 def list_groups():
-    with db() as conn:
+    with db(readonly=True) as conn:
         return [dict(r) for r in conn.execute("SELECT * FROM groups ORDER BY name")]
 
 def create_group_request(group_id, user):
+    """(request_id, group) where group is {name, created_by} of the target group, or None."""
     with db() as conn:
         cur = conn.cursor()
         cur.execute("INSERT INTO group_requests(group_id,user,status) VALUES(?,?,'pending')", (group_id, user))
-        return cur.lastrowid
+        g = cur.execute("SELECT name, created_by FROM groups WHERE id=?", (group_id,)).fetchone()
+        return cur.lastrowid, dict(g) if g else None
 
 def list_group_requests_for_admin(admin_user):
-    with db() as conn:
+    with db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("""SELECT gr.id, gr.group_id, g.name as group_name, gr.user
                        FROM group_requests gr
@@ -146,19 +259,77 @@ def accept_group_request(req_id):
         cur = conn.cursor()
         cur.execute("SELECT group_id, user FROM group_requests WHERE id=?", (req_id,))
         r = cur.fetchone()
-        if not r: return False
+        if not r: return None
         cur.execute("UPDATE group_requests SET status='accepted' WHERE id=?", (req_id,))
         cur.execute("INSERT INTO group_members(group_id,user) VALUES(?,?)", (r["group_id"], r["user"]))
-        return True
+        return r["group_id"]
 
 def is_member(group_id, user):
-    with db() as conn:
+    with db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT 1 FROM group_members WHERE group_id=? AND user=?", (group_id, user))
         return cur.fetchone() is not None
 def list_group_members(group_id: int) -> list[str]:
-    with db() as conn:
+    with db(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT user FROM group_members WHERE group_id=?", (group_id,))
         rows = cur.fetchall()
         return [r["user"] for r in rows]
+
+def list_all_group_members():
+    """Every (group_id, user) membership, for bulk-loading the chat tier's caches."""
+    with db(readonly=True) as conn:
+        return [(r["group_id"], r["user"]) for r in conn.execute("SELECT group_id, user FROM group_members")]
+
+# ---------------- message history ----------------
+
+def peer_key(u1, u2):
+    a, b = sorted((u1, u2))
+    return f"{a}\x00{b}"
+
+def insert_messages(rows):
+    """rows: iterable of (sender, recipient, group_id, text, lamport, ts)."""
+    with db() as conn:
+        conn.executemany(
+            "INSERT INTO messages(sender,recipient,group_id,text,lamport,ts,peer_key) VALUES(?,?,?,?,?,?,?)",
+            [(s, r, g, t, l, ts, peer_key(s, r) if r is not None else None) for s, r, g, t, l, ts in rows])
+
+def missing_messages(rows):
+    """The rows (as for insert_messages) that are not stored yet, matched by stamp and sender."""
+    out = []
+    with db(readonly=True) as conn:
+        for row in rows:
+            s, r, g = row[0], row[1], row[2]
+            if r is not None:
+                hit = conn.execute("SELECT 1 FROM messages WHERE recipient=? AND lamport=? AND sender=?", (r, row[4], s))
+            else:
+                hit = conn.execute("SELECT 1 FROM messages WHERE group_id=? AND lamport=? AND sender=?", (g, row[4], s))
+            if hit.fetchone() is None:
+                out.append(row)
+    return out
+
+def parse_cursor(cursor):
+    """'<lamport>:<id>' -> (lamport, id), or None for the newest page."""
+    if not cursor:
+        return None
+    lamport, mid = cursor.split(":", 1)
+    return int(lamport), int(mid)
+
+def _history(where, args, before, limit):
+    # keyset pagination: newest first, strictly older than the (lamport, id) cursor
+    limit = max(1, min(int(limit), HISTORY_MAX_PAGE))
+    sql = f"SELECT id, sender, recipient, group_id, text, lamport, ts FROM messages WHERE {where}"
+    if before:
+        sql += " AND (lamport, id) < (?, ?)"    # row value: an index range, not a filter
+        args = args + tuple(before)
+    sql += " ORDER BY lamport DESC, id DESC LIMIT ?"
+    with db(readonly=True) as conn:
+        for r in conn.execute(sql, args + (limit,)):
+            yield dict(r)
+
+def dm_history(u1, u2, before=None, limit=50):
+    """Yield one page of the u1<->u2 conversation without materialising it."""
+    return _history("peer_key = ?", (peer_key(u1, u2),), before, limit)
+
+def group_history(group_id, before=None, limit=50):
+    return _history("group_id = ?", (group_id,), before, limit)
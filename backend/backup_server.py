@@ -1,9 +1,32 @@
 # backend/backup_server.py
-import socket, threading, json, sqlite3, os
+import socket, threading, json, sqlite3, os, selectors, time
+from catchup import LOG_ADDR, SNAPSHOT_DIR, COLUMNS, PORT_OFFSET, snapshot_path, list_snapshots
+from lamport import HLC_MIN
+import logs
+import metrics
+import tracing
 
+log = logs.get("BACKUP")
+HOST = "127.0.0.1"
+PORT = 6001 + PORT_OFFSET
+METRICS_ADDR = (HOST, 9001 + PORT_OFFSET)   # Prometheus GET /metrics
 os.makedirs("database", exist_ok=True)
 DB = "database/backup.sqlite"
+FLUSH_INTERVAL = float(os.environ.get("BACKUP_FLUSH_MS", "10")) / 1000.0  # group-commit window
+MAX_GROUP = int(os.environ.get("BACKUP_MAX_GROUP", "20000"))              # rows per transaction
+MAX_FRAME = 1 << 20
+RETRY_MAX = 2.0              # seconds; cap of the backoff after a failed commit
+SNAPSHOT_INTERVAL = float(os.environ.get("BACKUP_SNAPSHOT_S", "300"))      # how often to consider a snapshot
+SNAPSHOT_MIN_ROWS = int(os.environ.get("BACKUP_SNAPSHOT_ROWS", "50000"))  # new rows needed to take one
+SNAPSHOT_KEEP = 2
+LOG_BATCH = 5000             # rows per read when shipping the backlog
+LOG_IDLE = 5.0               # seconds between head notices on an idle log stream
+COMMIT = metrics.histogram("webtalk_backup_commit_seconds", "One group commit into the backup database")
+ROWS_IN = metrics.counter("webtalk_backup_rows_in_total", "Rows received from the chat nodes")
+
 conn = sqlite3.connect(DB, check_same_thread=False)
+conn.execute("PRAGMA journal_mode=WAL")
+conn.execute("PRAGMA synchronous=NORMAL")   # WAL + NORMAL: durable on checkpoint, no fsync per commit
 cur = conn.cursor()
 cur.execute("""CREATE TABLE IF NOT EXISTS messages(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -16,34 +39,287 @@ cur.execute("""CREATE TABLE IF NOT EXISTS messages(
     ts INTEGER
 )""")
 conn.commit()
+# a chat node sends frames again when it reconnects before they were acknowledged; the
+# HLC stamp (node number in its low bits) plus sender identifies a message, so repeats
+# are ignored instead of stored twice. Rows from before the HLC carry per-node Lamport
+# counters that may repeat legitimately, so the index only covers HLC stamps.
+conn.execute("DROP INDEX IF EXISTS idx_messages_stamp")     # the unconditional first version
+try:
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_hlc ON messages(lamport, sender) WHERE lamport >= {HLC_MIN}")
+except sqlite3.IntegrityError:
+    # resends stored before acknowledgements existed: keep every row, dedupe from here on
+    floor = conn.execute("SELECT max(lamport) + 1 FROM messages").fetchone()[0]
+    conn.execute(f"CREATE UNIQUE INDEX idx_messages_hlc ON messages(lamport, sender) WHERE lamport >= {floor}")
+    log.warning("duplicate stamps already stored; deduplicating stamps from %d on", floor)
+conn.commit()
+head_lsn = conn.execute("SELECT coalesce(max(id), 0) FROM messages").fetchone()[0]
+committed = threading.Condition()   # notified whenever head_lsn moves
+
+INSERT_SQL = "INSERT OR IGNORE INTO messages(kind,sender,recipient,groupname,text,lamport,ts) VALUES(?,?,?,?,?,?,?)"
+
+pending = []                     # rows waiting for the writer
+pending_traces = []              # (trace context, received at) for the traced ones among them
+pending_acks = []                # (Conn, frames received on it) to acknowledge once committed
+pending_cv = threading.Condition()
+stats = {"frames": 0, "bad_frames": 0, "rows": 0, "duplicates": 0, "failed_rows": 0, "commits": 0, "last_commit_ms": 0.0,
+         "snapshots": 0, "last_snapshot_lsn": None, "last_snapshot_ms": None, "log_streams": 0}
+
+def to_row(msg):
+    kind = msg.get("kind")
+    if kind == "private":
+        return ("private", msg["from"], msg.get("to"), None, msg["message"], msg["clock"], msg["ts"])
+    if kind == "group":
+        return ("group", msg["from"], None, msg.get("group"), msg["message"], msg["clock"], msg["ts"])
+    return None
+
+# ---------------- single writer (group commit) ----------------
+
+def ack(acks):
+    # the highest count per connection covers the earlier ones
+    latest = {}
+    for c, n in acks:
+        latest[c] = n
+    for c, n in latest.items():
+        try:
+            c.sock.send(b'{"ack": %d}\n' % n)
+        except OSError:
+            pass             # gone: the node sends the frames again on its next connection
+
+def writer_loop():
+    global pending, pending_traces, pending_acks, head_lsn
+    backoff = 0.0
+    while True:
+        with pending_cv:
+            while not pending and not pending_acks:
+                pending_cv.wait()
+        # let more rows pile up behind the first one, then take the whole group
+        time.sleep(FLUSH_INTERVAL)
+        with pending_cv:
+            rows, pending = pending, []
+            traces, pending_traces = pending_traces, []
+            acks, pending_acks = pending_acks, []
+        t0 = time.perf_counter()
+        failed = None
+        for i in range(0, len(rows), MAX_GROUP):
+            tc = time.perf_counter()
+            group = rows[i:i + MAX_GROUP]
+            try:
+                before = conn.total_changes
+                conn.executemany(INSERT_SQL, group)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                failed = i
+                stats["failed_rows"] += len(group)
+                log.error("commit of %d row(s) failed, retrying: %s", len(group), e)
+                break
+            COMMIT.since(tc)
+            stats["commits"] += 1
+            stats["rows"] += conn.total_changes - before
+            stats["duplicates"] += len(group) - (conn.total_changes - before)
+        if failed is not None:
+            # e.g. "database is locked": keep the rest, ahead of what arrived meanwhile,
+            # and hold the acks (and trace spans) until they are in
+            with pending_cv:
+                pending[:0] = rows[failed:]
+                pending_traces[:0] = traces
+                pending_acks[:0] = acks
+            backoff = min(max(backoff * 2, 0.05), RETRY_MAX)
+            time.sleep(backoff)
+            continue
+        backoff = 0.0
+        ack(acks)
+        stats["last_commit_ms"] = (time.perf_counter() - t0) * 1000
+        if traces:
+            done = time.time()
+            for ctx, t in traces:
+                tracing.span(ctx, "commit", t, done)
+        with committed:
+            head_lsn = conn.execute("SELECT max(id) FROM messages").fetchone()[0] or 0
+            committed.notify_all()
+
+# ---------------- snapshots ----------------
+
+def take_snapshot():
+    """Write a compacted copy of the database named after the highest LSN in it."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp = os.path.join(SNAPSHOT_DIR, "snapshot.tmp")
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    t0 = time.perf_counter()
+    sconn = sqlite3.connect(DB)
+    try:
+        sconn.execute("VACUUM INTO ?", (tmp,))     # a consistent read, concurrent with the writer
+    finally:
+        sconn.close()
+    check = sqlite3.connect(tmp)
+    try:
+        lsn = check.execute("SELECT coalesce(max(id), 0) FROM messages").fetchone()[0]
+    finally:
+        check.close()
+    os.replace(tmp, snapshot_path(lsn))
+    for _, old in list_snapshots()[:-SNAPSHOT_KEEP]:
+        os.remove(old)
+    stats["snapshots"] += 1
+    stats["last_snapshot_lsn"] = lsn
+    stats["last_snapshot_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    log.info("snapshot at LSN %d in %s ms", lsn, stats["last_snapshot_ms"])
+    return lsn
+
+def snapshot_loop():
+    snaps = list_snapshots()
+    last = snaps[-1][0] if snaps else 0
+    while True:
+        if head_lsn - last >= SNAPSHOT_MIN_ROWS:
+            try:
+                last = take_snapshot()
+            except (sqlite3.Error, OSError) as e:
+                log.error("snapshot failed: %s", e)
+        time.sleep(SNAPSHOT_INTERVAL)
+
+# ---------------- log shipping to replicas ----------------
 
-def handle(conn_sock):
+def serve_log(c):
+    """Send one replica every row after its LSN, then follow new commits."""
+    rconn = sqlite3.connect(DB)
+    stats["log_streams"] += 1
     try:
+        req = b""
+        while b"\n" not in req:
+            chunk = c.recv(1024)
+            if not chunk:
+                return
+            req += chunk
+        lsn = int(json.loads(req.split(b"\n", 1)[0]).get("from", 0))
+        log.info("replica streaming from LSN %d (head %d)", lsn, head_lsn)
+        caught_up = False
         while True:
-            data = conn_sock.recv(4096)
-            if not data: break
-            msg = json.loads(data.decode())
-            kind = msg.get("kind")
-            if kind == "private":
-                cur.execute("INSERT INTO messages(kind,sender,recipient,text,lamport,ts) VALUES(?,?,?,?,?,?)",
-                            ("private", msg["from"], msg.get("to"), msg["message"], msg["clock"], msg["ts"]))
-            elif kind == "group":
-                cur.execute("INSERT INTO messages(kind,sender,groupname,text,lamport,ts) VALUES(?,?,?,?,?,?)",
-                            ("group", msg["from"], msg.get("group"), msg["message"], msg["clock"], msg["ts"]))
-            conn.commit()
-            print("[BACKUP] stored:", msg)
+            rows = rconn.execute(f"SELECT {COLUMNS} FROM messages WHERE id>? ORDER BY id LIMIT ?",
+                                 (lsn, LOG_BATCH)).fetchall()
+            if rows:
+                c.sendall("".join(json.dumps(r) + "\n" for r in rows).encode())
+                lsn = rows[-1][0]
+                if len(rows) == LOG_BATCH:
+                    continue
+            if not caught_up:
+                c.sendall((json.dumps({"caught_up": lsn}) + "\n").encode())
+                caught_up = True
+            with committed:
+                if head_lsn <= lsn and not committed.wait(LOG_IDLE):
+                    c.sendall((json.dumps({"head": head_lsn}) + "\n").encode())
+    except (OSError, ValueError) as e:
+        log.info("log stream closed: %s", e)
     finally:
-        conn_sock.close()
+        stats["log_streams"] -= 1
+        rconn.close()
+        try: c.close()
+        except: pass
+
+def log_server():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(LOG_ADDR)
+    s.listen(16)
+    log.info("log shipping on %s:%d", *LOG_ADDR)
+    while True:
+        c, _ = s.accept()
+        threading.Thread(target=serve_log, args=(c,), daemon=True).start()
+
+# ---------------- readers (one event loop for all connections) ----------------
+
+class Conn:
+    __slots__ = ("sock", "buf", "frames")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+        self.frames = 0          # frames received so far; acknowledged once committed
+
+def parse_frames(buf, traced):
+    """
+    Pop complete newline-delimited frames off the front of buf; traced gets
+    their trace contexts. Returns the rows and the number of frames taken.
+    """
+    rows, start, n = [], 0, 0
+    while True:
+        nl = buf.find(b"\n", start)
+        if nl < 0:
+            break
+        if nl > start:
+            n += 1
+            try:
+                msg = json.loads(buf[start:nl])
+                row = to_row(msg)
+                stats["frames"] += 1
+                if row:
+                    rows.append(row)
+                    if "trace" in msg:
+                        ctx = tracing.accept(msg["trace"], "replication")
+                        if ctx:
+                            traced.append((ctx, time.time()))
+            except (ValueError, KeyError, TypeError):
+                stats["bad_frames"] += 1
+        start = nl + 1
+    if start:
+        del buf[:start]          # one compaction per recv, not per frame
+    return rows, n
+
+def close(sel, c):
+    sel.unregister(c.sock)
+    try: c.sock.close()
+    except: pass
 
 def start_backup():
+    threading.Thread(target=writer_loop, daemon=True).start()
+    threading.Thread(target=snapshot_loop, daemon=True).start()
+    threading.Thread(target=log_server, daemon=True).start()
+    metrics.expose("webtalk_backup", lambda: dict(stats, head_lsn=head_lsn, pending=len(pending)))
+    metrics.serve(METRICS_ADDR)
+
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(("127.0.0.1", 6001))
+    s.bind((HOST, PORT))
     s.listen(64)
-    print("[BACKUP] listening on 127.0.0.1:6001")
+    s.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(s, selectors.EVENT_READ, None)
+    scratch = bytearray(256 * 1024)
+    view = memoryview(scratch)
+    log.info("listening on %s:%d (flush every %.0f ms)", HOST, PORT, FLUSH_INTERVAL * 1000)
+
     while True:
-        c, _ = s.accept()
-        threading.Thread(target=handle, args=(c,), daemon=True).start()
+        for key, _ in sel.select():
+            if key.data is None:
+                c, addr = s.accept()
+                c.setblocking(False)
+                sel.register(c, selectors.EVENT_READ, Conn(c))
+                log.info("replicator connected from %s", addr)
+                continue
+            c = key.data
+            try:
+                n = c.sock.recv_into(scratch)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                n = 0
+            if not n:
+                close(sel, c)
+                continue
+            c.buf += view[:n]
+            traced = []
+            rows, frames = parse_frames(c.buf, traced)
+            if len(c.buf) > MAX_FRAME:
+                log.warning("oversized frame, dropping connection")
+                close(sel, c)
+                continue
+            if frames:
+                c.frames += frames
+                ROWS_IN.inc(len(rows))
+                with pending_cv:
+                    pending.extend(rows)
+                    pending_traces.extend(traced)
+                    pending_acks.append((c, c.frames))
+                    pending_cv.notify()
 
 if __name__ == "__main__":
     start_backup()
@@ -1,18 +1,189 @@
 # backend/bully_election.py
-import socket, threading, time
+import socket, threading, json, time, os
+import handoff
+import logs
+
+log = logs.get("BULLY")
+
+HEARTBEAT_INTERVAL = float(os.environ.get("BULLY_HEARTBEAT_MS", 100)) / 1000
+SUSPECT_TIMEOUT = float(os.environ.get("BULLY_SUSPECT_MS", 300)) / 1000   # silence before a node is presumed dead
+ELECTION_TIMEOUT = float(os.environ.get("BULLY_ELECTION_MS", 150)) / 1000 # wait for OK from a higher node
+COORDINATOR_TIMEOUT = 0.5   # after an OK, wait this long for the winner to announce itself
 
 class Bully:
     """
-    Minimal bully scaffold. In this single-primary demo, we just expose API
-    and print role; can be extended with more nodes (ports) to fully elect.
+    Bully leader election between chat nodes over UDP.
+
+    Every node heartbeats its peers (and any observers, e.g. the load
+    balancer) every HEARTBEAT_INTERVAL. A peer silent for SUSPECT_TIMEOUT is
+    presumed dead; if it was the leader an election starts: ELECTION goes to
+    every higher id, any live higher node answers OK and takes over the
+    election, and a node that hears no OK within ELECTION_TIMEOUT declares
+    itself leader with COORDINATOR. The highest live id always wins.
+
+    peers: [(id, host, port)]. info is merged into every message (node name,
+    client address) so observers can map ids to backends. Callbacks run on
+    the election thread: on_leader(leader_id), on_down(id, info), on_up(id, info).
     """
-    def __init__(self, my_id, peers):
+    def __init__(self, my_id, peers, listen_addr=None, info=None, observers=(),
+                 on_leader=None, on_down=None, on_up=None):
         self.my_id = my_id
-        self.peers = peers  # [(id,host,port_for_election)]
-        self.leader = my_id
+        self.peers = {pid: (host, port) for pid, host, port in peers}
+        self.listen_addr = listen_addr
+        self.info = info or {}
+        self.observers = list(observers)
+        self.on_leader = on_leader
+        self.on_down = on_down
+        self.on_up = on_up
+        self.leader = my_id if not self.peers else None
+        self.alive = {}             # peer id -> info from its last message
+        self.last_seen = {}         # peer id -> monotonic time of its last message
+        self.election = None        # {"started": t, "ok_at": t or None} while electing
+        self.failover = None        # timestamps of the leader failure being handled
+        self.lock = threading.RLock()
+        self.sock = None
+        self.stats = {"elections": 0, "won": 0, "leader_changes": 0, "suspected": 0,
+                      "last_failover": None}
 
     def start(self):
-        print(f"[BULLY] Node {self.my_id} assumes leader (single-node demo).")
+        if not self.peers:
+            log.info("node %s assumes leader (no peers configured)", self.my_id)
+            return self
+        self.sock = handoff.bind(self.listen_addr, socket.SOCK_DGRAM)
+        self.sock.settimeout(HEARTBEAT_INTERVAL / 2)
+        log.info("node %s electing on %s:%d", self.my_id, *self.listen_addr)
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
 
     def is_leader(self):
         return self.leader == self.my_id
+
+    # ---------------- messaging ----------------
+
+    def _msg(self, kind, **extra):
+        return json.dumps(dict(self.info, t=kind, id=self.my_id, leader=self.leader, **extra)).encode()
+
+    def _send(self, addr, data):
+        try:
+            self.sock.sendto(data, addr)
+        except OSError:
+            pass
+
+    def _broadcast(self, data, observers=True):
+        for addr in self.peers.values():
+            self._send(addr, data)
+        if observers:
+            for addr in self.observers:
+                self._send(addr, data)
+
+    # ---------------- protocol ----------------
+
+    def _run(self):
+        next_hb = 0
+        # a restarting node heartbeats until its successor has the socket (handoff.py)
+        while not handoff.handed_off.is_set():
+            try:
+                data, _ = self.sock.recvfrom(65536)
+                self._on_message(json.loads(data))
+            except socket.timeout:
+                pass
+            except (OSError, ValueError) as e:
+                log.warning("bad message: %s", e)
+            now = time.monotonic()
+            with self.lock:
+                if now >= next_hb:
+                    self._broadcast(self._msg("hb"))
+                    next_hb = now + HEARTBEAT_INTERVAL
+                self._check(now)
+
+    def _on_message(self, msg):
+        pid, kind = msg.get("id"), msg.get("t")
+        if pid not in self.peers:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.last_seen[pid] = now
+            if pid not in self.alive:
+                self.alive[pid] = msg
+                log.info("node %s is up", pid)
+                if self.on_up:
+                    self.on_up(pid, msg)
+            self.alive[pid] = msg
+            if kind == "election" and pid < self.my_id:
+                self._send(self.peers[pid], self._msg("ok"))
+                if self.is_leader():
+                    self._send(self.peers[pid], self._msg("coord", down=[]))
+                elif self.election is None:
+                    self._start_election(now)
+            elif kind == "ok" and pid > self.my_id and self.election is not None:
+                self.election["ok_at"] = now
+            elif kind == "coord":
+                if pid < self.my_id:
+                    # a lower node claimed leadership: bully it
+                    if self.election is None:
+                        self._start_election(now)
+                else:
+                    self._set_leader(pid, now)
+            elif kind == "hb" and self.leader is None and msg.get("leader") == pid and pid > self.my_id:
+                # joined a cluster that already has a higher leader
+                self._set_leader(pid, now)
+
+    def _check(self, now):
+        for pid in list(self.alive):
+            if now - self.last_seen[pid] > SUSPECT_TIMEOUT:
+                info = self.alive.pop(pid)
+                self.stats["suspected"] += 1
+                log.warning("node %s suspected dead", pid)
+                if pid == self.leader:
+                    self.leader = None
+                    self.failover = {"last_seen": self.last_seen[pid], "detected": now}
+                    if self.election is None:
+                        self._start_election(now)
+                if self.on_down:
+                    self.on_down(pid, info)
+        e = self.election
+        if e is not None:
+            if e["ok_at"] is None and now - e["started"] > ELECTION_TIMEOUT:
+                self._win(now)
+            elif e["ok_at"] is not None and now - e["ok_at"] > COORDINATOR_TIMEOUT:
+                self._start_election(now)     # the higher node went quiet mid-election
+        elif self.leader is None or (self.leader < self.my_id):
+            self._start_election(now)
+
+    def _start_election(self, now):
+        self.election = {"started": now, "ok_at": None}
+        self.stats["elections"] += 1
+        data = self._msg("election")
+        for pid, addr in self.peers.items():
+            if pid > self.my_id:
+                self._send(addr, data)
+
+    def _win(self, now):
+        self.stats["won"] += 1
+        down = [pid for pid in self.peers if pid not in self.alive]
+        self._broadcast(self._msg("coord", down=down))
+        self._set_leader(self.my_id, now)
+
+    def _set_leader(self, leader, now):
+        self.election = None
+        if leader == self.leader:
+            return
+        self.leader = leader
+        self.stats["leader_changes"] += 1
+        log.info("node %s is leader", leader)
+        if self.on_leader:
+            self.on_leader(leader)
+        f, self.failover = self.failover, None
+        if f is not None:
+            # detect + elect only: the redirect happens in the load balancer,
+            # which reports it as last_failover_ms (last beat -> node taken out)
+            self.stats["last_failover"] = {
+                "detect_ms": round((f["detected"] - f["last_seen"]) * 1000, 1),
+                "elect_ms": round((now - f["detected"]) * 1000, 1),
+                "total_ms": round((now - f["last_seen"]) * 1000, 1),
+            }
+            log.info("new leader %s ms after the old one's last beat", self.stats["last_failover"]["total_ms"])
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, leader=self.leader, alive=sorted(self.alive))
@@ -0,0 +1,204 @@
+# backend/catchup.py
+import socket, threading, json, sqlite3, os, re, shutil, time
+import logs
+
+PORT_OFFSET = int(os.environ.get("WEBTALK_PORT_OFFSET", "0"))   # every default port shifts by this (bench/ runs whole stacks side by side)
+
+# Log shipping from the backup sink to replicas.
+#
+# The backup's messages.id (AUTOINCREMENT, never reused) is the log sequence
+# number (LSN). The backup periodically writes a compacted snapshot of its
+# database named after the highest LSN it contains, and serves the log tail
+# on LOG_PORT: a replica sends {"from": lsn} and receives every later row as a
+# JSON array [lsn, kind, sender, recipient, group, text, lamport, ts], then
+# {"caught_up": lsn} once it has the backlog, then live rows as they commit.
+# While idle the backup sends {"head": lsn} every few seconds.
+LOG_ADDR = ("127.0.0.1", 6011 + PORT_OFFSET)
+SNAPSHOT_DIR = "database/snapshots"
+SNAPSHOT_GAP = 200000       # a replica further behind than this restarts from the snapshot
+
+COLUMNS = "id,kind,sender,recipient,groupname,text,lamport,ts"
+SCHEMA = """CREATE TABLE IF NOT EXISTS messages(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT,
+    sender TEXT,
+    recipient TEXT,
+    groupname TEXT,
+    text TEXT,
+    lamport INTEGER,
+    ts INTEGER
+)"""
+
+_SNAP_RE = re.compile(r"^backup-(\d+)\.sqlite$")
+
+def snapshot_path(lsn, snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, "backup-%012d.sqlite" % lsn)
+
+def list_snapshots(snapshot_dir=SNAPSHOT_DIR):
+    """[(lsn, path)] oldest first."""
+    try:
+        names = os.listdir(snapshot_dir)
+    except FileNotFoundError:
+        return []
+    snaps = [(int(m.group(1)), os.path.join(snapshot_dir, n)) for n in names for m in [_SNAP_RE.match(n)] if m]
+    return sorted(snaps)
+
+def latest_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    snaps = list_snapshots(snapshot_dir)
+    return snaps[-1] if snaps else None
+
+class ReplicaLog:
+    """
+    A replica's local copy of the backup log. On start it adopts the newest
+    snapshot if it has no copy yet (or is more than SNAPSHOT_GAP behind),
+    then streams only the tail after its persisted LSN and keeps following
+    live commits. Rows and the LSN are committed in the same transaction,
+    so a restart resumes exactly where the last one stopped.
+    on_apply(max_lamport) is called after each applied batch. recent()
+    reads the newest rows back, so a promoted replica can restore the
+    history its failed peer had accepted but not yet stored.
+    """
+    def __init__(self, path="database/replica_log.sqlite", log_addr=LOG_ADDR,
+                 snapshot_dir=SNAPSHOT_DIR, on_apply=None, tag="REPLICA"):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.log_addr = log_addr
+        self.snapshot_dir = snapshot_dir
+        self.on_apply = on_apply
+        self.log = logs.get(tag)
+        self.conn = None
+        self.lsn = 0
+        self.head = 0
+        self.started = None
+        self.stats = {"applied": 0, "batches": 0, "snapshot_lsn": None, "bootstrap_ms": None,
+                      "caught_up_ms": None, "connects": 0}
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._bootstrap()
+        self.stats["bootstrap_ms"] = round((time.perf_counter() - self.started) * 1000, 1)
+        self.log.info("log at LSN %d after %s ms bootstrap", self.lsn, self.stats["bootstrap_ms"])
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    # ---------------- bootstrap ----------------
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(SCHEMA)
+        conn.execute("CREATE TABLE IF NOT EXISTS replica_meta(key TEXT PRIMARY KEY, value INTEGER)")
+        return conn
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM replica_meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _bootstrap(self):
+        local = None
+        if os.path.exists(self.path):
+            self.conn = self._open()
+            local = self._meta("lsn")
+        snap = latest_snapshot(self.snapshot_dir)
+        if snap and (local is None or snap[0] - local > SNAPSHOT_GAP):
+            self._adopt(*snap)
+        if self.conn is None:
+            self.conn = self._open()
+        self.lsn = self._meta("lsn") or 0
+        if self.on_apply and self._meta("max_lamport"):
+            self.on_apply(self._meta("max_lamport"))
+
+    def _adopt(self, lsn, snap):
+        # copy beside the live file, then swap it in; the snapshot itself stays untouched
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        tmp = self.path + ".snap"
+        shutil.copyfile(snap, tmp)
+        for suffix in ("-wal", "-shm"):
+            try: os.remove(self.path + suffix)
+            except FileNotFoundError: pass
+        os.replace(tmp, self.path)
+        self.conn = self._open()
+        # snapshots are made by VACUUM INTO and may lack our bookkeeping; the
+        # clock only needs the newest stamps, which are in the last rows by LSN
+        max_lamport = self.conn.execute(
+            "SELECT max(lamport) FROM (SELECT lamport FROM messages ORDER BY id DESC LIMIT 10000)").fetchone()[0] or 0
+        self.conn.executemany("INSERT OR REPLACE INTO replica_meta(key,value) VALUES(?,?)",
+                              [("lsn", lsn), ("max_lamport", max_lamport)])
+        self.stats["snapshot_lsn"] = lsn
+        self.log.info("adopted snapshot at LSN %d", lsn)
+
+    # ---------------- log tail ----------------
+
+    def _apply(self, rows):
+        lsn = rows[-1][0]
+        max_lamport = max((r[6] or 0) for r in rows)
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(f"INSERT OR IGNORE INTO messages({COLUMNS}) VALUES(?,?,?,?,?,?,?,?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO replica_meta(key,value) VALUES('lsn',?)", (lsn,))
+            self.conn.execute("""INSERT INTO replica_meta(key,value) VALUES('max_lamport',?)
+                                 ON CONFLICT(key) DO UPDATE SET value=max(value, excluded.value)""", (max_lamport,))
+            self.conn.execute("COMMIT")
+        except sqlite3.Error:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.lsn = lsn
+        self.head = max(self.head, lsn)
+        self.stats["applied"] += len(rows)
+        self.stats["batches"] += 1
+        if self.on_apply:
+            self.on_apply(max_lamport)
+
+    def _control(self, msg):
+        if "caught_up" in msg:
+            self.head = max(self.head, msg["caught_up"])
+            if self.stats["caught_up_ms"] is None:
+                self.stats["caught_up_ms"] = round((time.perf_counter() - self.started) * 1000, 1)
+                self.log.info("caught up at LSN %d (%d rows streamed, %s ms since start)",
+                              self.lsn, self.stats["applied"], self.stats["caught_up_ms"])
+        elif "head" in msg:
+            self.head = max(self.head, msg["head"])
+
+    def _run(self):
+        while True:
+            try:
+                s = socket.create_connection(self.log_addr, timeout=3)
+                s.settimeout(None)
+                s.sendall((json.dumps({"from": self.lsn}) + "\n").encode())
+                self.stats["connects"] += 1
+                buf = b""
+                while True:
+                    chunk = s.recv(256 * 1024)
+                    if not chunk:
+                        break
+                    *lines, buf = (buf + chunk).split(b"\n")
+                    rows = []
+                    for line in lines:
+                        if line.startswith(b"["):
+                            rows.append(json.loads(line))
+                        elif line:
+                            if rows:
+                                self._apply(rows)
+                                rows = []
+                            self._control(json.loads(line))
+                    if rows:
+                        self._apply(rows)       # one transaction per received chunk
+            except (OSError, ValueError, sqlite3.Error) as e:
+                self.log.warning("log stream interrupted: %s", e)
+            time.sleep(1.0)
+
+    def recent(self, limit):
+        """The newest limit rows as (sender, recipient, group, text, lamport, ts), oldest first."""
+        conn = sqlite3.connect(self.path)        # a reader of its own: the stream thread owns self.conn
+        try:
+            rows = conn.execute("SELECT sender, recipient, groupname, text, lamport, ts FROM messages "
+                                "WHERE kind IN ('private', 'group') ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        finally:
+            conn.close()
+        return rows[::-1]
+
+    def snapshot(self):
+        return dict(self.stats, lsn=self.lsn, head=self.head, lag=max(self.head - self.lsn, 0))
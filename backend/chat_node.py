@@ -0,0 +1,461 @@
+# backend/chat_node.py
+import socket, threading, json, time, os, random
+from lamport import HybridClock, ReorderBuffer, physical_ms
+from bully_election import Bully
+from replication import Replicator
+from cluster import Cluster, worker_layout
+from groups import GroupCache
+from acl import AclCache
+from history import HistoryWriter
+from inbox import Inbox
+from mux import MUX_HELLO, JsonConn, encode_body, read_handshake, serve_text_mux, serve_binary
+from wire import HELLO_V2
+import outbox
+import events
+import handoff
+import logs
+import metrics
+import tracing
+
+# The chat node shared by chat_server_primary.py and chat_server_replica.py;
+# those only say which node they are (id, ports, election peers) and add
+# their role-specific parts.
+PORT_OFFSET = int(os.environ.get("WEBTALK_PORT_OFFSET", "0"))
+# set by supervisor.py when several processes serve this node; worker 0 leads
+WORKER = int(os.environ.get("WEBTALK_WORKER", "0"))
+WORKERS = int(os.environ.get("WEBTALK_WORKERS", "1"))
+WORKER_STARTS = int(os.environ.get("WEBTALK_WORKER_STARTS", "1"))   # >1: restarted after a crash
+LEAD = WORKER == 0
+HOST = "127.0.0.1"
+BACKUP_ADDR = ("127.0.0.1", 6001 + PORT_OFFSET)  # replication sink
+LB_ELECTION_ADDR = ("127.0.0.1", 5300 + PORT_OFFSET)   # the load balancer listens for heartbeats here
+REORDER_WINDOW = float(os.environ.get("REORDER_WINDOW_MS", 20)) / 1000   # only frames from peer nodes wait
+ACL_ENFORCE = os.environ.get("WEBTALK_ACL", "1") == "1"   # 0 lets anyone message anyone (benchmarks)
+DB_DIR = "database"
+
+FRAMES_IN = metrics.counter("webtalk_frames_in_total", "Frames received from clients")
+FRAMES_OUT = metrics.counter("webtalk_frames_out_total", "Frames queued to local recipients")
+DELIVERY = metrics.histogram("webtalk_delivery_seconds", "Sender's clock stamp to the recipient's outbox")
+
+class ChatNode:
+    """
+    One chat node: client connections (direct JSON or frontend mux links),
+    delivery through the reorder buffer, the inbox for offline users,
+    replication to the backup, history, routing to peer nodes (cluster.py)
+    and leader election (bully_election.py).
+
+    Ports are given without WEBTALK_PORT_OFFSET. election_peers is
+    [(bully id, port)], peers {node id: peer port}. extras maps a stats name
+    to a snapshot function the entry point adds (served in the stats frame
+    and as webtalk_<name> metrics); promoted holds functions it wants run
+    when this node takes over as leader.
+    """
+    def __init__(self, node_id, node_num, bully_id, port, peer_port, event_port, election_port,
+                 metrics_port, election_peers, peers, tag):
+        os.makedirs(DB_DIR, exist_ok=True)
+        self.node_id = node_id
+        self.node_num = node_num
+        self.bully_id = bully_id
+        self.port = port + PORT_OFFSET
+        self.peer_port = peer_port + PORT_OFFSET
+        self.event_port = event_port + PORT_OFFSET
+        self.metrics_addr = (HOST, metrics_port + PORT_OFFSET + 10 * WORKER)   # one port per worker
+        self.log = logs.get(tag if LEAD else f"{tag}/{WORKER}")
+        self.extras = {}
+        self.promoted = []       # run (each in a thread) whenever this node becomes the leader
+
+        self.clients = {}        # username -> session (mux.py), each with its own outbound queue
+        self.open_conns = {}     # accepted socket -> username or link hello, until it closes
+        self.direct = {}         # accepted socket -> JsonConn of a direct client on it
+        # workers of one node differ in the upper node bits; so do a restarted process and
+        # its predecessor (handoff.py), which overlap while the old one drains
+        self.lamport = HybridClock(node_num | (WORKER or handoff.GENERATION % 16) << 4)
+        self.replicator = Replicator(BACKUP_ADDR, tag=f"{tag}->BACKUP")
+        self.group_cache = GroupCache()
+        self.acl = AclCache()
+        self.reorder = ReorderBuffer(self.release, REORDER_WINDOW)
+        self.history = HistoryWriter()
+        self.inbox = Inbox()
+
+        cluster_id, peer_listen, cluster_peers, siblings = worker_layout(
+            node_id, WORKER, WORKERS, (HOST, self.peer_port),
+            {nid: ("127.0.0.1", p + PORT_OFFSET) for nid, p in peers.items()})
+        self.cluster = Cluster(cluster_id, peer_listen, cluster_peers, self.clients,
+                               self.accept_forwarded, self.accept_forwarded_many,
+                               siblings=siblings, relay=LEAD and WORKERS > 1, on_event=self.on_event)
+        self.bully = Bully(bully_id, [(pid, "127.0.0.1", p + PORT_OFFSET) for pid, p in election_peers],
+                           (HOST, election_port + PORT_OFFSET), info={"node": node_id, "addr": [HOST, self.port]},
+                           observers=[LB_ELECTION_ADDR], on_leader=self.on_leader, on_down=self.on_node_down)
+        metrics.gauge("webtalk_connected_clients", "Users attached to this node", fn=lambda: len(self.clients))
+
+    # ---- delivery ----
+    def send_json(self, conn, obj):
+        # conn is any session from mux.py; it encodes for its own protocol and
+        # only queues, so a slow recipient never blocks the sender's thread
+        try:
+            conn.send(obj)
+        except Exception:
+            pass
+
+    def local_stamp(self, stamp):
+        # stamped by this node (any worker or generation): no reorder window needed
+        return (stamp & 0xF) == self.node_num
+
+    def deliver_local(self, target, frame):
+        if target not in self.clients:
+            return False
+        self.reorder.push(frame["clock"], [target], frame, direct=self.local_stamp(frame["clock"]))
+        return True
+
+    def deliver_many(self, targets, frame):
+        """Queue frame for the targets attached here; returns the others."""
+        local, missed = [], []
+        for t in targets:
+            (local if t in self.clients else missed).append(t)
+        if local:
+            self.reorder.push(frame["clock"], local, frame, direct=self.local_stamp(frame["clock"]))
+        return missed
+
+    def release(self, targets, frame):
+        # called by the reorder buffer in stamp order; encode once per protocol,
+        # write the same body to every recipient, park it for anyone who just left
+        if "trace" in frame:
+            frame = tracing.relay(frame, "reorder", self.node_id)
+        bodies = {}
+        gone = []
+        for t in targets:
+            conn = self.clients.get(t)
+            if conn is None:
+                gone.append(t)
+                continue
+            body = bodies.get(conn.proto)
+            if body is None:
+                body = bodies[conn.proto] = encode_body(conn.proto, frame)
+            try:
+                conn.send_body(body)
+            except Exception:
+                pass
+        FRAMES_OUT.inc(len(targets) - len(gone))
+        DELIVERY.observe(time.time() - physical_ms(frame["clock"]) / 1000)
+        if gone:
+            self.inbox.append(gone, frame)
+
+    def fan_out_group(self, username, group_id, frame):
+        # each member is placed once, so a presence change mid-way cannot
+        # put it in two lists or in none
+        local, remote, offline = [], [], []
+        for m in self.group_cache.members(group_id):
+            if m == username:
+                continue
+            if m in self.clients:
+                local.append(m)
+            elif self.cluster.locate(m):
+                remote.append(m)
+            else:
+                offline.append(m)
+        if local:
+            self.reorder.push(frame["clock"], local, frame, direct=True)   # release() parks it for anyone who leaves
+        unsent = self.cluster.fanout(remote, frame)
+        offline += unsent
+        self.inbox.append(offline, frame)
+        return len(local), len(remote) - len(unsent), len(offline)
+
+    def accept_forwarded(self, target, frame):
+        # a peer routed this here; if the user left in the meantime, keep it for them
+        self.lamport.update(frame.get("clock", 0))
+        if "trace" in frame:
+            frame = tracing.relay(frame, "peer", self.node_id)
+        if not self.deliver_local(target, frame):
+            self.inbox.append(target, frame)
+        return True
+
+    def accept_forwarded_many(self, targets, frame):
+        self.lamport.update(frame.get("clock", 0))
+        if "trace" in frame:
+            frame = tracing.relay(frame, "peer", self.node_id)
+        missed = self.deliver_many(targets, frame)
+        self.inbox.append(missed, frame)
+        return len(targets) - len(missed)
+
+    def flush_inbox(self, conn, username):
+        # the whole backlog goes out in one write
+        frames = self.inbox.drain(username)
+        if not frames:
+            return
+        if conn.proto == "json":
+            bodies = [f.encode() for f in frames]
+        else:
+            bodies = [encode_body(conn.proto, json.loads(f)) for f in frames]
+        try:
+            conn.send_bodies(bodies)
+        except OSError:
+            self.inbox.restore(username, frames)
+            raise
+
+    def attach(self, conn, username):
+        """Deliver the offline backlog, then make the user reachable for live traffic."""
+        self.flush_inbox(conn, username)
+        self.clients[username] = conn
+        self.cluster.announce_join(username)
+        self.flush_inbox(conn, username)   # anything stored while the first drain was in flight
+
+    def detach(self, conn, username):
+        if self.clients.get(username) is conn:
+            del self.clients[username]
+            self.cluster.announce_leave(username)
+        try: conn.close()
+        except: pass
+
+    # ---- cluster and API events ----
+    def on_event(self, ev):
+        # API change notifications: keep membership and DM permissions current
+        self.group_cache.on_event(ev)
+        self.acl.on_event(ev)
+
+    def on_api_event(self, ev):
+        # only the lead worker binds the event port; siblings hear it over the worker bus
+        self.on_event(ev)
+        self.cluster.publish(ev)
+
+    def on_leader(self, leader_id):
+        # expiring the shared inbox is leader-only work
+        self.inbox.purging = leader_id == self.bully_id
+        if leader_id == self.bully_id:
+            for fn in self.promoted:
+                threading.Thread(target=fn, daemon=True).start()
+
+    def on_node_down(self, bully_id, info):
+        # route around the dead node now; its users' messages wait in the inbox until they reconnect here
+        self.cluster.node_down(info.get("node"))
+
+    # ---- client frames ----
+    def handle_message(self, conn, username, msg):
+        """Process one client frame; conn is a session from mux.py."""
+        mtype = msg.get("type")
+        FRAMES_IN.inc()
+        ts = self.lamport.stamp()
+        ctx = msg.get("trace")
+        if ctx is not None:
+            t_in = time.time()
+            ctx = tracing.accept(ctx, "lb")     # frontend hand-off -> here: the LB and the network
+
+        if mtype == "private":
+            target = msg.get("target")
+            text = msg.get("message", "")
+            if ACL_ENFORCE:
+                # a pair the cache cannot answer is checked on the ACL thread,
+                # which sends the frame on from there
+                def then(ok):
+                    if ok:
+                        self.send_private(conn, username, target, text, ts, ctx)
+                    else:
+                        self.send_json(conn, {"ack":"denied", "target": target})
+                allowed = self.acl.dm_allowed(username, target, then)
+                if allowed is None:
+                    return
+                if not allowed:
+                    self.send_json(conn, {"ack":"denied", "target": target})
+                    return
+            ctx = self.send_private(conn, username, target, text, ts, ctx)
+
+        elif mtype == "join":
+            # optional – not used if gateway fans out groups as multiple PMs
+            group = msg.get("message", "")
+            self.send_json(conn, {"info": f"joined {group}"})
+
+        elif mtype == "group":
+            # server-side fan-out: target is the group id
+            try:
+                g = int(msg.get("target"))
+            except (TypeError, ValueError):
+                self.send_json(conn, {"ack":"bad_group"})
+                return
+            if ACL_ENFORCE and username not in self.group_cache.members(g):
+                self.send_json(conn, {"ack":"denied", "group": g})
+                return
+            text = msg.get("message","")
+            gname = msg.get("group_name") or str(g)
+            rec = {"kind":"group","group":g,"from":username,"message":text,"clock":ts,"ts":int(time.time())}
+            if ctx:
+                ctx = rec["trace"] = tracing.hop(ctx, self.node_id)
+            self.replicator.submit(rec)
+            frame = {"from": username, "group": g, "group_name": gname, "message": text, "clock": ts}
+            if ctx:
+                frame["trace"] = ctx
+            self.history.record(username, None, g, text, ts, int(time.time()))
+            local, remote, stored = self.fan_out_group(username, g, frame)
+            self.send_json(conn, {"ack":"group_sent", "delivered": local, "forwarded": remote, "stored": stored})
+
+        elif mtype == "stats":
+            stats = {"replication": self.replicator.snapshot(), "groups": self.group_cache.stats, "acl": self.acl.stats,
+                     "history": self.history.stats, "inbox": self.inbox.stats, "reorder": self.reorder.stats,
+                     "election": self.bully.snapshot(), "delivery": DELIVERY.snapshot(), "worker": self.worker_stats(),
+                     "outbox": outbox.summary(c.outbox for c in list(self.clients.values())),
+                     "connection": conn.snapshot()}
+            stats.update((name, fn()) for name, fn in self.extras.items())
+            self.send_json(conn, {"stats": stats})
+        if ctx:
+            tracing.span(ctx, "handle", t_in)
+
+    def send_private(self, conn, username, target, text, ts, ctx):
+        rec = {"kind":"private","from":username,"to":target,"message":text,"clock":ts,"ts":int(time.time())}
+        if ctx:
+            ctx = rec["trace"] = tracing.hop(ctx, self.node_id)
+        self.replicator.submit(rec)
+        self.history.record(username, target, None, text, ts, int(time.time()))
+        # deliver locally, or in one hop to the node holding the target
+        frame = {"from": username, "message": text, "clock": ts}
+        if ctx:
+            frame["trace"] = ctx
+        if self.deliver_local(target, frame):
+            self.send_json(conn, {"ack":"delivered"})
+        elif self.cluster.forward(target, frame):
+            self.send_json(conn, {"ack":"forwarded", "node": self.cluster.locate(target)})
+        else:
+            self.inbox.append(target, frame)
+            self.send_json(conn, {"ack":"offline", "stored": True})
+        return ctx
+
+    def worker_stats(self):
+        return {"index": WORKER, "workers": WORKERS, "starts": WORKER_STARTS}
+
+    # ---- connections ----
+    def handle_client(self, sock, username, buf=b""):
+        conn = JsonConn(sock, name=username)
+        self.direct[sock] = conn
+        self.log.debug("%s connected", username)
+        try:
+            self.attach(conn, username)
+            while True:
+                # process complete lines (newline-delimited JSON)
+                *lines, buf = buf.split(b"\n")
+                for line in lines:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        msg = json.loads(line)
+                    except Exception:
+                        continue
+                    self.handle_message(conn, username, msg)
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                buf += chunk
+        except Exception as e:
+            self.log.warning("%s: %s", username, e)
+        finally:
+            self.direct.pop(sock, None)
+            self.detach(conn, username)
+            self.log.debug("%s disconnected", username)
+
+    def handle_conn(self, conn):
+        # first line = username, or the mux hello from a frontend worker
+        try:
+            username, rest = read_handshake(conn)
+        except OSError:
+            username = ""
+        if not username:
+            try: conn.close()
+            except: pass
+            return
+        self.open_conns[conn] = username
+        try:
+            if username in (MUX_HELLO, HELLO_V2):
+                serve = serve_text_mux if username == MUX_HELLO else serve_binary
+                self.log.info("frontend link opened (%s)", username)
+                try:
+                    n = serve(conn, rest, self.attach, self.detach, self.handle_message)
+                    self.log.info("frontend link closed (%d session(s))", n)
+                except (OSError, ValueError) as e:
+                    self.log.warning("frontend link error: %s", e)
+            else:
+                self.handle_client(conn, username, rest)
+        finally:
+            self.open_conns.pop(conn, None)
+
+    # ---- restarts (handoff.py) ----
+    def drain(self):
+        """
+        Runs once a successor holds our ports (handoff.py). Each connection is
+        closed at a random point within DRAIN_S, so clients come back (to the
+        successor) spread out instead of in one spike; direct clients are told
+        when. Frontend links reconnect and reopen their sessions on their own.
+        """
+        plan = sorted(((random.uniform(0, handoff.DRAIN_S), s) for s in list(self.open_conns)), key=lambda p: p[0])
+        for delay, s in plan:
+            # by socket, not username: a user with two connections gets a notice on each
+            conn = self.direct.get(s)
+            if conn is not None:
+                self.send_json(conn, {"migrate": {"after_ms": int(delay * 1000)}})
+        self.log.info("draining %d connection(s) over %.0fs", len(plan), handoff.DRAIN_S)
+        t0 = time.monotonic()
+        for delay, s in plan:
+            time.sleep(max(0.0, t0 + delay - time.monotonic()))
+            try:
+                s.shutdown(socket.SHUT_RD)    # the reader sees EOF, detaches, and the outbox flushes and closes
+            except OSError:
+                pass
+        # let the last frames reach the outboxes, the backup and the history file
+        deadline = time.monotonic() + 5
+        while (self.open_conns or self.replicator.depth() or self.history.q.qsize()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)
+        self.log.info("drained (%d connection(s) left), exiting", len(self.open_conns))
+
+    def on_predecessor_exit(self):
+        # frames the old process parked for users who had already moved here
+        for username, conn in list(self.clients.items()):
+            try:
+                self.flush_inbox(conn, username)
+            except OSError:
+                pass
+        self.cluster.resync()
+
+    # ---- main ----
+    def serve(self, lead_start=()):
+        """Start everything and accept clients until a successor takes over. lead_start: extra
+        node-wide services (started by the lead worker only)."""
+        handoff.adopt()          # started by a draining predecessor: take its sockets
+        if LEAD:
+            for fn in lead_start:
+                fn()
+            self.bully.start()
+        else:
+            self.inbox.purging = False   # node-wide duties (election, expiry, API events) stay with worker 0
+        self.replicator.start()
+        self.cluster.start()
+        self.history.start()
+        self.reorder.start()
+        self.inbox.start()
+        if ACL_ENFORCE:
+            self.acl.load().start()
+            self.group_cache.preload()
+        if LEAD:
+            events.listen((HOST, self.event_port), self.on_api_event)
+        for prefix, fn in (("webtalk_replication", self.replicator.snapshot), ("webtalk_reorder", lambda: self.reorder.stats),
+                           ("webtalk_history", lambda: self.history.stats), ("webtalk_inbox", lambda: self.inbox.stats),
+                           ("webtalk_acl", lambda: self.acl.stats), ("webtalk_groups", lambda: self.group_cache.stats),
+                           ("webtalk_election", self.bully.snapshot),
+                           ("webtalk_outbox", lambda: outbox.summary(c.outbox for c in list(self.clients.values())))):
+            metrics.expose(prefix, fn)
+        metrics.expose("webtalk_worker", self.worker_stats)
+        for name, fn in self.extras.items():
+            metrics.expose("webtalk_" + name, fn)
+        metrics.serve(self.metrics_addr)
+
+        # with WORKERS > 1 the kernel spreads accepts over the workers' sockets
+        s = handoff.bind((HOST, self.port), backlog=128, reuse_port=WORKERS > 1)
+        if WORKERS == 1:
+            # SIGUSR2: restart without closing the port; supervisor.py restarts workers instead
+            handoff.install(self.drain, prepare=lambda: self.cluster.hand_over((HOST, self.peer_port)))
+            handoff.on_predecessor_exit(self.on_predecessor_exit)
+        self.log.info("listening on %s:%d, metrics on :%d%s", HOST, self.port, self.metrics_addr[1],
+                      f" (worker {WORKER} of {WORKERS}, pid {os.getpid()})" if WORKERS > 1 else "")
+
+        while True:
+            got = handoff.accept(s)
+            if got is None:
+                break
+            threading.Thread(target=self.handle_conn, args=(got[0],), daemon=True).start()
+        handoff.done.wait()
@@ -1,78 +1,31 @@
 # backend/chat_server_replica.py
-import socket, threading, json
-from lamport import LamportClock
-
-HOST = "127.0.0.1"
-PORT = 6002
-
-clients = {}
-lamport = LamportClock()
-
-def send_json(sock, obj):
-    try:
-        sock.sendall((json.dumps(obj) + "\n").encode())
-    except Exception:
-        pass
-
-def handle_client(conn, username):
-    print(f"[REPLICA] {username} connected")
-    buf = ""
+import os, time
+from catchup import ReplicaLog
+from chat_node import ChatNode
+
+BACKFILL_ROWS = int(os.environ.get("REPLICA_BACKFILL_ROWS", "100000"))   # >= a node's history queue
+
+node = ChatNode("replica", node_num=2, bully_id=1,
+                port=6002, peer_port=6102, event_port=6202, election_port=6302, metrics_port=9002,
+                election_peers=[(2, 6300)], peers={"primary": 6100}, tag="REPLICA")
+# local copy of the backup log (snapshot + tail), so a promoted replica has full
+# history; applying it keeps our clock ahead of everything already written
+replica_log = ReplicaLog(on_apply=node.lamport.update, tag="REPLICA")
+node.extras["catchup"] = replica_log.snapshot
+
+def backfill():
+    # the failed leader's history writer dies with its queue; those messages reached
+    # the backup, so write the ones the API database lacks from our copy of the log
+    deadline = time.monotonic() + 5
+    while replica_log.snapshot()["lag"] and time.monotonic() < deadline:
+        time.sleep(0.1)
     try:
-        while True:
-            chunk = conn.recv(4096)
-            if not chunk:
-                break
-            buf += chunk.decode(errors="ignore")
-            while "\n" in buf:
-                line, buf = buf.split("\n", 1)
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    msg = json.loads(line)
-                except Exception:
-                    continue
-
-                lamport.tick()
-                ts = lamport.now()
-                t = msg.get("type")
-
-                if t == "private":
-                    target, text = msg.get("target"), msg.get("message","")
-                    if target in clients:
-                        send_json(clients[target], {"from":username,"message":text,"clock":ts})
-                        send_json(conn, {"ack":"delivered"})
-                    else:
-                        send_json(conn, {"ack":"offline"})
-
-                elif t == "join":
-                    g = msg.get("message","")
-                    send_json(conn, {"info": f"joined {g}"})
-
-                elif t == "group":
-                    # mirror primary behaviour if needed later
-                    send_json(conn, {"ack":"group_sent"})
-    finally:
-        if username in clients:
-            del clients[username]
-        try: conn.close()
-        except: pass
+        rows = [r for r in replica_log.recent(BACKFILL_ROWS) if not node.local_stamp(r[4] or 0)]
+        node.log.info("restored %d history row(s) from the replica log", node.history.backfill(rows))
+    except Exception as e:
+        node.log.error("history backfill failed: %s", e)
 
-def serve_replica():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((HOST, PORT))
-    s.listen(128)
-    print(f"[REPLICA] listening on {HOST}:{PORT}")
-    while True:
-        conn, _ = s.accept()
-        username = conn.recv(1024).decode(errors="ignore").strip()
-        if not username:
-            try: conn.close()
-            except: pass
-            continue
-        clients[username] = conn
-        threading.Thread(target=handle_client, args=(conn, username), daemon=True).start()
+node.promoted.append(backfill)
 
 if __name__ == "__main__":
-    serve_replica()
+    node.serve(lead_start=[replica_log.start])   # one local log copy per node
@@ -0,0 +1,366 @@
+# backend/cluster.py
+import os, socket, threading, json, time, queue
+import handoff
+import logs
+
+log = logs.get("CLUSTER")
+RUN_DIR = "run"              # unix sockets of the worker bus (supervisor.py), next to database/
+BOOT = os.urandom(4).hex()   # this process; a hello with a new boot means the peer restarted
+
+def _dial(addr):
+    # a str is a unix socket path (sibling worker), a tuple a TCP address (peer node)
+    if isinstance(addr, str):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(2)
+        try:
+            s.connect(addr)
+        except OSError:
+            s.close()
+            raise
+        return s
+    s = socket.create_connection(addr, timeout=2)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return s
+
+def _listen(addr):
+    if not isinstance(addr, str):
+        return handoff.bind(addr, backlog=16)
+    os.makedirs(os.path.dirname(addr) or ".", exist_ok=True)
+    try:
+        os.unlink(addr)              # left behind by a crashed worker
+    except FileNotFoundError:
+        pass
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(addr)
+    s.listen(16)
+    return s
+
+def worker_layout(node_id, worker, workers, peer_addr, peers):
+    """
+    Cluster identity for worker `worker` of the `workers` processes serving
+    one node: (node id, listen addresses, peers, siblings). Every worker links
+    to every sibling over a unix socket. Worker 0 keeps the node's id, peer
+    port and remote peers, so other nodes see one node as before, and relays
+    presence and frames between its siblings and the remote nodes.
+    """
+    if workers <= 1:
+        return node_id, [peer_addr], dict(peers), set()
+    ids = [node_id] + [f"{node_id}.{k}" for k in range(1, workers)]
+    bus = {nid: os.path.join(RUN_DIR, nid + ".sock") for nid in ids}
+    me = ids[worker]
+    siblings = {nid: addr for nid, addr in bus.items() if nid != me}
+    if worker == 0:
+        return me, [peer_addr, bus[me]], dict(peers, **siblings), set(siblings)
+    return me, [bus[me]], siblings, set(siblings)
+
+class PeerLink:
+    """
+    Outbound link to one peer node. Frames are queued by handler threads and
+    written by a dedicated thread, so a slow peer never blocks local chatting.
+    """
+    def __init__(self, cluster, node_id, addr, max_queue=50000, hello=True):
+        self.cluster = cluster
+        self.node_id = node_id
+        self.addr = addr
+        self.hello = hello
+        self.q = queue.Queue(maxsize=max_queue)
+        self.sock = None
+        self.stale = False
+        self.stats = {"forwarded": 0, "dropped": 0, "connects": 0}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def send(self, obj):
+        try:
+            self.q.put_nowait(obj)
+            return True
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+
+    def reset(self):
+        """The peer restarted (handoff.py): reconnect, reaching the new process, and say hello again."""
+        self.stale = True
+        self.send({"op": "sync"})
+
+    def _connect(self):
+        while True:
+            try:
+                s = _dial(self.addr)
+                s.settimeout(None)
+                # first frame on every (re)connect is our full presence snapshot
+                if self.hello:
+                    hello = {"op": "hello", "node": self.cluster.node_id, "boot": BOOT,
+                             "users": self.cluster.advertised(self.node_id)}
+                    s.sendall((json.dumps(hello) + "\n").encode())
+                self.sock = s
+                self.stats["connects"] += 1
+                log.info("link to %s up", self.node_id)
+                return s
+            except OSError:
+                time.sleep(0.5)
+
+    def _run(self):
+        while True:
+            frames = [self.q.get()]
+            while True:
+                try: frames.append(self.q.get_nowait())
+                except queue.Empty: break
+            payload = "".join(json.dumps(f) + "\n" for f in frames).encode()
+            if self.stale:
+                self.stale = False
+                if self.sock is not None:
+                    try: self.sock.close()
+                    except: pass
+                    self.sock = None
+            s = self.sock or self._connect()
+            try:
+                s.sendall(payload)
+                self.stats["forwarded"] += len(frames)
+            except OSError:
+                # the peer re-learns our presence from the hello on reconnect; in-flight
+                # forwards are lost like any message to a crashed node
+                log.warning("link to %s lost", self.node_id)
+                try: s.close()
+                except: pass
+                self.sock = None
+                self.stats["dropped"] += len(frames)
+
+class Cluster:
+    """
+    Inter-node routing for chat servers.
+    Keeps a presence directory (username -> node id) for users held by peer
+    nodes, announces local joins/leaves to every peer, and forwards frames in
+    one hop to whichever node holds the recipient.
+
+    deliver_local(username, frame) is called for frames forwarded to us and
+    must return True if the user is connected here; deliver_many(usernames,
+    frame) does the same for a group fan-out.
+
+    Workers of one node (supervisor.py) are peers of each other on unix
+    sockets; siblings names them. With relay=True (the node's first worker)
+    presence learned on one side of the node boundary is re-announced as our
+    own on the other side, and frames for users held across it are passed
+    on. on_event(ev) receives API events the first worker publish()es.
+
+    While frozen (a draining process, handoff.py) local leaves and lost peers
+    are not announced or dropped: the successor owns the presence by then,
+    and hand_over() sends it the frames for users we cannot place, i.e. those
+    who already moved to it.
+    """
+    def __init__(self, node_id, listen_addr, peers, clients, deliver_local, deliver_many=None,
+                 siblings=(), relay=False, on_event=None):
+        self.node_id = node_id
+        self.listen_addrs = listen_addr if isinstance(listen_addr, list) else [listen_addr]
+        self.clients = clients                      # the server's local username -> conn map
+        self.deliver_local = deliver_local
+        self.deliver_many = deliver_many or (lambda users, frame: sum(deliver_local(u, frame) for u in users))
+        self.presence = {}                          # username -> peer node id
+        self.lock = threading.Lock()
+        self.links = {nid: PeerLink(self, nid, addr) for nid, addr in peers.items()}
+        self.siblings = set(siblings)
+        self.relay = relay
+        self.on_event = on_event
+        self.conns = {}                             # peer node id -> its latest inbound connection
+        self.boots = {}                             # peer node id -> boot of its latest hello
+        self.frozen = False
+        self.successor = None                       # PeerLink to the process that took our port
+
+    def start(self):
+        for addr in self.listen_addrs:
+            threading.Thread(target=self._serve, args=(addr,), daemon=True).start()
+        for link in self.links.values():
+            link.start()
+        return self
+
+    def local_users(self):
+        return list(self.clients.keys())
+
+    def advertised(self, node):
+        """Users to claim in our hello to node: ours, plus what we relay to its side."""
+        users = self.local_users()
+        if self.relay:
+            side = node in self.siblings
+            with self.lock:
+                users += [u for u, n in self.presence.items() if (n in self.siblings) != side]
+        return users
+
+    def publish(self, ev):
+        """Pass an API event on to every sibling worker."""
+        for nid in self.siblings:
+            self.links[nid].send({"op": "event", "event": ev})
+
+    # ---- local presence changes ----
+    def announce_join(self, username):
+        for link in self.links.values():
+            link.send({"op": "join", "node": self.node_id, "user": username})
+
+    def announce_leave(self, username):
+        if self.frozen:
+            return
+        for link in self.links.values():
+            link.send({"op": "leave", "node": self.node_id, "user": username})
+
+    # ---- routing ----
+    def locate(self, username):
+        node = self.presence.get(username)
+        if node is None and self.successor is not None:
+            return self.node_id
+        return node
+
+    def _route(self, username):
+        node = self.presence.get(username)
+        if node is None:
+            return self.successor
+        return self.links.get(node)
+
+    def forward(self, username, frame):
+        """Send frame to the node holding username. False if nobody holds it."""
+        link = self._route(username)
+        if link is None:
+            return False
+        return link.send({"op": "fwd", "to": username, "frame": frame})
+
+    def fanout(self, usernames, frame):
+        """Forward one copy of frame per peer node holding any of usernames.
+        Returns the recipients that could not be handed to a peer (no route,
+        or its link's queue is full); the caller keeps the frame for them."""
+        by_link, unsent = {}, []
+        for u in usernames:
+            link = self._route(u)
+            if link is not None:
+                by_link.setdefault(link, []).append(u)
+            else:
+                unsent.append(u)
+        for link, users in by_link.items():
+            if not link.send({"op": "fanout", "to": users, "frame": frame}):
+                unsent += users
+        return unsent
+
+    def hand_over(self, addr):
+        """Draining: send frames for users we hold no route to to our successor on addr."""
+        self.frozen = True
+        self.successor = PeerLink(self, self.node_id, addr, hello=False)
+        self.successor.start()
+
+    # ---- relaying across the node boundary (first worker only) ----
+    def _relay(self, src, msg):
+        side = src in self.siblings
+        out = dict(msg, node=self.node_id)
+        for nid, link in self.links.items():
+            if (nid in self.siblings) != side:
+                link.send(out)
+
+    def _onward(self, src, username):
+        """The link to pass a frame for username on to, when we relay and it is held elsewhere."""
+        if not self.relay or username in self.clients:
+            return None
+        node = self.presence.get(username)
+        return self.links.get(node) if node != src else None
+
+    # ---- inbound peer links ----
+    def resync(self):
+        """Send every peer a fresh hello, e.g. once a predecessor's leftover presence is gone."""
+        for link in self.links.values():
+            link.reset()
+
+    def _serve(self, addr):
+        s = _listen(addr)
+        if isinstance(addr, str):
+            log.info("%s worker bus on %s", self.node_id, addr)
+            accept = s.accept
+        else:
+            log.info("%s peer port on %s:%d", self.node_id, *addr)
+            accept = lambda: handoff.accept(s)
+        while True:
+            got = accept()
+            if got is None:
+                return               # the port went to our successor
+            c, _ = got
+            threading.Thread(target=self._handle_peer, args=(c,), daemon=True).start()
+
+    def _drop_node(self, node):
+        if self.frozen:
+            return
+        with self.lock:
+            gone = [u for u, n in self.presence.items() if n == node]
+            for u in gone:
+                del self.presence[u]
+        if self.relay:
+            for u in gone:
+                self._relay(node, {"op": "leave", "user": u})
+
+    def node_down(self, node):
+        """Failure detector says node is gone: stop routing to it without waiting for TCP."""
+        self._drop_node(node)
+        log.warning("%s presumed down, routes dropped", node)
+
+    def _handle_peer(self, conn):
+        node = None
+        buf = b""
+        try:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                buf += chunk
+                *lines, buf = buf.split(b"\n")
+                for line in lines:
+                    if not line:
+                        continue
+                    msg = json.loads(line)
+                    op = msg.get("op")
+                    if op == "fwd":
+                        link = self._onward(node, msg["to"])
+                        if link is not None:
+                            link.send(msg)
+                        else:
+                            self.deliver_local(msg["to"], msg["frame"])
+                    elif op == "fanout":
+                        users = msg["to"]
+                        if self.relay:
+                            onward = [u for u in users if self._onward(node, u) is not None]
+                            if onward:
+                                unsent = self.fanout(onward, msg["frame"])
+                                onward = set(onward) - set(unsent)
+                                users = [u for u in users if u not in onward]   # deliver_many stores the unsent
+                        self.deliver_many(users, msg["frame"])
+                    elif op == "join":
+                        self.presence[msg["user"]] = msg["node"]
+                        if self.relay:
+                            self._relay(node, msg)
+                    elif op == "leave":
+                        with self.lock:
+                            left = self.presence.get(msg["user"]) == msg["node"]
+                            if left:
+                                del self.presence[msg["user"]]
+                        if left and self.relay:
+                            self._relay(node, msg)
+                    elif op == "event":
+                        if self.on_event:
+                            self.on_event(msg["event"])
+                    elif op == "hello":
+                        node = msg["node"]
+                        self.conns[node] = conn
+                        boot, self.boots[node] = self.boots.get(node), msg.get("boot")
+                        if boot and boot != msg.get("boot") and node in self.links:
+                            self.links[node].reset()    # our link still talks to its predecessor
+                        self._drop_node(node)
+                        with self.lock:
+                            for u in msg["users"]:
+                                self.presence[u] = node
+                        if self.relay:
+                            for u in msg["users"]:
+                                self._relay(node, {"op": "join", "user": u})
+                        log.info("%s joined with %d user(s)", node, len(msg["users"]))
+        except (OSError, ValueError) as e:
+            log.warning("peer link error: %s", e)
+        finally:
+            if node and self.conns.get(node) is conn:
+                # a newer connection (a reconnect or a restarted peer) supersedes this one
+                del self.conns[node]
+                self._drop_node(node)
+                log.info("%s left", node)
+            try: conn.close()
+            except: pass
@@ -14,16 +14,19 @@ locks = {}
 
 def start_reader(username, sock):
     def reader():
+        buf = b""
         while True:
             try:
                 data = sock.recv(4096)
                 if not data: break
-                # server sends json or plain text; try json
-                try:
-                    msg = json.loads(data.decode())
-                    socketio.emit("message", msg, to=username)
-                except:
-                    socketio.emit("system", {"text": data.decode()}, to=username)
+                # server sends newline-delimited json or plain text; try json
+                *lines, buf = (buf + data).split(b"\n")
+                for line in lines:
+                    try:
+                        msg = json.loads(line.decode())
+                        socketio.emit("message", msg, to=username)
+                    except:
+                        socketio.emit("system", {"text": line.decode(errors="ignore")}, to=username)
             except:
                 break
         socketio.emit("system", {"text": "Disconnected from server."}, to=username)
@@ -49,7 +52,7 @@ def on_register(data):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.connect(LB_ADDR)
-    s.sendall(username.encode())  # first line = username
+    s.sendall(username.encode() + b"\n")  # first line = username
     tcp_conns[username] = s
     locks[username] = threading.Lock()
     start_reader(username, s)
@@ -61,7 +64,7 @@ def send_private(data):
     data = {from: "...", to: "...", text: "..."}
     """
     try:
-        payload = json.dumps({"type":"private","target":data["to"],"message":data["text"]}).encode()
+        payload = json.dumps({"type":"private","target":data["to"],"message":data["text"]}).encode() + b"\n"
         with locks[data["from"]]:
             tcp_conns[data["from"]].sendall(payload)
     except Exception as e:
@@ -73,7 +76,7 @@ def join_group(data):
     data = {user: "...", group: "groupname"}
     """
     try:
-        payload = json.dumps({"type":"join","message":data["group"]}).encode()
+        payload = json.dumps({"type":"join","message":data["group"]}).encode() + b"\n"
         with locks[data["user"]]:
             tcp_conns[data["user"]].sendall(payload)
     except Exception as e:
@@ -82,10 +85,19 @@ def join_group(data):
 @socketio.on("send_group")
 def send_group(data):
     """
-    data = {from: "...", group: "groupname", text: "..."}
+    data = {from: "...", group_id: 7, group_name: "...", text: "..."}
+    Chat servers fan out by group id (like frontend/app.py); a bare numeric
+    "group" is taken as the id, a group name alone is refused.
     """
+    gid = data.get("group_id", data.get("group"))
     try:
-        payload = json.dumps({"type":"group","target":data["group"],"message":data["text"]}).encode()
+        gid = int(gid)
+    except (TypeError, ValueError):
+        emit("system", {"text": "Send failed: group_id required"}, to=data.get("from"))
+        return
+    try:
+        payload = json.dumps({"type":"group","target":gid,"group_name":data.get("group_name", ""),
+                              "message":data["text"]}).encode() + b"\n"
         with locks[data["from"]]:
             tcp_conns[data["from"]].sendall(payload)
     except Exception as e:
@@ -0,0 +1,75 @@
+# backend/groups.py
+import os, sys, threading, time
+from collections import OrderedDict
+
+# chat servers share the API's data layer for group membership
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api")
+if API_DIR not in sys.path:
+    sys.path.insert(0, API_DIR)
+from models import list_group_members, list_all_group_members
+
+class GroupCache:
+    """
+    In-memory group membership cache for server-side fan-out.
+    Entries load lazily from models.list_group_members and are dropped on
+    'group_changed' events from the API; the TTL is only a safety net for
+    lost notifications. Group ids come from clients, so at most max_groups
+    entries are kept, oldest load first out.
+    """
+    def __init__(self, loader=list_group_members, ttl=60.0, max_groups=100000):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_groups = max_groups
+        self.entries = OrderedDict()   # group_id -> (frozenset(members), loaded_at), oldest first
+        self.epoch = 0           # bumped by every invalidation
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evicted": 0}
+
+    def _put(self, group_id, members, now):
+        # called with the lock held
+        self.entries.pop(group_id, None)
+        self.entries[group_id] = (members, now)
+        while len(self.entries) > self.max_groups:
+            self.entries.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def members(self, group_id):
+        e = self.entries.get(group_id)
+        if e and time.time() - e[1] < self.ttl:
+            self.stats["hits"] += 1
+            return e[0]
+        self.stats["misses"] += 1
+        epoch = self.epoch
+        members = frozenset(self.loader(group_id))
+        with self.lock:
+            # don't cache a result that an invalidation raced past
+            if self.epoch == epoch:
+                self._put(group_id, members, time.time())
+        return members
+
+    def preload(self, loader=list_all_group_members):
+        """Load every group's membership with one query (at startup)."""
+        epoch = self.epoch
+        groups = {}
+        for gid, user in loader():
+            groups.setdefault(gid, set()).add(user)
+        now = time.time()
+        with self.lock:
+            if self.epoch == epoch:
+                for gid, users in groups.items():
+                    self._put(gid, frozenset(users), now)
+        return self
+
+    def invalidate(self, group_id=None):
+        with self.lock:
+            self.stats["invalidations"] += 1
+            self.epoch += 1
+            if group_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(group_id, None)
+
+    def on_event(self, ev):
+        if ev.get("event") == "group_changed":
+            gid = ev.get("group_id")
+            self.invalidate(int(gid) if gid is not None else None)
@@ -0,0 +1,146 @@
+# backend/handoff.py
+import json, os, select, signal, socket, subprocess, sys, threading, time
+import logs
+
+# Zero-downtime restarts. On SIGUSR2 a process starts a copy of itself and
+# passes it every socket it listens on (SCM_RIGHTS over a unix socket), so
+# the ports never close and nobody gets connection refused; then it drains:
+# its clients are moved over a jittered window and it exits when empty.
+#
+#   old: SIGUSR2 -> start successor -> successor connects -> pause accepting
+#        -> send sockets -> drain(): close clients over DRAIN_S -> exit
+#   new: adopt() the sockets instead of binding -> serve; the handoff link
+#        reaching EOF means the old process is gone
+#
+# Sockets must come from bind(); blocking accept loops use accept() and UDP
+# loops stop once handed_off is set.
+log = logs.get("HANDOFF")
+ENV = "WEBTALK_HANDOFF"
+DRAIN_S = float(os.environ.get("WEBTALK_DRAIN_S", "10"))   # window the clients' reconnects are spread over
+POLL = 0.2                   # how often paused loops look at the flags
+CONNECT_TIMEOUT = 30.0       # for the successor to start and ask for the sockets
+GENERATION = int(os.environ.get("WEBTALK_GENERATION", "0"))   # restarts so far; tells overlapping processes apart
+
+draining = threading.Event()     # stop accepting: the successor is about to take over
+handed_off = threading.Event()   # the successor has the sockets: leave them alone
+done = threading.Event()         # drained; the main thread may return
+_sockets = {}                    # key -> socket we listen on
+_inherited = {}                  # key -> socket received from our predecessor
+_stoppers = []                   # called when draining starts (e.g. HTTP servers' shutdown)
+_link = None                     # unix socket to our predecessor while it runs
+
+def _key(addr, kind):
+    return "%s:%s:%d" % ("udp" if kind == socket.SOCK_DGRAM else "tcp", addr[0], addr[1])
+
+def adopt():
+    """Take over the sockets of the process that started us, if one did. Call before bind()."""
+    global _link
+    path = os.environ.pop(ENV, None)
+    if not path or _link is not None:
+        return False
+    c = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    c.connect(path)
+    msg, fds, _, _ = socket.recv_fds(c, 65536, 64)
+    for key, fd in zip(json.loads(msg), fds):
+        _inherited[key] = socket.socket(fileno=fd)
+    _link = c
+    log.info("took over %d socket(s) from pid %d", len(fds), os.getppid())
+    return True
+
+def bind(addr, kind=socket.SOCK_STREAM, backlog=128, reuse_addr=None, reuse_port=False):
+    """A bound (and, for TCP, listening) socket on addr; the predecessor's if it handed one over."""
+    key = _key(addr, kind)
+    s = _inherited.pop(key, None)
+    if s is None:
+        s = socket.socket(socket.AF_INET, kind)
+        if reuse_addr or (reuse_addr is None and kind == socket.SOCK_STREAM):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(addr)
+        if kind == socket.SOCK_STREAM:
+            s.listen(backlog)
+    _sockets[key] = s
+    return s
+
+def accept(s):
+    """s.accept(), or None once s belongs to the successor. Waits while a handoff is in progress."""
+    while not handed_off.is_set():
+        if draining.is_set():
+            time.sleep(POLL)
+            continue
+        if not select.select([s], [], [], POLL)[0] or draining.is_set():
+            continue
+        try:
+            return s.accept()
+        except (BlockingIOError, InterruptedError):
+            continue         # the listener is non-blocking in this process
+    return None
+
+def on_draining(fn):
+    _stoppers.append(fn)
+
+def on_predecessor_exit(fn):
+    """Call fn() once the process we took over from has exited."""
+    if _link is None:
+        return
+    def wait():
+        try:
+            while _link.recv(64):
+                pass
+        except OSError:
+            pass
+        log.info("predecessor exited")
+        fn()
+    threading.Thread(target=wait, daemon=True).start()
+
+def install(drain=None, prepare=None, sig=signal.SIGUSR2):
+    """
+    On sig: start a successor, hand it our sockets, then run drain() (move
+    the clients off and return when they are gone) and set done.
+    prepare() runs just before the sockets go over.
+    """
+    def handler(signum, frame):
+        if not draining.is_set():
+            threading.Thread(target=_restart, args=(drain, prepare), daemon=True).start()
+    signal.signal(sig, handler)
+
+def _restart(drain, prepare):
+    os.makedirs("run", exist_ok=True)
+    path = os.path.join("run", "handoff-%d.sock" % os.getpid())
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(path)
+    srv.listen(1)
+    srv.settimeout(CONNECT_TIMEOUT)
+    proc = subprocess.Popen([sys.executable] + sys.argv, env=dict(os.environ, WEBTALK_GENERATION=str(GENERATION + 1), **{ENV: path}))
+    log.info("restarting: successor pid %d", proc.pid)
+    try:
+        c, _ = srv.accept()
+    except OSError as e:
+        log.error("successor never asked for the sockets (%s); staying up", e)
+        proc.kill()
+        return
+    finally:
+        srv.close()
+        os.unlink(path)
+
+    draining.set()
+    for fn in _stoppers:
+        fn()
+    time.sleep(2 * POLL)             # paused loops are out of accept()
+    if prepare:
+        prepare()
+    keys = list(_sockets)
+    socket.send_fds(c, [json.dumps(keys).encode()], [_sockets[k].fileno() for k in keys])
+    handed_off.set()
+    log.info("handed %d socket(s) to pid %d, draining over %.0fs", len(keys), proc.pid, DRAIN_S)
+    try:
+        if drain:
+            drain()
+    finally:
+        done.set()
+        # c stays open until we exit: the successor reads EOF from it then
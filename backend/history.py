@@ -0,0 +1,77 @@
+# backend/history.py
+import os, sys, threading, time, queue
+import logs
+import metrics
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api")
+if API_DIR not in sys.path:
+    sys.path.insert(0, API_DIR)
+from models import init_db, insert_messages, missing_messages
+
+COMMIT = metrics.histogram("webtalk_history_commit_seconds", "One batch insert into the API database")
+
+class HistoryWriter:
+    """
+    Persists chat messages into the API's messages table so /history can
+    serve them. Messages are recorded once, on the node that accepted them,
+    and written by a background thread in executemany batches.
+    """
+    def __init__(self, max_queue=100000, batch_size=1000, batch_interval=0.05, tag="HISTORY"):
+        self.q = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.log = logs.get(tag)
+        self.stats = {"recorded": 0, "written": 0, "dropped": 0, "batches": 0, "backfilled": 0}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def record(self, sender, recipient, group_id, text, lamport, ts):
+        try:
+            self.q.put_nowait((sender, recipient, group_id, text, lamport, ts))
+            self.stats["recorded"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def backfill(self, rows):
+        """Record those of rows (record()'s arguments) that the messages table lacks; returns how many."""
+        missing = missing_messages(rows)
+        for row in missing:
+            self.record(*row)
+        self.stats["backfilled"] += len(missing)
+        return len(missing)
+
+    def _schema(self):
+        # the API may still be starting: create/migrate the tables ourselves so
+        # no batch is written before migration 2 (peer_key) exists
+        delay = 0.1
+        while True:
+            try:
+                init_db()
+                return
+            except Exception as e:
+                self.log.error("schema setup failed, retrying in %.1fs: %s", delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+    def _run(self):
+        self._schema()              # records queue up meanwhile
+        while True:
+            batch = [self.q.get()]
+            deadline = time.time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                try:
+                    batch.append(self.q.get(timeout=remaining) if remaining > 0 else self.q.get_nowait())
+                except queue.Empty:
+                    break
+            t0 = time.perf_counter()
+            try:
+                insert_messages(batch)
+                COMMIT.since(t0)
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+            except Exception as e:
+                self.stats["dropped"] += len(batch)
+                self.log.error("write failed: %s", e)
@@ -0,0 +1,115 @@
+# backend/inbox.py
+import sqlite3, threading, itertools, json, time, os
+import logs
+
+log = logs.get("INBOX")
+
+class Inbox:
+    """
+    Durable store-and-forward inbox for users who are offline.
+    Rows are clustered by (recipient, lamport, seq) in a WITHOUT ROWID table,
+    so draining one user's backlog is a single sequential range read. Each
+    inbox is capped (oldest messages are dropped first) and entries expire
+    after ttl seconds. The file is shared by every chat node on the box.
+    """
+    def __init__(self, path="database/inbox.sqlite", cap=1000, ttl=7 * 86400, purge_interval=60):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.cap = cap
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS inbox(
+            recipient TEXT NOT NULL,
+            lamport INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            expires INTEGER NOT NULL,
+            frame TEXT NOT NULL,
+            PRIMARY KEY(recipient, lamport, seq)
+        ) WITHOUT ROWID""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_inbox_expires ON inbox(expires)")
+        self.lock = threading.Lock()
+        # tie-break for equal clocks; the pid in the high bits keeps the processes
+        # sharing the file apart, so INSERT OR IGNORE never drops a distinct frame
+        self.seq = itertools.count(os.getpid() << 32)
+        self.counts = {}          # recipient -> rows appended since the last trim check
+        self.purging = True       # only one node (the elected leader) needs to expire rows
+        self.stats = {"stored": 0, "drained": 0, "trimmed": 0, "expired": 0}
+
+    def start(self):
+        threading.Thread(target=self._purge_loop, daemon=True).start()
+        return self
+
+    def append(self, recipients, frame):
+        """Store one frame for each recipient in a single transaction."""
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        if not recipients:
+            return
+        data = json.dumps(frame)
+        expires = int(time.time()) + self.ttl
+        clock = int(frame.get("clock", 0))
+        with self.lock:
+            seq = next(self.seq)
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("INSERT OR IGNORE INTO inbox(recipient,lamport,seq,expires,frame) VALUES(?,?,?,?,?)",
+                                      [(r, clock, seq, expires, data) for r in recipients])
+                for r in recipients:
+                    self.counts[r] = self.counts.get(r, 0) + 1
+                    if self.counts[r] > self.cap // 10:
+                        self._trim(r)
+                self.conn.execute("COMMIT")
+            except sqlite3.Error:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.stats["stored"] += len(recipients)
+
+    def _trim(self, recipient):
+        # checked every cap/10 appends per recipient rather than on every insert
+        self.counts[recipient] = 0
+        cur = self.conn.execute("""DELETE FROM inbox WHERE recipient=? AND (lamport, seq) <= (
+                                     SELECT lamport, seq FROM inbox WHERE recipient=?
+                                     ORDER BY lamport DESC, seq DESC LIMIT 1 OFFSET ?)""",
+                                (recipient, recipient, self.cap))
+        self.stats["trimmed"] += max(cur.rowcount, 0)
+
+    def drain(self, recipient):
+        """Remove and return the recipient's backlog as encoded frames in Lamport order."""
+        with self.lock:
+            # cheap read first: most reconnecting users have nothing waiting
+            if self.conn.execute("SELECT 1 FROM inbox WHERE recipient=? LIMIT 1", (recipient,)).fetchone() is None:
+                return []
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute(
+                    "SELECT frame FROM inbox WHERE recipient=? AND expires>=? ORDER BY lamport, seq",
+                    (recipient, int(time.time()))).fetchall()
+                self.conn.execute("DELETE FROM inbox WHERE recipient=?", (recipient,))
+                self.conn.execute("COMMIT")
+            except sqlite3.Error:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.counts.pop(recipient, None)
+        rows = rows[-self.cap:]     # trimming is amortised, so enforce the cap exactly here
+        self.stats["drained"] += len(rows)
+        return [r[0] for r in rows]
+
+    def restore(self, recipient, frames):
+        """Put drained frames back after a failed delivery."""
+        for f in frames:
+            self.append(recipient, json.loads(f))
+
+    def _purge_loop(self):
+        while True:
+            time.sleep(self.purge_interval)
+            if not self.purging:
+                continue
+            try:
+                with self.lock:
+                    cur = self.conn.execute("DELETE FROM inbox WHERE expires<?", (int(time.time()),))
+                self.stats["expired"] += max(cur.rowcount, 0)
+            except sqlite3.Error as e:
+                log.error("purge failed: %s", e)
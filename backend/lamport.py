@@ -1,5 +1,8 @@
 # backend/lamport.py
-import threading
+import threading, time, heapq, itertools
+import logs
+
+log = logs.get("REORDER")
 
 class LamportClock:
     def __init__(self):
@@ -19,3 +22,133 @@ class LamportClock:
     def now(self):
         with self.lock:
             return self.val
+
+# Hybrid logical clock stamps are plain integers so they sort and index like
+# the old Lamport values:
+#
+#   | wall-clock ms (41 bits) | logical counter (12 bits) | node (8 bits) |
+#
+# The top 53 bits move together as one logical time: it never runs behind
+# the wall clock, and when many events share a millisecond (or a peer is
+# ahead of us) the counter absorbs it and carries into the ms field.
+NODE_BITS = 8
+COUNTER_BITS = 12
+# no HLC stamp is below this (2020-01-01); the old per-node Lamport counters all are
+HLC_MIN = 1577836800000 << (COUNTER_BITS + NODE_BITS)
+
+class HybridClock:
+    """
+    Issues unique, monotonic stamps from one call (stamp()). Stamps from
+    different nodes never collide because the node number is in the low bits.
+    update() merges a stamp received from another node so causally later
+    events always get larger stamps.
+    """
+    def __init__(self, node):
+        if not 0 <= node < (1 << NODE_BITS):
+            raise ValueError(f"node must fit in {NODE_BITS} bits")
+        self.node = node
+        self.last = 0               # logical time of the last stamp (no node bits)
+        self.lock = threading.Lock()
+
+    def stamp(self):
+        wall = time.time_ns() // 1_000_000 << COUNTER_BITS
+        with self.lock:
+            t = self.last = max(self.last + 1, wall)
+        return t << NODE_BITS | self.node
+
+    def update(self, received):
+        """Merge a remote stamp; returns a local stamp that is after it."""
+        received = int(received) >> NODE_BITS
+        wall = time.time_ns() // 1_000_000 << COUNTER_BITS
+        with self.lock:
+            t = self.last = max(self.last + 1, received + 1, wall)
+        return t << NODE_BITS | self.node
+
+    def now(self):
+        return self.last << NODE_BITS | self.node
+
+def physical_ms(stamp):
+    return stamp >> (NODE_BITS + COUNTER_BITS)
+
+class ReorderBuffer:
+    """
+    Holds deliveries from other nodes for a short window and releases them in
+    stamp order, so a recipient sees messages from several nodes in the same
+    order that history (sorted by stamp) returns them. Frames stamped on this
+    node are already in order and go out at once (push(direct=True)), after
+    anything older still buffered, so the window is never a latency floor
+    for local traffic. window=0 delivers everything immediately.
+    """
+    def __init__(self, release, window=0.02):
+        self.release = release
+        self.window = window
+        self.heap = []
+        self.seq = itertools.count()
+        self.cv = threading.Condition()
+        self.out = threading.Lock()     # one releaser at a time, so releases keep their order
+        self.stats = {"buffered": 0, "direct": 0, "released": 0, "reordered": 0}
+        self.last_released = 0
+
+    def start(self):
+        if self.window > 0:
+            threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def push(self, stamp, *item, direct=False):
+        if self.window <= 0:
+            self.release(*item)
+            return
+        if direct:
+            with self.out:
+                with self.cv:
+                    ready = []
+                    while self.heap and self.heap[0][0] <= stamp:
+                        ready.append(self._pop())
+                    self.stats["direct"] += 1
+                    self._count(stamp)
+                for it in ready + [item]:
+                    self._release(it)
+            return
+        with self.cv:
+            heapq.heappush(self.heap, (stamp, next(self.seq), time.monotonic() + self.window, item))
+            self.stats["buffered"] += 1
+            if len(self.heap) == 1:
+                self.cv.notify()
+
+    def _count(self, stamp):
+        # called with cv held
+        self.stats["released"] += 1
+        if stamp < self.last_released:
+            # arrived after its window: still delivered, just out of order
+            self.stats["reordered"] += 1
+        self.last_released = max(self.last_released, stamp)
+
+    def _pop(self):
+        # called with cv held
+        stamp, _, _, item = heapq.heappop(self.heap)
+        self._count(stamp)
+        return item
+
+    def _release(self, item):
+        try:
+            self.release(*item)
+        except Exception as e:
+            log.error("delivery failed: %s", e)
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while not self.heap:
+                    self.cv.wait()
+                delay = self.heap[0][2] - time.monotonic()
+                if delay > 0:
+                    self.cv.wait(delay)
+                    continue
+            with self.out:
+                with self.cv:
+                    now = time.monotonic()
+                    ready = []
+                    while self.heap and self.heap[0][2] <= now:
+                        ready.append(self._pop())
+                for it in ready:
+                    self._release(it)
@@ -1,50 +1,389 @@
 # backend/load_balancer.py
-import socket, threading
+import socket, threading, selectors, os, time, errno, itertools, json, random
+from bully_election import HEARTBEAT_INTERVAL, SUSPECT_TIMEOUT
+import handoff
+import logs
+import metrics
 
-SERVERS = [("127.0.0.1", 6000), ("127.0.0.1", 6002)]  # primary + replica
-rr = 0
-lock = threading.Lock()
+log = logs.get("LB")
 
-def pipe(src, dest):
+PORT_OFFSET = int(os.environ.get("WEBTALK_PORT_OFFSET", "0"))
+HOST, PORT = "127.0.0.1", 5000 + PORT_OFFSET
+SERVERS = [("127.0.0.1", 6000 + PORT_OFFSET), ("127.0.0.1", 6002 + PORT_OFFSET)]  # primary + replica
+POLICY = os.environ.get("LB_POLICY", "least_conn")    # least_conn | round_robin
+HEALTH_INTERVAL = 1.0     # seconds between active checks
+HEALTH_TIMEOUT = 0.5
+HEALTH_FAILS = 2          # consecutive failures before a node is taken out
+ELECTION_ADDR = (HOST, 5300 + PORT_OFFSET)   # chat nodes send bully heartbeats / COORDINATOR here
+METRICS_ADDR = (HOST, 8000 + PORT_OFFSET)    # Prometheus GET /metrics
+CHUNK = 64 * 1024
+BYTES = metrics.counter("webtalk_lb_bytes_total", "Bytes proxied in either direction")
+CONNECT = metrics.histogram("webtalk_lb_connect_seconds", "Client accepted to chat node connected")
+
+# zero-copy socket -> pipe -> socket where the kernel has splice(2)
+USE_SPLICE = hasattr(os, "splice") and os.environ.get("LB_SPLICE", "1") == "1"
+SPLICE_FLAGS = (os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK) if USE_SPLICE else 0
+
+class Backend:
+    def __init__(self, addr):
+        self.addr = addr
+        self.healthy = True
+        self.fails = 0
+        self.active = 0
+        self.last_hb = None       # monotonic time of the node's last heartbeat, once it sends them
+
+    def mark(self, ok):
+        if ok:
+            if not self.healthy:
+                log.info("%s:%d is back up", *self.addr)
+            self.healthy, self.fails = True, 0
+        else:
+            self.fails += 1
+            if self.healthy and self.fails >= HEALTH_FAILS:
+                self.healthy = False
+                log.warning("%s:%d marked down", *self.addr)
+
+    def hb_stale(self, now):
+        return self.last_hb is not None and now - self.last_hb > SUSPECT_TIMEOUT
+
+    def fail_over(self, now):
+        """Take the node out at once on heartbeat loss; new clients go to the others."""
+        if not self.healthy:
+            return
+        self.healthy, self.fails = False, HEALTH_FAILS
+        ms = round((now - self.last_hb) * 1000, 1)
+        stats["failovers"] += 1
+        stats["last_failover_ms"] = ms
+        log.warning("%s:%d stopped heartbeating, redirected %s ms after its last beat", *self.addr, ms)
+
+backends = [Backend(a) for a in SERVERS]
+rr = itertools.count()
+stats = {"accepted": 0, "active": 0, "no_backend": 0, "connect_failed": 0,
+         "failovers": 0, "last_failover_ms": None, "leader": None}
+
+def pick_backend(exclude=()):
+    up = [b for b in backends if b.healthy and b not in exclude]
+    if not up:
+        return None
+    start = next(rr)
+    if POLICY == "round_robin":
+        return up[start % len(up)]
+    # least connections, rotating the starting point to break ties
+    up = up[start % len(up):] + up[:start % len(up)]
+    return min(up, key=lambda b: b.active)
+
+def health_loop():
+    while True:
+        for b in backends:
+            try:
+                socket.create_connection(b.addr, timeout=HEALTH_TIMEOUT).close()
+                # an open port is not enough if the node's heartbeats have stopped
+                b.mark(not b.hb_stale(time.monotonic()))
+            except OSError:
+                b.mark(False)
+        time.sleep(HEALTH_INTERVAL)
+
+def election_loop():
+    """Follow the chat nodes' bully heartbeats: sub-second failure detection."""
+    s = handoff.bind(ELECTION_ADDR, socket.SOCK_DGRAM)
+    s.settimeout(SUSPECT_TIMEOUT / 3)
+    by_addr = {b.addr: b for b in backends}
+    by_id = {}
+    while not handoff.handed_off.is_set():
+        try:
+            msg = json.loads(s.recvfrom(65536)[0])
+        except socket.timeout:
+            msg = None
+        except (OSError, ValueError):
+            continue
+        now = time.monotonic()
+        if msg:
+            b = by_addr.get(tuple(msg.get("addr") or ()))
+            if b is not None:
+                by_id[msg.get("id")] = b
+                b.last_hb = now
+                if not b.healthy:
+                    b.mark(True)
+            if msg.get("t") == "coord":
+                if stats["leader"] != msg.get("id"):
+                    stats["leader"] = msg.get("id")
+                    log.info("leader is now %s", msg.get("node"))
+                # the winner's view of who is dead, applied once we have missed a beat too
+                for pid in msg.get("down", ()):
+                    b = by_id.get(pid)
+                    if b is not None and now - b.last_hb > 1.5 * HEARTBEAT_INTERVAL:
+                        b.fail_over(now)
+        for b in backends:
+            if b.healthy and b.hb_stale(now):
+                b.fail_over(now)
+
+# ---------------- proxying ----------------
+
+class Flow:
+    """One direction of a proxied connection (src -> dst)."""
+    __slots__ = ("src", "dst", "pending", "eof", "pipe", "buf", "off")
+
+    def __init__(self, src, dst):
+        self.src, self.dst = src, dst
+        self.pending = 0          # bytes read from src but not yet written to dst
+        self.eof = False
+        self.pipe = None
+        self.buf = None
+        self.off = 0
+        if USE_SPLICE:
+            r, w = os.pipe()
+            try:
+                import fcntl
+                fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, CHUNK)
+            except (ImportError, AttributeError, OSError):
+                pass
+            self.pipe = (r, w)
+        else:
+            self.buf = bytearray(CHUNK)
+
+    def pull(self):
+        """Read from src. Returns False on EOF."""
+        if USE_SPLICE:
+            n = os.splice(self.src.fileno(), self.pipe[1], CHUNK, flags=SPLICE_FLAGS)
+        else:
+            n = self.src.recv_into(self.buf)
+            self.off = 0
+        self.pending += n
+        BYTES.inc(n)
+        return n > 0
+
+    def push(self):
+        """Write as much pending data to dst as it will take."""
+        while self.pending:
+            if USE_SPLICE:
+                n = os.splice(self.pipe[0], self.dst.fileno(), self.pending, flags=SPLICE_FLAGS)
+            else:
+                n = self.dst.send(memoryview(self.buf)[self.off:self.off + self.pending])
+                self.off += n
+            self.pending -= n
+
+    def close(self):
+        if self.pipe:
+            for fd in self.pipe:
+                try: os.close(fd)
+                except OSError: pass
+            self.pipe = None
+
+class Proxy:
+    __slots__ = ("client", "server", "backend", "up", "down", "connected", "tried", "closed", "t0")
+
+    def __init__(self, client):
+        self.client = client
+        self.server = None
+        self.backend = None
+        self.up = self.down = None
+        self.connected = False
+        self.tried = []
+        self.closed = False
+        self.t0 = time.perf_counter()
+
+sel = selectors.DefaultSelector()
+proxies = set()
+
+def interest(p, sock):
+    """Event mask a socket needs given the state of both flows."""
+    if not p.connected:
+        return selectors.EVENT_WRITE if sock is p.server else 0
+    src_flow, dst_flow = (p.up, p.down) if sock is p.client else (p.down, p.up)
+    mask = 0
+    if not src_flow.eof and not src_flow.pending:
+        mask |= selectors.EVENT_READ       # backpressure: stop reading while dst is full
+    if dst_flow.pending:
+        mask |= selectors.EVENT_WRITE
+    return mask
+
+def update(p, sock):
+    if p.closed or sock is None:
+        return
+    mask = interest(p, sock)
     try:
-        while True:
-            data = src.recv(4096)
-            if not data: break
-            dest.sendall(data)
-    except:
-        pass
-    finally:
-        try: src.close()
-        except: pass
-        try: dest.close()
-        except: pass
+        key = sel.get_key(sock)
+    except KeyError:
+        key = None
+    if key and not mask:
+        sel.unregister(sock)
+    elif key and key.events != mask:
+        sel.modify(sock, mask, p)
+    elif not key and mask:
+        sel.register(sock, mask, p)
 
-def handle_client(client_sock, addr):
-    global rr
-    with lock:
-        target = SERVERS[rr % len(SERVERS)]
-        rr += 1
+def close_proxy(p):
+    if p.closed:
+        return
+    p.closed = True
+    proxies.discard(p)
+    for s in (p.client, p.server):
+        if s is None:
+            continue
+        try: sel.unregister(s)
+        except (KeyError, ValueError): pass
+        try: s.close()
+        except OSError: pass
+    for f in (p.up, p.down):
+        if f: f.close()
+    if p.backend:
+        p.backend.active -= 1
+    stats["active"] -= 1
 
-    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_sock.connect(target)
+def connect_backend(p):
+    """Start a non-blocking connect to the best healthy node not yet tried."""
+    b = pick_backend(exclude=p.tried)
+    if b is None:
+        stats["no_backend"] += 1
+        log.error("no healthy chat server available")
+        close_proxy(p)
+        return
+    p.tried.append(b)
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setblocking(False)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    err = s.connect_ex(b.addr)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        s.close()
+        b.mark(False)
+        stats["connect_failed"] += 1
+        connect_backend(p)
+        return
+    p.server, p.backend = s, b
+    b.active += 1
+    update(p, s)
 
-    # First message from client is the username; forward to server
-    username = client_sock.recv(1024)
-    server_sock.sendall(username)
+def on_connected(p):
+    err = p.server.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        # passive health signal: fail over to the next node instead of dropping the client
+        stats["connect_failed"] += 1
+        p.backend.mark(False)
+        p.backend.active -= 1
+        sel.unregister(p.server)
+        p.server.close()
+        p.server = p.backend = None
+        connect_backend(p)
+        return
+    p.connected = True
+    CONNECT.since(p.t0)
+    p.up = Flow(p.client, p.server)
+    p.down = Flow(p.server, p.client)
+    update(p, p.client)
+    update(p, p.server)
 
-    threading.Thread(target=pipe, args=(client_sock, server_sock), daemon=True).start()
-    threading.Thread(target=pipe, args=(server_sock, client_sock), daemon=True).start()
+def on_event(p, sock, mask):
+    if not p.connected:
+        on_connected(p)
+        return
+    src_flow, dst_flow = (p.up, p.down) if sock is p.client else (p.down, p.up)
+    if mask & selectors.EVENT_WRITE:
+        dst_flow.push()
+        if dst_flow.eof and not dst_flow.pending:
+            sock.shutdown(socket.SHUT_WR)
+    if mask & selectors.EVENT_READ and not src_flow.pending:
+        if not src_flow.pull():
+            src_flow.eof = True
+        src_flow.push()
+        if src_flow.eof and not src_flow.pending:
+            src_flow.dst.shutdown(socket.SHUT_WR)
+    if p.up.eof and p.down.eof and not p.up.pending and not p.down.pending:
+        close_proxy(p)
+        return
+    update(p, p.client)
+    update(p, p.server)
+
+def wind_down(p):
+    """
+    End p as if the client had hung up: the chat node sees EOF, flushes what
+    it still has for the client and closes, and the proxy closes behind it.
+    """
+    if p.closed:
+        return
+    if not p.connected:
+        close_proxy(p)
+        return
+    p.up.eof = True
+    if not p.up.pending:
+        p.server.shutdown(socket.SHUT_WR)
+    update(p, p.client)
+    update(p, p.server)
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
 
 def start_lb():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(("127.0.0.1", 5000))
-    s.listen(256)
-    print("[LB] listening on 127.0.0.1:5000")
+    handoff.adopt()          # started by a draining predecessor: take its sockets
+    raise_fd_limit()
+    threading.Thread(target=health_loop, daemon=True).start()
+    threading.Thread(target=election_loop, daemon=True).start()
+
+    s = handoff.bind((HOST, PORT), backlog=1024)
+    s.setblocking(False)
+    sel.register(s, selectors.EVENT_READ, None)
+    listening = True
+    # SIGUSR2: a successor takes the port; we wind our proxies down below
+    handoff.install()
+    metrics.expose("webtalk_lb", lambda: stats)
+    for b in backends:
+        node = "%s:%d" % b.addr
+        metrics.gauge("webtalk_lb_backend_active", "Proxied connections per chat node", fn=lambda b=b: b.active, node=node)
+        metrics.gauge("webtalk_lb_backend_healthy", "1 while the node takes new clients", fn=lambda b=b: b.healthy, node=node)
+    metrics.serve(METRICS_ADDR)
+    log.info("listening on %s:%d (%s, %s), metrics on :%d", HOST, PORT, POLICY, "splice" if USE_SPLICE else "copy", METRICS_ADDR[1])
+
+    closing = None           # proxy -> when to wind it down, once a successor has the port
     while True:
-        c, addr = s.accept()
-        threading.Thread(target=handle_client, args=(c, addr), daemon=True).start()
+        if listening and handoff.draining.is_set():
+            sel.unregister(s)
+            listening = False
+        if handoff.handed_off.is_set():
+            now = time.monotonic()
+            if closing is None:
+                # spread the clients' reconnects over the drain window instead of one spike
+                closing = {p: now + random.uniform(0, handoff.DRAIN_S) for p in proxies}
+                deadline = now + handoff.DRAIN_S + 5
+                log.info("draining %d connection(s) over %.0fs", len(closing), handoff.DRAIN_S)
+            for p in [p for p, t in closing.items() if t <= now]:
+                del closing[p]
+                try:
+                    wind_down(p)
+                except OSError:
+                    close_proxy(p)
+            if not proxies or now > deadline:
+                log.info("drained (%d connection(s) left), exiting", len(proxies))
+                return
+        for key, mask in sel.select(handoff.POLL):
+            if key.data is None:
+                if not listening:
+                    continue
+                try:
+                    c, _ = s.accept()
+                except (BlockingIOError, InterruptedError):
+                    continue
+                c.setblocking(False)
+                c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                stats["accepted"] += 1
+                stats["active"] += 1
+                p = Proxy(c)
+                proxies.add(p)
+                connect_backend(p)
+                continue
+            p = key.data
+            if p.closed:
+                continue          # closed by an earlier event in this batch; its fds may be reused
+            try:
+                on_event(p, key.fileobj, mask)
+            except (BlockingIOError, InterruptedError):
+                update(p, p.client)
+                update(p, p.server)
+            except OSError:
+                close_proxy(p)
 
 if __name__ == "__main__":
     start_lb()
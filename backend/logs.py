@@ -0,0 +1,62 @@
+# backend/logs.py
+import logging, os, sys, threading, time
+
+# Leveled, rate-limited logging for every process. Lines keep the old
+# "[TAG] message" look. Each call site (logger + format string, so pass
+# values as arguments: log.info("%s connected", user)) gets a token bucket
+# of RATE lines per second with bursts up to BURST; what it drops is counted
+# and reported on the next line that gets through.
+LEVEL = os.environ.get("WEBTALK_LOG_LEVEL", "INFO").upper()
+RATE = float(os.environ.get("WEBTALK_LOG_RATE", "5"))
+BURST = int(os.environ.get("WEBTALK_LOG_BURST", "20"))
+
+class RateLimit(logging.Filter):
+    def __init__(self, rate=RATE, burst=BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}        # (logger, template) -> [tokens, last refill, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        record.suppressed = ""
+        if self.rate <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            b = self.buckets.get(key)
+            if b is None:
+                b = self.buckets[key] = [self.burst, now, 0]
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+            if b[0] < 1:
+                b[2] += 1
+                return False
+            b[0] -= 1
+            if b[2]:
+                record.suppressed = f" ({b[2]} similar suppressed)"
+                b[2] = 0
+        return True
+
+class _Format(logging.Formatter):
+    def format(self, record):
+        line = f"[{record.name.rsplit('.', 1)[-1]}] {record.getMessage()}{getattr(record, 'suppressed', '')}"
+        if record.levelno >= logging.WARNING:
+            line = f"{record.levelname} {line}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+_root = logging.getLogger("webtalk")
+_root.propagate = False
+if not _root.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(_Format())
+    _handler.addFilter(RateLimit())
+    _root.addHandler(_handler)
+    _root.setLevel(getattr(logging, LEVEL, logging.INFO))
+
+def get(tag):
+    """Logger printing as "[tag] ..."."""
+    return logging.getLogger("webtalk." + tag)
@@ -0,0 +1,206 @@
+# backend/metrics.py
+import bisect, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import handoff
+
+# Process-wide metrics in the Prometheus text format.
+#
+# The hot path only does plain attribute arithmetic (no locks, like the stats
+# dicts everywhere else): Counter.inc is one add, Histogram.observe one bisect
+# and two adds. Anything that already lives in a stats dict or can be read
+# off a data structure is exported at scrape time instead, through
+# Gauge(fn=...) or Registry.expose(prefix, fn).
+
+# seconds; fine below 10 ms where delivery and commits normally sit
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + "}"
+
+def _num(v):
+    if isinstance(v, bool):
+        return "1" if v else "0"
+    if isinstance(v, float):
+        return repr(v) if v == v else "NaN"
+    return str(v)
+
+class Counter:
+    kind = "counter"
+    __slots__ = ("value", "labels")
+
+    def __init__(self, labels=None):
+        self.value = 0
+        self.labels = labels or {}
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name):
+        yield name, self.labels, self.value
+
+class Gauge:
+    """A value that is set, or computed by fn() at scrape time."""
+    kind = "gauge"
+    __slots__ = ("value", "labels", "fn")
+
+    def __init__(self, labels=None, fn=None):
+        self.value = 0
+        self.labels = labels or {}
+        self.fn = fn
+
+    def set(self, v):
+        self.value = v
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def samples(self, name):
+        yield name, self.labels, self.fn() if self.fn else self.value
+
+class Histogram:
+    kind = "histogram"
+    __slots__ = ("bounds", "counts", "sum", "labels")
+
+    def __init__(self, labels=None, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)     # last slot: above the largest bound
+        self.sum = 0.0
+        self.labels = labels or {}
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.sum += v
+
+    def since(self, t0):
+        """observe() the seconds elapsed since a time.perf_counter() reading."""
+        self.observe(time.perf_counter() - t0)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self, name):
+        total = 0
+        for bound, n in zip(self.bounds + (float("inf"),), self.counts):
+            total += n
+            yield name + "_bucket", dict(self.labels, le="+Inf" if bound == float("inf") else repr(bound)), total
+        yield name + "_sum", self.labels, self.sum
+        yield name + "_count", self.labels, total
+
+    def snapshot(self, scale=1000.0, unit="ms"):
+        """JSON-friendly view for the stats frames, in milliseconds by default."""
+        les = [_num(round(b * scale, 3)) for b in self.bounds] + ["+Inf"]
+        n = self.count
+        return {"count": n, f"mean_{unit}": round(self.sum * scale / n, 2) if n else None,
+                "buckets": dict(zip(les, self.counts))}
+
+class Registry:
+    def __init__(self):
+        self.families = {}       # name -> (kind, help, {labels key: metric})
+        self.exposed = []        # (prefix, fn) stats dicts rendered as gauges
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kw):
+        key = tuple(sorted(labels.items()))
+        fam = self.families.get(name)
+        if fam is None or key not in fam[2]:
+            with self.lock:
+                fam = self.families.setdefault(name, (cls.kind, help, {}))
+                if fam[0] != cls.kind:
+                    raise ValueError(f"{name} is already a {fam[0]}")
+                fam[2].setdefault(key, cls(labels, **kw))
+        return fam[2][key]
+
+    def counter(self, name, help="", **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", fn=None, **labels):
+        return self._get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help="", buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def expose(self, prefix, fn):
+        """Render every number in the dict fn() returns (nested keys joined by _) as a gauge."""
+        self.exposed.append((prefix, fn))
+
+    def render(self):
+        lines = []
+        for name, (kind, help, metrics) in sorted(self.families.items()):
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for m in list(metrics.values()):
+                try:
+                    for sname, labels, v in m.samples(name):
+                        lines.append(f"{sname}{_labels(labels)} {_num(v)}")
+                except Exception:
+                    pass             # a failing fn() must not break the whole scrape
+        for prefix, fn in self.exposed:
+            try:
+                flat = _flatten(prefix, fn())
+            except Exception:
+                continue
+            for name, v in flat:
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_num(v)}")
+        return "\n".join(lines) + "\n"
+
+_BAD_NAME = re.compile(r"[^a-zA-Z0-9_:]")
+
+def _flatten(prefix, d):
+    for k, v in d.items():
+        name = _BAD_NAME.sub("_", f"{prefix}_{k}")
+        if isinstance(v, dict):
+            yield from _flatten(name, v)
+        elif isinstance(v, (int, float)):
+            yield name, v
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+expose = REGISTRY.expose
+render = REGISTRY.render
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PAGES = {}               # extra path -> (fn() returning str, content type) served next to /metrics
+
+def page(path, fn, content_type="application/json"):
+    PAGES[path] = (fn, content_type)
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            fn, ctype = self.server.registry.render, CONTENT_TYPE
+        elif path in PAGES:
+            fn, ctype = PAGES[path]
+        else:
+            self.send_error(404)
+            return
+        body = fn().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(addr, registry=REGISTRY):
+    """Serve GET /metrics (and any page() paths) on addr from a background thread."""
+    srv = ThreadingHTTPServer(addr, _Handler, bind_and_activate=False)
+    srv.socket.close()
+    srv.socket = handoff.bind(addr, backlog=16)
+    srv.daemon_threads = True
+    srv.registry = registry
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    handoff.on_draining(srv.shutdown)     # the successor serves the port from then on
+    return srv
@@ -0,0 +1,229 @@
+# backend/mux.py
+import json
+import logs
+import wire
+from outbox import Outbox, SessionEvicted, LINK_HIGH_WATER
+
+log = logs.get("MUX")
+
+# Client connection protocols understood by the chat servers. The first line
+# a client sends picks one:
+#   "<username>"  legacy: one user, newline-delimited JSON
+#   "@mux"        text mux: many sessions per link, lines b"<sid> <payload>\n"
+#                 where payload is a JSON frame or "@open <user>" / "@close"
+#                 (server -> frontend: "@closed")
+#   "@wt2"        binary v2: length-prefixed frames, see wire.py
+# Each protocol has a session class with the same interface, so delivery code
+# keeps one username -> session map and never cares what is on the wire.
+# Sessions never write to a socket directly: every connection has an Outbox
+# whose writer thread does the sending, so a slow reader only delays itself.
+# On a shared link each session is also held to its own share of the queue:
+# a session that falls behind is closed alone, the link stays up.
+# A link carries many users: an error in one session's callback (a slow
+# consumer, a failed inbox flush, a database error) ends that session only.
+MUX_HELLO = "@mux"
+
+def read_handshake(conn):
+    """
+    Read the first line of a client connection.
+    Returns (line, leftover_bytes). Legacy clients that send the username
+    without a newline are handled by taking the whole first chunk.
+    """
+    data = conn.recv(1024)
+    if b"\n" in data:
+        line, rest = data.split(b"\n", 1)
+    else:
+        line, rest = data, b""
+    return line.decode(errors="ignore").strip(), rest
+
+def encode_body(proto, obj):
+    return wire.encode(obj) if proto == "bin" else json.dumps(obj).encode()
+
+class JsonConn:
+    """A dedicated legacy connection for one user."""
+    proto = "json"
+
+    def __init__(self, sock, name=""):
+        self.outbox = Outbox(sock, name=name).start()
+
+    def send(self, obj):
+        self.send_body(encode_body(self.proto, obj))
+
+    def send_body(self, body):
+        self.outbox.put_many((body, b"\n"))
+
+    def send_bodies(self, bodies):
+        self.outbox.put_many([x for b in bodies for x in (b, b"\n")])
+
+    def close(self):
+        self.outbox.close()
+
+    def snapshot(self):
+        return self.outbox.snapshot()
+
+class MuxLink:
+    """One multiplexed connection; its sessions share one outbound queue."""
+    def __init__(self, sock, name="", on_evict=None):
+        self.outbox = Outbox(sock, high_water=LINK_HIGH_WATER, name=name).start()
+        self.sessions = {}       # sid -> session
+        self.on_evict = on_evict  # called with a session that fell behind
+
+    def write(self, data):
+        self.outbox.put(data)
+
+    def write_many(self, chunks, owner=None):
+        try:
+            self.outbox.put_many(chunks, owner)
+        except SessionEvicted:
+            self.evict(owner)
+            raise
+
+    def evict(self, sess):
+        if self.sessions.get(sess.sid) is sess:
+            del self.sessions[sess.sid]
+        if self.on_evict:
+            self.on_evict(sess)
+        else:
+            sess.close()
+
+    def close(self):
+        self.outbox.close()
+
+class MuxSession(JsonConn):
+    """One user session on a text mux link."""
+    def __init__(self, link, sid, username):
+        self.link = link
+        self.outbox = link.outbox
+        self.sid = sid
+        self.prefix = b"%d " % sid
+        self.username = username
+        self.closed = False
+
+    def __str__(self):
+        return f"session {self.sid} ({self.username})"
+
+    def snapshot(self):
+        return dict(self.outbox.snapshot(), session_queued_bytes=self.outbox.owned_bytes(self))
+
+    def send_body(self, body):
+        if self.closed:
+            raise OSError("mux session closed")
+        self.link.write_many((self.prefix, body, b"\n"), self)
+
+    def send_bodies(self, bodies):
+        if self.closed:
+            raise OSError("mux session closed")
+        p = self.prefix
+        self.link.write_many([x for b in bodies for x in (p, b, b"\n")], self)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.link.write(self.prefix + b"@closed\n")
+        except OSError:
+            pass
+
+class BinarySession(MuxSession):
+    """One user session on a binary v2 connection."""
+    proto = "bin"
+
+    def send_body(self, body):
+        if self.closed:
+            raise OSError("session closed")
+        self.link.write_many((wire.HEADER.pack(len(body), wire.MSG, self.sid), body), self)
+
+    def send_bodies(self, bodies):
+        if self.closed:
+            raise OSError("session closed")
+        sid, pack = self.sid, wire.HEADER.pack
+        self.link.write_many([x for b in bodies for x in (pack(len(b), wire.MSG, sid), b)], self)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.link.write(wire.frame(wire.CLOSED, self.sid))
+        except OSError:
+            pass
+
+def _guard(link, sess, detach, fn):
+    """Run fn(); if it raises, evict sess and keep the link serving the others."""
+    try:
+        fn()
+    except Exception as e:
+        log.warning("%s: closing session %d (%s): %s", link.outbox.name, sess.sid, sess.username, e)
+        if link.sessions.get(sess.sid) is sess:
+            del link.sessions[sess.sid]
+        try:
+            detach(sess, sess.username)
+        except Exception as e:
+            log.error("%s: detaching %s failed: %s", link.outbox.name, sess.username, e)
+
+def serve_text_mux(conn, buf, attach, detach, on_message):
+    """Run a text mux link until it closes. Callbacks take (session, ...)."""
+    link = MuxLink(conn, name="mux link", on_evict=lambda s: detach(s, s.username))
+    try:
+        while True:
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                sid, _, payload = line.partition(b" ")
+                if not sid.isdigit():
+                    continue
+                sid = int(sid)
+                if payload.startswith(b"@open "):
+                    sess = MuxSession(link, sid, payload[6:].decode(errors="ignore").strip())
+                    link.sessions[sid] = sess
+                    _guard(link, sess, detach, lambda: attach(sess, sess.username))
+                elif payload == b"@close":
+                    sess = link.sessions.pop(sid, None)
+                    if sess:
+                        detach(sess, sess.username)
+                else:
+                    sess = link.sessions.get(sid)
+                    if sess is None:
+                        continue
+                    try:
+                        msg = json.loads(payload)
+                    except ValueError:
+                        continue
+                    _guard(link, sess, detach, lambda: on_message(sess, sess.username, msg))
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            buf += chunk
+    finally:
+        for sess in list(link.sessions.values()):
+            detach(sess, sess.username)
+        link.close()
+    return len(link.sessions)
+
+def serve_binary(conn, buf, attach, detach, on_message):
+    """Run a binary v2 connection (single user or multiplexed) until it closes."""
+    link = MuxLink(conn, name="v2 link", on_evict=lambda s: detach(s, s.username))
+    reader = wire.FrameReader(conn, buf)
+    try:
+        link.write((wire.HELLO_V2 + "\n").encode())       # accept the upgrade
+        while True:
+            for kind, sid, payload in reader.frames():
+                if kind == wire.MSG:
+                    sess = link.sessions.get(sid)
+                    if sess is not None:
+                        _guard(link, sess, detach, lambda: on_message(sess, sess.username, wire.decode(payload)))
+                elif kind in (wire.USER, wire.OPEN):
+                    sess = BinarySession(link, sid, str(payload, "utf-8", "ignore").strip())
+                    link.sessions[sid] = sess
+                    _guard(link, sess, detach, lambda: attach(sess, sess.username))
+                elif kind == wire.CLOSE:
+                    sess = link.sessions.pop(sid, None)
+                    if sess:
+                        detach(sess, sess.username)
+            if not reader.fill():
+                break
+    finally:
+        for sess in list(link.sessions.values()):
+            detach(sess, sess.username)
+        link.close()
+    return len(link.sessions)
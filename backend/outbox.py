@@ -0,0 +1,187 @@
+# backend/outbox.py
+import socket, threading, collections, os
+import logs
+
+log = logs.get("OUTBOX")
+
+# Outbound bytes a connection may have queued before it counts as a slow
+# consumer. Frontend links carry many users, so they get a deeper queue, and
+# each session on a link is held to HIGH_WATER on its own share of it.
+HIGH_WATER = int(os.environ.get("OUTBOX_HIGH_WATER", 1 << 20))
+LINK_HIGH_WATER = int(os.environ.get("OUTBOX_LINK_HIGH_WATER", 16 << 20))
+# "disconnect": shut the connection down; "drop": discard the frame, keep the connection
+POLICY = os.environ.get("OUTBOX_POLICY", "disconnect")
+CLOSE_LINGER = 5.0          # seconds a closing connection gets to flush its queue
+IOV_MAX = 1024              # buffers per sendmsg call
+
+totals = {"evicted": 0, "dropped": 0, "sessions_evicted": 0}
+
+class SlowConsumer(OSError):
+    pass
+
+class SessionEvicted(SlowConsumer):
+    """One session on a shared connection went over its share; the connection is fine."""
+
+class Outbox:
+    """
+    Bounded outbound queue for one socket, drained by its own writer thread.
+    put() never blocks: senders append and return, the writer hands
+    everything queued to a single sendmsg (writev). A connection that falls
+    more than high_water bytes behind is handled by policy instead of
+    stalling whoever is sending to it. Chunks put with an owner (a mux
+    session) are also counted per owner, and an owner more than
+    owner_high_water behind is dropped or evicted alone; the connection is
+    only shut down when its socket as a whole stops draining.
+    """
+    def __init__(self, sock, high_water=HIGH_WATER, policy=POLICY, name="", owner_high_water=HIGH_WATER):
+        self.sock = sock
+        self.high_water = high_water
+        self.owner_high_water = owner_high_water
+        self.policy = policy
+        self.name = name
+        self.cv = threading.Condition()
+        self.chunks = collections.deque()
+        self.queued = 0             # bytes accepted but not yet written
+        self.owned = {}             # owner -> its share of queued
+        self.closed = False
+        self.stats = {"peak_bytes": 0, "sent_bytes": 0, "frames": 0, "writes": 0, "dropped": 0, "evicted": False,
+                      "sessions_evicted": 0}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def put(self, data):
+        self.put_many((data,))
+
+    def put_many(self, chunks, owner=None):
+        """Queue chunks as one unit: all of them are accepted or none."""
+        size = sum(map(len, chunks))
+        with self.cv:
+            if self.closed:
+                raise OSError("connection closed")
+            # a single oversized write to an idle connection is still allowed
+            if self.queued and self.queued + size > self.high_water:
+                self._slow(size)
+            if owner is not None:
+                mine = self.owned.get(owner, 0)
+                if mine and mine + size > self.owner_high_water:
+                    self._slow_owner(owner, mine)
+                self.owned[owner] = mine + size
+            self.chunks.extend((c, owner) for c in chunks)
+            self.queued += size
+            self.stats["frames"] += len(chunks)
+            if self.queued > self.stats["peak_bytes"]:
+                self.stats["peak_bytes"] = self.queued
+            self.cv.notify()
+
+    def _slow(self, size):
+        # called with cv held
+        if self.policy == "drop":
+            self.stats["dropped"] += 1
+            totals["dropped"] += 1
+            raise SlowConsumer(f"{self.name}: {self.queued} bytes queued, frame dropped")
+        self.closed = True
+        self.chunks.clear()
+        self.owned.clear()
+        self.stats["evicted"] = True
+        totals["evicted"] += 1
+        log.warning("evicting slow consumer %s (%d bytes queued)", self.name, self.queued)
+        self.abort()
+        self.cv.notify()
+        raise SlowConsumer(f"{self.name}: evicted")
+
+    def _slow_owner(self, owner, mine):
+        # called with cv held; what the owner already queued still goes out,
+        # since dropping part of a unit the writer has begun would cut a frame
+        if self.policy == "drop":
+            self.stats["dropped"] += 1
+            totals["dropped"] += 1
+            raise SlowConsumer(f"{self.name}: {owner}: {mine} bytes queued, frame dropped")
+        self.stats["sessions_evicted"] += 1
+        totals["sessions_evicted"] += 1
+        log.warning("evicting slow %s on %s (%d bytes queued)", owner, self.name, mine)
+        raise SessionEvicted(f"{self.name}: {owner}: evicted")
+
+    def owned_bytes(self, owner):
+        return self.owned.get(owner, 0)
+
+    def close(self):
+        """Flush what is queued (for up to CLOSE_LINGER seconds), then close the socket."""
+        with self.cv:
+            if self.closed:
+                return
+            self.closed = True
+            pending = bool(self.chunks)
+            self.cv.notify()
+        if pending:
+            t = threading.Timer(CLOSE_LINGER, self.abort)
+            t.daemon = True
+            t.start()
+
+    def abort(self):
+        # wakes a writer blocked in sendmsg and a reader blocked in recv
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        try:
+            while True:
+                with self.cv:
+                    while not self.chunks and not self.closed:
+                        self.cv.wait()
+                    if not self.chunks:
+                        break
+                    n = min(len(self.chunks), IOV_MAX)
+                    batch = [self.chunks.popleft() for _ in range(n)]
+                size = self._write([c for c, _ in batch])
+                with self.cv:
+                    self.queued -= size
+                    for c, owner in batch:
+                        if owner is not None:
+                            left = self.owned.get(owner, 0) - len(c)
+                            if left > 0:
+                                self.owned[owner] = left
+                            else:
+                                self.owned.pop(owner, None)
+        except OSError:
+            with self.cv:
+                self.closed = True
+                self.chunks.clear()
+                self.owned.clear()
+            self.abort()
+        finally:
+            self.queued = 0
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def _write(self, batch):
+        total = sum(map(len, batch))
+        i = 0
+        while i < len(batch):
+            n = self.sock.sendmsg(batch[i:] if i else batch)
+            self.stats["writes"] += 1
+            self.stats["sent_bytes"] += n
+            # skip fully written buffers, keep the unwritten tail of a partial one
+            while i < len(batch) and n >= len(batch[i]):
+                n -= len(batch[i])
+                i += 1
+            if n:
+                batch[i] = memoryview(batch[i])[n:]
+        return total
+
+    def snapshot(self):
+        return dict(self.stats, queued_bytes=self.queued)
+
+def summary(outboxes):
+    """Aggregate counters over a set of outboxes (each counted once)."""
+    seen = {id(o): o for o in outboxes}.values()
+    queued = [o.queued for o in seen]
+    per_session = [max(list(o.owned.values()), default=0) for o in seen]
+    return {"connections": len(queued), "queued_bytes": sum(queued),
+            "max_queued_bytes": max(queued, default=0),
+            "max_session_queued_bytes": max(per_session, default=0), **totals}
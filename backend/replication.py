@@ -0,0 +1,163 @@
+# backend/replication.py
+import socket, threading, json, time, queue, itertools
+from collections import deque
+import logs
+
+class Replicator:
+    """
+    Background replication pipeline to the backup sink.
+    Handlers call submit() and return immediately; one sender thread keeps a
+    long-lived connection to the backup open (reconnecting with backoff) and
+    ships queued messages as newline-delimited JSON batches.
+
+    The backup acknowledges, per connection, how many frames it has
+    committed. Sent frames are kept until then and only those are sent
+    again on a new connection (the backup ignores rows it already has).
+    """
+    def __init__(self, addr, max_queue=50000, batch_size=256, batch_interval=0.02, tag="REPL"):
+        self.addr = addr
+        self.q = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval   # max time a message waits for batch-mates
+        self.log = logs.get(tag)
+        self.max_unacked = max_queue
+        self.sock = None
+        self.seq = itertools.count()
+        self.unacked = deque()                 # (seq, enqueue time, msg) sent but not yet committed
+        self.lock = threading.Lock()
+        self.stats = {"enqueued": 0, "sent": 0, "acked": 0, "resent": 0, "dropped": 0, "batches": 0,
+                      "connects": 0, "last_batch_lag_ms": 0}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def submit(self, msg_obj):
+        # never block a chat handler on the backup: drop when the queue is full
+        try:
+            self.q.put_nowait((time.time(), msg_obj))
+            self.stats["enqueued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def depth(self):
+        """Messages not yet committed by the backup: queued plus sent and unacknowledged."""
+        return self.q.qsize() + len(self.unacked)
+
+    def lag(self):
+        """Seconds the oldest not-yet-committed message has been waiting."""
+        oldest = None
+        with self.lock:
+            if self.unacked:
+                oldest = self.unacked[0][1]
+        if oldest is None:
+            with self.q.mutex:
+                if self.q.queue:
+                    oldest = self.q.queue[0][0]
+        return time.time() - oldest if oldest is not None else 0.0
+
+    def snapshot(self):
+        s = dict(self.stats)
+        s["queue_depth"] = self.q.qsize()
+        s["unacked"] = len(self.unacked)
+        s["lag_ms"] = int(self.lag() * 1000)
+        s["connected"] = self.sock is not None
+        return s
+
+    # ---- sender thread ----
+    def _collect(self):
+        try:
+            first = self.q.get(timeout=1.0)
+        except queue.Empty:
+            return []        # idle: lets a lost connection's unacknowledged frames go out again
+        batch = [first]
+        deadline = first[0] + self.batch_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                batch.append(self.q.get(timeout=remaining) if remaining > 0 else self.q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _connect(self):
+        backoff = 0.1
+        while True:
+            try:
+                s = socket.create_connection(self.addr, timeout=2)
+                s.settimeout(None)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                self.sock = s
+                self.stats["connects"] += 1
+                with self.lock:
+                    base = self.unacked[0][0] if self.unacked else None
+                threading.Thread(target=self._read_acks, args=(s, base), daemon=True).start()
+                return s
+            except OSError as e:
+                self.log.warning("backup not reachable: %s", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 5.0)
+
+    def _lost(self, s, why):
+        if self.sock is s:
+            self.log.warning("backup link lost: %s", why)
+            self.sock = None
+        try: s.close()
+        except: pass
+
+    def _read_acks(self, s, base):
+        # {"ack": n}: the first n frames sent on this connection are committed. Frames on a
+        # connection have consecutive seqs, from base (the oldest unacknowledged at connect)
+        # or, if nothing was outstanding, from the first one sent on it
+        buf = b""
+        try:
+            while True:
+                chunk = s.recv(4096)
+                if not chunk:
+                    break
+                buf += chunk
+                *lines, buf = buf.split(b"\n")
+                for line in lines:
+                    n = json.loads(line).get("ack", 0)
+                    with self.lock:
+                        if base is None and self.unacked:
+                            base = self.unacked[0][0]
+                        while self.unacked and base is not None and self.unacked[0][0] < base + n:
+                            self.unacked.popleft()
+                            self.stats["acked"] += 1
+        except (OSError, ValueError) as e:
+            self._lost(s, e)
+            return
+        self._lost(s, "closed by the backup")
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch and (self.sock is not None or not self.unacked):
+                continue
+            now = time.time()
+            with self.lock:
+                # bounded like the queue: past max_queue the oldest unacknowledged frames go
+                while self.unacked and len(self.unacked) + len(batch) > self.max_unacked:
+                    self.unacked.popleft()
+                    self.stats["dropped"] += 1
+                fresh = [(next(self.seq), t, m) for t, m in batch]
+                self.unacked.extend(fresh)
+            frames = fresh
+            while True:
+                s = self.sock
+                if s is None:
+                    s = self._connect()
+                    with self.lock:
+                        frames = list(self.unacked)      # everything not committed goes again
+                    self.stats["resent"] += len(frames) - len(fresh)
+                try:
+                    s.sendall("".join(json.dumps(m) + "\n" for _, _, m in frames).encode())
+                    break
+                except OSError as e:
+                    self._lost(s, e)
+            if batch:
+                self.stats["sent"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["last_batch_lag_ms"] = int((now - batch[0][0]) * 1000)
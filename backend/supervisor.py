@@ -0,0 +1,104 @@
+# backend/supervisor.py
+import argparse, os, signal, socket, subprocess, sys, threading, time
+import logs
+import metrics
+
+# Runs one chat node as several worker processes (Linux):
+#
+#   python supervisor.py chat_server_primary.py -n 4
+#
+# Every worker binds the node's client port with SO_REUSEPORT, so the kernel
+# spreads incoming connections over them, and links to its siblings over unix
+# sockets in run/ (cluster.worker_layout) to reach users they hold. Worker 0
+# also does the node-wide work: peer port, election, API events. Workers are
+# told their index through WEBTALK_WORKER / WEBTALK_WORKERS and restarted
+# when they exit; one that keeps dying young is restarted with backoff.
+log = logs.get("SUPERVISOR")
+MIN_UPTIME = 5.0             # a worker that lived shorter than this counts as crash-looping
+MAX_BACKOFF = 30.0
+
+class Worker:
+    def __init__(self, script, index, count):
+        self.script = script
+        self.index = index
+        self.count = count
+        self.proc = None
+        self.started = None
+        self.backoff = 0.0
+        self.restart_at = 0.0
+        self.stats = {"starts": 0, "crashes": 0, "last_exit": None}
+
+    def start(self):
+        self.stats["starts"] += 1
+        env = dict(os.environ, WEBTALK_WORKER=str(self.index), WEBTALK_WORKERS=str(self.count),
+                   WEBTALK_WORKER_STARTS=str(self.stats["starts"]))
+        self.proc = subprocess.Popen([sys.executable, self.script], env=env)
+        self.started = time.monotonic()
+        log.info("worker %d started (pid %d)", self.index, self.proc.pid)
+
+    def check(self, now):
+        """Restart the worker if it exited; called from the supervisor loop."""
+        if self.proc is not None:
+            code = self.proc.poll()
+            if code is None:
+                return
+            self.proc = None
+            self.stats["crashes"] += 1
+            self.stats["last_exit"] = code
+            short = now - self.started < MIN_UPTIME
+            self.backoff = min(max(self.backoff * 2, 0.5), MAX_BACKOFF) if short else 0.0
+            self.restart_at = now + self.backoff
+            log.warning("worker %d exited with %s, restarting in %.1fs", self.index, code, self.backoff)
+        if now >= self.restart_at:
+            self.start()
+
+    def snapshot(self):
+        up = self.proc is not None and self.proc.poll() is None
+        return dict(self.stats, up=up, pid=self.proc.pid if up else None,
+                    uptime_s=round(time.monotonic() - self.started, 1) if up else 0)
+
+def main():
+    ap = argparse.ArgumentParser(description="Run a chat node as N worker processes sharing its port.")
+    ap.add_argument("script", help="chat_server_primary.py or chat_server_replica.py")
+    ap.add_argument("-n", "--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--metrics-port", type=int, default=0,
+                    help="serve per-worker supervisor stats at /metrics on this port (+ WEBTALK_PORT_OFFSET)")
+    args = ap.parse_args()
+    if not hasattr(socket, "SO_REUSEPORT"):
+        sys.exit("supervisor.py needs SO_REUSEPORT (Linux)")
+    if not 1 <= args.workers <= 16:
+        sys.exit("--workers must be 1..16 (the worker index shares the clock's node bits)")
+
+    workers = [Worker(args.script, k, args.workers) for k in range(args.workers)]
+    for w in workers:
+        metrics.expose(f"webtalk_supervisor_worker_{w.index}", w.snapshot)
+    if args.metrics_port:
+        offset = int(os.environ.get("WEBTALK_PORT_OFFSET", "0"))
+        metrics.serve(("127.0.0.1", args.metrics_port + offset))
+
+    stopping = threading.Event()
+    def stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for w in workers:
+        w.start()
+    while not stopping.wait(0.5):
+        now = time.monotonic()
+        for w in workers:
+            w.check(now)
+
+    log.info("stopping %d worker(s)", len(workers))
+    procs = [w.proc for w in workers if w.proc is not None]
+    for p in procs:
+        p.terminate()
+    deadline = time.monotonic() + 10
+    for p in procs:
+        try:
+            p.wait(max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# backend/tracing.py
+import json, os, random, time
+from collections import deque
+import metrics
+
+# Sampled per-message tracing: browser -> frontend -> LB -> chat server -> backup.
+#
+# The frontend starts a trace for a RATE share of the messages it sends by
+# putting a context in the frame, {"id": trace id, "hops": [[hop, wall time]]}.
+# Each component that handles a traced frame records spans (trace id, name,
+# start, end) into its own ring buffer, served as JSON at /traces, and stamps
+# its hand-off onto the context it passes on, so the next component can time
+# the wait in between (the LB splices bytes without looking at them; its
+# share shows up as the "lb" span the chat server measures).
+# bench/tracestitch.py joins the rings of all processes by trace id.
+#
+# An untraced frame costs one dict lookup per hop. Stamps are time.time() so
+# processes on one host line up; across hosts the transit spans include skew.
+RATE = float(os.environ.get("WEBTALK_TRACE_RATE", "0"))   # 0.01 = trace 1% of messages
+RING_SIZE = int(os.environ.get("WEBTALK_TRACE_RING", "4096"))
+
+ring = deque(maxlen=RING_SIZE)     # appends are atomic: no lock on the hot path
+
+def sampled(rate=RATE):
+    return rate > 0 and random.random() < rate
+
+def start(hop, t=None):
+    """A new context whose first hand-off is hop at t."""
+    return {"id": os.urandom(8).hex(), "hops": [[hop, t or time.time()]]}
+
+def hop(ctx, name, t=None):
+    """A copy of ctx with one more hand-off stamp; frames already holding ctx keep theirs."""
+    return {"id": ctx["id"], "hops": ctx["hops"] + [[name, t or time.time()]]}
+
+def last(ctx):
+    """Wall time of the latest hand-off in ctx."""
+    return ctx["hops"][-1][1]
+
+MAX_HOPS = 16
+
+def accept(ctx, name):
+    """
+    Check a context that arrived from a client and record the transit span
+    name since its last hand-off. Returns ctx, or None when it is malformed.
+    """
+    try:
+        hops = ctx["hops"]
+        if not (isinstance(ctx["id"], str) and len(ctx["id"]) <= 32 and 0 < len(hops) < MAX_HOPS):
+            return None
+        span(ctx, name, float(last(ctx)))
+    except (TypeError, KeyError, IndexError, ValueError):
+        return None
+    return ctx
+
+def span(ctx, name, t0, t1=None):
+    ring.append((ctx["id"], name, t0, t1 or time.time()))
+
+def relay(frame, name, hop_name):
+    """Record span name since frame's last hand-off and return the frame re-stamped by hop_name."""
+    ctx = frame.get("trace")
+    if ctx is None:
+        return frame
+    now = time.time()
+    span(ctx, name, last(ctx), now)
+    return dict(frame, trace=hop(ctx, hop_name, now))
+
+def dump():
+    return json.dumps(list(ring))
+
+metrics.page("/traces", dump)
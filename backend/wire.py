@@ -0,0 +1,230 @@
+# backend/wire.py
+import struct
+
+# Binary chat protocol, version 2.
+#
+# Negotiation: the client's first line is "@wt2"; a server that speaks it
+# answers "@wt2\n" and both sides switch to length-prefixed frames. Clients
+# that send a username (or "@mux") line keep the newline-JSON protocol.
+#
+# Frame:  u32 payload length | u8 kind | u32 session id | payload
+#   USER   payload = username; single-user connection, session id 0
+#   OPEN   payload = username; opens a multiplexed session
+#   CLOSE  client ends a session
+#   CLOSED server ended a session
+#   MSG    payload = value encoded with encode()
+HELLO_V2 = "@wt2"
+HEADER = struct.Struct("!IBI")
+MAX_FRAME = 1 << 20
+
+USER, OPEN, CLOSE, CLOSED, MSG = 1, 2, 3, 4, 5
+
+# value tags
+_NONE, _TRUE, _FALSE, _INT, _NEGINT, _STR, _LIST, _DICT, _FLOAT, _BYTES = range(10)
+_F64 = struct.Struct("!d")
+
+def frame(kind, sid, payload=b""):
+    return HEADER.pack(len(payload), kind, sid) + payload
+
+def _varint(out, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _enc_str(out, v):
+    b = v.encode()
+    n = len(b)
+    if n < 0x80:                      # the common case: one length byte
+        out += bytes((_STR, n))
+    else:
+        out.append(_STR)
+        _varint(out, n)
+    out += b
+
+def _enc_int(out, v):
+    if v < 0:
+        out.append(_NEGINT)
+        v = -v
+    else:
+        out.append(_INT)
+    _varint(out, v)
+
+def _enc_dict(out, v):
+    out.append(_DICT)
+    _varint(out, len(v))
+    for k, x in v.items():
+        b = k.encode() if type(k) is str else str(k).encode()
+        _varint(out, len(b))
+        out += b
+        t = type(x)
+        if t is str:                  # inline the two types chat frames are made of
+            _enc_str(out, x)
+        elif t is int:
+            _enc_int(out, x)
+        else:
+            _enc(out, x)
+
+def _enc_list(out, v):
+    out.append(_LIST)
+    _varint(out, len(v))
+    for x in v:
+        _enc(out, x)
+
+def _enc_float(out, v):
+    out.append(_FLOAT)
+    out += _F64.pack(v)
+
+def _enc_bytes(out, v):
+    out.append(_BYTES)
+    _varint(out, len(v))
+    out += v
+
+_ENCODERS = {str: _enc_str, int: _enc_int, dict: _enc_dict, list: _enc_list, tuple: _enc_list,
+             float: _enc_float, bytes: _enc_bytes, bytearray: _enc_bytes, memoryview: _enc_bytes}
+
+def _enc(out, v):
+    f = _ENCODERS.get(type(v))
+    if f is not None:
+        f(out, v)
+    elif v is None:
+        out.append(_NONE)
+    elif v is True:
+        out.append(_TRUE)
+    elif v is False:
+        out.append(_FALSE)
+    elif isinstance(v, int):
+        _enc_int(out, int(v))
+    elif isinstance(v, str):
+        _enc_str(out, str(v))
+    elif isinstance(v, dict):
+        _enc_dict(out, v)
+    else:
+        raise TypeError(f"cannot encode {type(v).__name__}")
+
+def encode(value):
+    out = bytearray()
+    _enc(out, value)
+    return bytes(out)
+
+def _rvarint(mv, i):
+    n = shift = 0
+    while True:
+        b = mv[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+def _dec(mv, i):
+    tag = mv[i]
+    i += 1
+    if tag == _STR:
+        n = mv[i]
+        if n < 0x80:
+            i += 1
+        else:
+            n, i = _rvarint(mv, i)
+        return str(mv[i:i + n], "utf-8"), i + n     # decoded straight from the view
+    if tag == _INT:
+        n = mv[i]
+        if n < 0x80:
+            return n, i + 1
+        return _rvarint(mv, i)
+    if tag == _DICT:
+        n, i = _rvarint(mv, i)
+        d = {}
+        for _ in range(n):
+            kn = mv[i]
+            if kn < 0x80:
+                i += 1
+            else:
+                kn, i = _rvarint(mv, i)
+            k = str(mv[i:i + kn], "utf-8")
+            i += kn
+            if mv[i] == _STR and mv[i + 1] < 0x80:     # inline short string values
+                sn = mv[i + 1]
+                d[k] = str(mv[i + 2:i + 2 + sn], "utf-8")
+                i += 2 + sn
+            else:
+                d[k], i = _dec(mv, i)
+        return d, i
+    if tag == _NONE:
+        return None, i
+    if tag == _TRUE:
+        return True, i
+    if tag == _FALSE:
+        return False, i
+    if tag == _NEGINT:
+        n, i = _rvarint(mv, i)
+        return -n, i
+    if tag == _LIST:
+        n, i = _rvarint(mv, i)
+        out = []
+        for _ in range(n):
+            x, i = _dec(mv, i)
+            out.append(x)
+        return out, i
+    if tag == _FLOAT:
+        return _F64.unpack_from(mv, i)[0], i + 8
+    if tag == _BYTES:
+        n, i = _rvarint(mv, i)
+        return bytes(mv[i:i + n]), i + n
+    raise ValueError(f"bad tag {tag}")
+
+def decode(payload):
+    """Decode a value from a bytes-like payload (a memoryview is not copied)."""
+    mv = payload if isinstance(payload, memoryview) else memoryview(payload)
+    value, _ = _dec(mv, 0)
+    return value
+
+class FrameReader:
+    """
+    Parses frames out of one reusable bytearray. recv_into() fills the free
+    tail, frames are handed out as memoryviews into the buffer, and bytes are
+    only moved when a partial frame has to be shifted to the front.
+    Payload views are valid until the next fill().
+    """
+    def __init__(self, sock, initial=b"", size=64 * 1024):
+        self.sock = sock
+        self.buf = bytearray(max(size, len(initial)))
+        self.buf[:len(initial)] = initial
+        self.start = 0
+        self.end = len(initial)
+
+    def fill(self):
+        """Read more bytes from the socket. Returns False on EOF."""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            pending = self.end - self.start
+            if self.start:
+                self.buf[:pending] = self.buf[self.start:self.end]
+            else:
+                # one frame larger than the buffer: swap in a bigger one (a live
+                # payload view may still pin the old one, so never resize in place)
+                bigger = bytearray(2 * len(self.buf))
+                bigger[:pending] = self.buf
+                self.buf = bigger
+            self.start, self.end = 0, pending
+        n = self.sock.recv_into(memoryview(self.buf)[self.end:])
+        self.end += n
+        return n > 0
+
+    def frames(self):
+        """Yield (kind, sid, payload_view) for every complete buffered frame."""
+        mv = memoryview(self.buf)
+        hs = HEADER.size
+        try:
+            while self.end - self.start >= hs:
+                length, kind, sid = HEADER.unpack_from(self.buf, self.start)
+                if length > MAX_FRAME:
+                    raise ValueError(f"frame of {length} bytes exceeds limit")
+                stop = self.start + hs + length
+                if stop > self.end:
+                    break
+                self.start = stop
+                yield kind, sid, mv[stop - length:stop]
+        finally:
+            mv.release()
@@ -0,0 +1,618 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test for the chat tier (Linux).
+
+    python chatbench.py --clients 2000 --duration 30 --out results/run.json
+    python chatbench.py --compare results/before.json results/after.json
+
+Boots a private stack (backup, primary, replica, load balancer and the REST
+API) from this checkout in a temporary directory, on free ports chosen at
+startup and passed down as WEBTALK_PORT_OFFSET, and seeds it with users and
+groups. Simulated clients then speak the legacy line protocol through the
+load balancer: DMs, group messages, join frames and reconnect churn. Every
+message carries its send time, so the receiving client measures end-to-end
+delivery latency. With --trace a share of the messages also carries a
+trace context (backend/tracing.py) and the result gets a per-hop breakdown
+stitched from the servers' trace rings (tracestitch.py).
+
+The result JSON holds throughput, p50/p95/p99 delivery latency, acks by
+kind, replication lag sampled from the servers' stats frames, per-process
+CPU and RSS from /proc, and the raw server stats at the end of the run.
+--compare prints the change between two results and exits 1 when a tracked
+metric got worse by more than --tolerance.
+"""
+import argparse, heapq, http.client, json, math, multiprocessing as mp, os, random, resource, selectors
+import shutil, socket, sqlite3, subprocess, sys, tempfile, threading, time
+from collections import Counter
+import tracestitch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, "backend")
+API_DIR = os.path.join(BACKEND, "api")
+
+# default ports of the stack (see the modules); the whole set shifts by one offset
+TCP_PORTS = (5000, 6000, 6001, 6002, 6011, 6100, 6102, 7000, 8000, 9000, 9001, 9002)
+UDP_PORTS = (5300, 6200, 6202, 6210, 6300, 6302)
+# name, script, client port; started in this order
+PROCESSES = [("backup", os.path.join(BACKEND, "backup_server.py"), 6001),
+             ("primary", os.path.join(BACKEND, "chat_server_primary.py"), 6000),
+             ("replica", os.path.join(BACKEND, "chat_server_replica.py"), 6002),
+             ("lb", os.path.join(BACKEND, "load_balancer.py"), 5000),
+             ("api", os.path.join(API_DIR, "app.py"), 7000)]
+LB_PORT, API_PORT = 5000, 7000
+STATS_NODES = {"primary": 6000, "replica": 6002}
+SUPERVISOR = os.path.join(BACKEND, "supervisor.py")
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+# ---------------- latency histogram ----------------
+
+HIST_SCALE = 50          # buckets per e-fold: about 2% resolution
+
+def hist_add(hist, us):
+    b = int(math.log(max(us, 1)) * HIST_SCALE)
+    hist[b] = hist.get(b, 0) + 1
+
+def hist_summary(hist):
+    """Percentiles in ms from a merged {bucket: count} histogram."""
+    total = sum(hist.values())
+    if not total:
+        return {"count": 0}
+    out, seen, buckets = {"count": total}, 0, sorted(hist.items())
+    wanted = [("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("p999", 0.999)]
+    for b, n in buckets:
+        seen += n
+        while wanted and seen >= wanted[0][1] * total:
+            out[wanted.pop(0)[0]] = round(math.exp((b + 0.5) / HIST_SCALE) / 1000, 3)
+    out["max"] = round(math.exp((buckets[-1][0] + 1) / HIST_SCALE) / 1000, 3)
+    return out
+
+def merge_hist(into, hist):
+    for b, n in hist.items():
+        into[int(b)] = into.get(int(b), 0) + n
+
+# ---------------- stack ----------------
+
+def port_free(port, kind):
+    s = socket.socket(socket.AF_INET, kind)
+    try:
+        s.bind(("127.0.0.1", port))
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+def find_offset(node_workers=1):
+    """An offset at which every port of the stack is currently free."""
+    tcp = TCP_PORTS + tuple(p + 10 * k for k in range(1, node_workers) for p in (9000, 9002))   # worker metrics
+    for off in random.sample(range(10000, 50000, 100), 400):
+        if all(port_free(p + off, socket.SOCK_STREAM) for p in tcp) and \
+           all(port_free(p + off, socket.SOCK_DGRAM) for p in UDP_PORTS):
+            return off
+    sys.exit("no free port range for the stack")
+
+def user_name(i):
+    return "u%05d" % i
+
+def group_members(g, users, group_size):
+    return [(g * group_size + k) % users for k in range(min(group_size, users))]
+
+def seed(db_path, users, groups, group_size):
+    """Create the API schema, users and groups straight in SQLite (no per-user password hashing)."""
+    os.environ["WEBTALK_DB"] = db_path
+    if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+    import models
+    models.init_db()
+    pw = models.generate_password_hash("bench")
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany("INSERT INTO users(username,password_hash) VALUES(?,?)",
+                         [(user_name(i), pw) for i in range(users)])
+        for g in range(groups):
+            members = group_members(g, users, group_size)
+            gid = conn.execute("INSERT INTO groups(name,created_by) VALUES(?,?)",
+                               ("g%04d" % g, user_name(members[0]))).lastrowid
+            conn.executemany("INSERT INTO group_members(group_id,user) VALUES(?,?)",
+                             [(gid, user_name(m)) for m in members])
+    conn.close()
+
+def wait_port(port, proc, timeout=15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+class Stack:
+    def __init__(self, workdir, offset, env_extra, node_workers=1):
+        self.workdir = workdir
+        self.offset = offset
+        self.node_workers = node_workers
+        self.env = dict(os.environ, WEBTALK_PORT_OFFSET=str(offset), WEBTALK_DB=os.path.join(workdir, "webtalk.sqlite"),
+                        WEBTALK_DEBUG="0", PYTHONUNBUFFERED="1", **env_extra)
+        self.procs = {}
+        self.errors = {}
+
+    def start(self):
+        os.makedirs(os.path.join(self.workdir, "logs"), exist_ok=True)
+        for name, script, port in PROCESSES:
+            log = open(os.path.join(self.workdir, "logs", name + ".log"), "wb")
+            cmd = [sys.executable, script]
+            if name in STATS_NODES and self.node_workers > 1:
+                cmd = [sys.executable, SUPERVISOR, script, "-n", str(self.node_workers)]
+            p = subprocess.Popen(cmd, cwd=self.workdir, env=self.env,
+                                 stdout=log, stderr=subprocess.STDOUT)
+            self.procs[name] = p
+            if not wait_port(port + self.offset, p):
+                self.errors[name] = "did not come up (see logs/%s.log)" % name
+                if name != "api":
+                    raise RuntimeError(f"{name} {self.errors[name]} in {self.workdir}")
+        time.sleep(1.0)          # let the bully election settle before load
+
+    def stop(self):
+        for p in self.procs.values():
+            if p.poll() is None:
+                p.terminate()
+        for p in self.procs.values():
+            try:
+                p.wait(5)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+    def alive(self, name):
+        p = self.procs.get(name)
+        return p is not None and p.poll() is None
+
+# ---------------- /proc ----------------
+
+def _stat(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().rsplit(")", 1)[1].split()
+
+def process_tree(pid):
+    """pid and all its live descendants (a supervisor's workers)."""
+    children = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                children.setdefault(int(_stat(name)[1]), []).append(int(name))
+            except OSError:
+                pass
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo += children.get(p, [])
+    return tree
+
+def cpu_seconds(pid):
+    total = 0.0
+    for p in process_tree(pid):
+        try:
+            fields = _stat(p)
+        except OSError:
+            continue
+        total += (int(fields[11]) + int(fields[12])) / CLK_TCK     # utime + stime
+    return total
+
+def memory_mb(pid):
+    out = {"VmRSS": 0.0, "VmHWM": 0.0}
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith(("VmRSS:", "VmHWM:")):
+                        out[line.split(":")[0]] += int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return {"rss_mb": round(out["VmRSS"], 1), "peak_rss_mb": round(out["VmHWM"], 1)}
+
+def sample_cpu(stack):
+    out = {}
+    for name, p in stack.procs.items():
+        try:
+            out[name] = cpu_seconds(p.pid)
+        except OSError:
+            pass
+    return out
+
+# ---------------- server stats ----------------
+
+def fetch_stats(port, name="bench-stats"):
+    """One stats frame from a chat server, via the legacy protocol."""
+    s = socket.create_connection(("127.0.0.1", port), timeout=2)
+    try:
+        s.sendall(f"{name}\n".encode() + json.dumps({"type": "stats"}).encode() + b"\n")
+        buf = b""
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                return None
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                obj = json.loads(line)
+                if "stats" in obj:
+                    return obj["stats"]
+    finally:
+        s.close()
+
+class LagSampler(threading.Thread):
+    """Polls replication lag from both chat servers while the load runs."""
+    def __init__(self, offset, interval=0.5):
+        super().__init__(daemon=True)
+        self.offset = offset
+        self.interval = interval
+        self.samples = {n: [] for n in STATS_NODES}
+        self.catchup = []
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            for name, port in STATS_NODES.items():
+                try:
+                    st = fetch_stats(port + self.offset, f"bench-stats-{name}")
+                except (OSError, ValueError):
+                    continue
+                if st:
+                    r = st.get("replication", {})
+                    self.samples[name].append((r.get("lag_ms", 0), r.get("queue_depth", 0)))
+                    if "catchup" in st:
+                        self.catchup.append(st["catchup"].get("lag", 0))
+
+    def summary(self):
+        out = {}
+        for name, samples in self.samples.items():
+            lags = sorted(s[0] for s in samples)
+            depths = [s[1] for s in samples]
+            out[name] = {"samples": len(lags),
+                         "lag_ms_p50": lags[len(lags) // 2] if lags else None,
+                         "lag_ms_max": lags[-1] if lags else None,
+                         "queue_depth_max": max(depths) if depths else None}
+        out["replica_log_lag_rows_max"] = max(self.catchup) if self.catchup else None
+        return out
+
+# ---------------- load generator (one process per worker) ----------------
+
+class Client:
+    __slots__ = ("idx", "name", "sock", "rbuf", "wbuf", "groups")
+
+    def __init__(self, idx, groups):
+        self.idx, self.name, self.groups = idx, user_name(idx), groups
+        self.sock, self.rbuf, self.wbuf = None, b"", bytearray()
+
+def drive(worker, indices, cfg, ready, go, results):
+    resource.setrlimit(resource.RLIMIT_NOFILE, (resource.getrlimit(resource.RLIMIT_NOFILE)[1],) * 2)
+    rnd = random.Random(cfg["seed"] + worker)
+    sel = selectors.DefaultSelector()
+    lb = ("127.0.0.1", LB_PORT + cfg["offset"])
+    memberships = {}
+    for g in range(cfg["groups"]):
+        for m in group_members(g, cfg["users"], cfg["group_size"]):
+            memberships.setdefault(m, []).append(g + 1)     # group ids start at 1 in a fresh DB
+    clients = [Client(i, memberships.get(i, [])) for i in indices]
+    by_sock = {}
+    hist, reconnect_hist = {}, {}
+    stats = Counter()
+    spans = []               # delivery spans of traced messages, as tracestitch records
+
+    def connect(c):
+        s = socket.create_connection(lb, timeout=10)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.sendall(c.name.encode() + b"\n")
+        s.setblocking(False)
+        c.sock, c.rbuf, c.wbuf = s, b"", bytearray()
+        by_sock[s] = c
+        sel.register(s, selectors.EVENT_READ, c)
+
+    def disconnect(c):
+        if c.sock is not None:
+            sel.unregister(c.sock)
+            by_sock.pop(c.sock, None)
+            c.sock.close()
+            c.sock = None
+
+    def flush(c):
+        try:
+            n = c.sock.send(c.wbuf)
+            del c.wbuf[:n]
+        except BlockingIOError:
+            pass
+        except OSError:
+            stats["send_errors"] += 1
+            c.wbuf.clear()
+        sel.modify(c.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if c.wbuf else 0), c)
+
+    def on_readable(c):
+        try:
+            chunk = c.sock.recv(256 * 1024)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b""
+        if not chunk:
+            stats["server_closed"] += 1
+            disconnect(c)
+            return
+        now = time.time_ns()
+        *lines, c.rbuf = (c.rbuf + chunk).split(b"\n")
+        for line in lines:
+            if not line:
+                continue
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                stats["bad_frames"] += 1
+                continue
+            text = msg.get("message")
+            ctx = msg.get("trace")
+            if ctx:
+                spans.append(("bench", ctx["id"], "delivery", ctx["hops"][-1][1], now / 1e9))
+            if isinstance(text, str) and text.startswith("b ") and "from" in msg:
+                hist_add(hist, (now - int(text[2:])) // 1000)
+                stats["received_group" if "group" in msg else "received_dm"] += 1
+            elif "ack" in msg:
+                stats["ack_" + msg["ack"]] += 1
+            elif "info" in msg:
+                stats["join_info"] += 1
+
+    def send_one(c):
+        r = rnd.random()
+        stamp = "b %d" % time.time_ns()
+        if r < cfg["dm"] or not c.groups:
+            target = user_name(rnd.randrange(cfg["users"]))
+            if target == c.name:
+                target = user_name((c.idx + 1) % cfg["users"])
+            frame = {"type": "private", "target": target, "message": stamp}
+            stats["sent_dm"] += 1
+        elif r < cfg["dm"] + cfg["group"]:
+            g = rnd.choice(c.groups)
+            frame = {"type": "group", "target": g, "group_name": "g%04d" % (g - 1), "message": stamp}
+            stats["sent_group"] += 1
+            stats["expected_group"] += cfg["group_size"] - 1
+        else:
+            frame = {"type": "join", "message": "g%04d" % (rnd.choice(c.groups) - 1)}
+            stats["sent_join"] += 1
+        if cfg["trace"] and frame["type"] != "join" and rnd.random() < cfg["trace"]:
+            frame["trace"] = {"id": os.urandom(8).hex(), "hops": [["bench", time.time()]]}
+            stats["traced"] += 1
+        c.wbuf += json.dumps(frame).encode() + b"\n"
+        flush(c)
+
+    # connect everyone before the clock starts; the listeners' backlogs are finite
+    for k, c in enumerate(clients):
+        try:
+            connect(c)
+        except OSError:
+            stats["connect_errors"] += 1
+        if k % 100 == 99:
+            time.sleep(0.05)
+    ready.put(worker)
+    go.wait()
+
+    interval = 1.0 / cfg["rate"] if cfg["rate"] > 0 else None
+    start = time.time()
+    end = start + cfg["duration"]
+    due = [(start + rnd.random() * interval, c.idx, c) for c in clients] if interval else []
+    heapq.heapify(due)
+    churn_every = 1.0 / (cfg["churn"] * len(clients)) if cfg["churn"] > 0 and clients else None
+    next_churn = start + (churn_every or 0)
+    while True:
+        now = time.time()
+        if now >= end + cfg["drain"]:
+            break
+        sending = now < end
+        timeout = 0.01
+        for key, events in sel.select(timeout):
+            c = key.data
+            if events & selectors.EVENT_READ and c.sock is not None:
+                on_readable(c)
+            if events & selectors.EVENT_WRITE and c.sock is not None and c.wbuf:
+                flush(c)
+        if not sending:
+            continue
+        now = time.time()
+        while due and due[0][0] <= now:
+            at, idx, c = heapq.heappop(due)
+            if c.sock is not None and not c.wbuf:     # a client still writing skips its turn
+                send_one(c)
+            # fell behind: skip the missed turns rather than burst
+            heapq.heappush(due, (at + interval if at + interval > now else now + interval, idx, c))
+        while churn_every and next_churn <= now:
+            next_churn += churn_every
+            c = rnd.choice(clients)
+            disconnect(c)
+            t0 = time.perf_counter()
+            try:
+                connect(c)
+                hist_add(reconnect_hist, (time.perf_counter() - t0) * 1e6)
+                stats["reconnects"] += 1
+            except OSError:
+                stats["connect_errors"] += 1
+    for c in clients:
+        disconnect(c)
+    results.put({"worker": worker, "stats": dict(stats), "hist": hist, "reconnect_hist": reconnect_hist,
+                 "spans": spans, "elapsed": time.time() - start})
+
+# ---------------- API probe ----------------
+
+def probe_api(offset, n=200):
+    """GET /users latency over one keep-alive connection, plus a conditional GET."""
+    conn = http.client.HTTPConnection("127.0.0.1", API_PORT + offset, timeout=5)
+    hist, etag, not_modified = {}, None, 0
+    for i in range(n):
+        headers = {"If-None-Match": etag} if etag and i % 2 else {}
+        t0 = time.perf_counter()
+        conn.request("GET", "/users?limit=50", headers=headers)
+        r = conn.getresponse()
+        r.read()
+        hist_add(hist, (time.perf_counter() - t0) * 1e6)
+        etag = r.getheader("ETag") or etag
+        not_modified += r.status == 304
+    conn.close()
+    return {"get_users_ms": hist_summary(hist), "not_modified": not_modified}
+
+# ---------------- driver ----------------
+
+def run(args):
+    resource.setrlimit(resource.RLIMIT_NOFILE, (resource.getrlimit(resource.RLIMIT_NOFILE)[1],) * 2)
+    offset = find_offset(args.node_workers)
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    env = {"WEBTALK_ACL": "1" if args.acl else "0"}
+    seed(os.path.join(workdir, "webtalk.sqlite"), args.users or args.clients, args.groups, args.group_size)
+    stack = Stack(workdir, offset, env, args.node_workers)
+    cfg = {"offset": offset, "users": args.users or args.clients, "groups": args.groups, "group_size": args.group_size,
+           "rate": args.rate, "duration": args.duration, "drain": args.drain, "dm": args.dm, "group": args.group,
+           "churn": args.churn, "seed": args.seed, "trace": args.trace}
+    result = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "host": {"cpus": os.cpu_count(), "python": sys.version.split()[0]},
+              "config": dict(cfg, clients=args.clients, workers=args.workers, node_workers=args.node_workers, acl=args.acl)}
+    try:
+        stack.start()
+        ready, go, results = mp.Queue(), mp.Event(), mp.Queue()
+        workers = [mp.Process(target=drive, args=(w, list(range(w, args.clients, args.workers)), cfg, ready, go, results),
+                              daemon=True) for w in range(args.workers)]
+        for w in workers:
+            w.start()
+        for _ in workers:
+            ready.get(timeout=120)
+        sampler = LagSampler(offset)
+        cpu0, t0 = sample_cpu(stack), time.time()
+        sampler.start()
+        go.set()
+        outs = [results.get(timeout=args.duration + args.drain + 60) for _ in workers]
+        wall = time.time() - t0
+        cpu1 = sample_cpu(stack)
+        sampler.stop.set()
+        for w in workers:
+            w.join(5)
+
+        stats, hist, reconnect_hist = Counter(), {}, {}
+        for o in outs:
+            stats.update(o["stats"])
+            merge_hist(hist, o["hist"])
+            merge_hist(reconnect_hist, o["reconnect_hist"])
+        sent = stats["sent_dm"] + stats["sent_group"] + stats["sent_join"]
+        received = stats["received_dm"] + stats["received_group"]
+        result["throughput"] = {
+            "sent": sent, "sent_per_s": round(sent / args.duration, 1),
+            "delivered": received, "delivered_per_s": round(received / args.duration, 1),
+            "dm_delivery_ratio": round(stats["received_dm"] / stats["sent_dm"], 4) if stats["sent_dm"] else None,
+            "group_delivery_ratio": round(stats["received_group"] / stats["expected_group"], 4) if stats["expected_group"] else None,
+        }
+        result["latency_ms"] = hist_summary(hist)
+        result["reconnect_ms"] = hist_summary(reconnect_hist)
+        result["counters"] = dict(sorted(stats.items()))
+        result["replication"] = sampler.summary()
+        result["processes"] = {}
+        for name, p in stack.procs.items():
+            if name in cpu0 and name in cpu1 and stack.alive(name):
+                used = cpu1[name] - cpu0[name]
+                result["processes"][name] = dict(memory_mb(p.pid), cpu_s=round(used, 2), cpu_pct=round(100 * used / wall, 1))
+        result["servers"] = {}
+        for name, port in STATS_NODES.items():
+            try:
+                result["servers"][name] = fetch_stats(port + offset, f"bench-stats-{name}")
+            except (OSError, ValueError) as e:
+                result["servers"][name] = {"error": str(e)}
+        if stack.alive("api"):
+            try:
+                result["api"] = probe_api(offset)
+            except (OSError, http.client.HTTPException) as e:
+                result["api"] = {"error": str(e)}
+        else:
+            result["api"] = {"error": stack.errors.get("api", "exited")}
+        if args.trace:
+            errors = {}
+            records = tracestitch.collect(offset, sources=[s for s in tracestitch.SOURCES if s[0] != "frontend"], errors=errors)
+            records += [tuple(r) for o in outs for r in o["spans"]]
+            result["traces"] = dict(tracestitch.summarize(tracestitch.stitch(records), slowest=5), errors=errors)
+    finally:
+        stack.stop()
+        if args.keep:
+            print(f"[chatbench] stack directory kept: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+# ---------------- comparing runs ----------------
+
+# (path, higher_is_better)
+TRACKED = [(("throughput", "delivered_per_s"), True),
+           (("latency_ms", "p50"), False), (("latency_ms", "p95"), False), (("latency_ms", "p99"), False),
+           (("replication", "primary", "lag_ms_max"), False), (("replication", "replica", "lag_ms_max"), False)]
+
+def dig(obj, path):
+    for k in path:
+        obj = obj.get(k) if isinstance(obj, dict) else None
+    return obj
+
+def compare(before, after, tolerance):
+    """Print tracked metrics side by side; returns the list of regressions."""
+    regressions = []
+    for path, higher in TRACKED:
+        a, b = dig(before, path), dig(after, path)
+        name = ".".join(path)
+        if not isinstance(a, (int, float)) or not isinstance(b, (int, float)) or not a:
+            print(f"{name:40s} {a!s:>12} {b!s:>12}")     # no baseline to take a ratio against
+            continue
+        change = (b - a) / a
+        worse = change < -tolerance if higher else change > tolerance
+        print(f"{name:40s} {a:>12} {b:>12} {change:+8.1%}{'  REGRESSION' if worse else ''}")
+        if worse:
+            regressions.append(name)
+    for name in sorted(set(before.get("processes", {})) | set(after.get("processes", {}))):
+        a = dig(before, ("processes", name, "cpu_pct"))
+        b = dig(after, ("processes", name, "cpu_pct"))
+        print(f"{'processes.' + name + '.cpu_pct':40s} {a!s:>12} {b!s:>12}")
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser(description="Boot a private WebTalk stack and load-test the chat tier.")
+    ap.add_argument("--clients", type=int, default=1000, help="simulated users connected at once")
+    ap.add_argument("--users", type=int, default=0, help="users in the directory (default: --clients)")
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    ap.add_argument("--rate", type=float, default=1.0, help="frames per second per client")
+    ap.add_argument("--dm", type=float, default=0.80, help="share of frames that are DMs")
+    ap.add_argument("--group", type=float, default=0.18, help="share that are group messages (the rest are joins)")
+    ap.add_argument("--groups", type=int, default=100)
+    ap.add_argument("--group-size", type=int, default=20)
+    ap.add_argument("--churn", type=float, default=0.01, help="share of clients reconnecting per second")
+    ap.add_argument("--drain", type=float, default=2.0, help="seconds to keep receiving after the load stops")
+    ap.add_argument("-j", "--workers", type=int, default=max(1, min(8, (os.cpu_count() or 2) // 2)))
+    ap.add_argument("--node-workers", type=int, default=1, help="run each chat node as this many processes (supervisor.py)")
+    ap.add_argument("--acl", action="store_true", help="keep DM permission checks on (off by default: no accepted pairs are seeded)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--trace", type=float, default=0.0, help="share of messages to trace end to end (e.g. 0.01)")
+    ap.add_argument("--keep", action="store_true", help="keep the stack's directory and logs")
+    ap.add_argument("-o", "--out", help="write the result JSON here (default: stdout)")
+    ap.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="allowed relative change before --compare fails")
+    args = ap.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            regressions = compare(json.load(f), json.load(g), args.tolerance)
+        sys.exit(1 if regressions else 0)
+    if not sys.platform.startswith("linux"):
+        sys.exit("chatbench needs Linux (/proc, many sockets)")
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    t, l = result["throughput"], result["latency_ms"]
+    print(f"[chatbench] {t['sent_per_s']} sent/s, {t['delivered_per_s']} delivered/s, "
+          f"latency p50 {l.get('p50')} ms p95 {l.get('p95')} ms p99 {l.get('p99')} ms", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Join the per-process trace rings (backend/tracing.py) into per-message
+latency breakdowns.
+
+    WEBTALK_TRACE_RATE=0.01 ...             # on the frontend: trace 1% of messages
+    python tracestitch.py                   # default ports, or --offset N
+    python tracestitch.py --slowest 5 --json
+
+Each process serves its ring at /traces: the frontend on its web port, the
+chat servers and the backup on their metrics ports. Spans, in path order:
+
+    browser      browser send -> frontend handler (browser clock)
+    frontend     Socket.IO handler -> handed to the chat link
+    lb           frontend hand-off -> chat server (LB and network)
+    handle       handle_message on the chat server
+    peer         sending node -> node holding the recipient
+    reorder      held in the reorder window until released to the outbox
+    delivery     released -> back at the recipient's frontend (outbox, LB, network)
+    replication  handle_message -> backup received the batch
+    commit       backup received -> group commit done
+
+A group message has one trace with a delivery per recipient.
+"""
+import argparse, json, sys, urllib.request
+from collections import defaultdict
+
+# name, default port, path
+SOURCES = [("frontend", 8080, "/traces"), ("primary", 9000, "/traces"),
+           ("replica", 9002, "/traces"), ("backup", 9001, "/traces")]
+ORDER = ["browser", "frontend", "lb", "handle", "peer", "reorder", "delivery", "replication", "commit"]
+
+def fetch(url, timeout=3.0):
+    with urllib.request.urlopen(url, timeout=timeout) as r:
+        return json.loads(r.read())
+
+def collect(offset=0, host="127.0.0.1", sources=SOURCES, errors=None):
+    """(node, trace id, span, start, end) from every reachable process."""
+    records = []
+    for node, port, path in sources:
+        try:
+            records += [(node, *r) for r in fetch(f"http://{host}:{port + offset}{path}")]
+        except (OSError, ValueError) as e:
+            if errors is not None:
+                errors[node] = str(e)
+    return records
+
+def stitch(records):
+    """trace id -> its spans as (start, end, node, span), in start order."""
+    traces = defaultdict(list)
+    for node, tid, name, t0, t1 in records:
+        traces[tid].append((t0, t1, node, name))
+    for spans in traces.values():
+        spans.sort()
+    return dict(traces)
+
+def breakdown(spans):
+    """Total ms from the first start to the last end, and ms per span."""
+    total = (max(s[1] for s in spans) - spans[0][0]) * 1000
+    return round(total, 3), [(f"{node}.{name}", round((t1 - t0) * 1000, 3)) for t0, t1, node, name in spans]
+
+def percentiles(values):
+    values = sorted(values)
+    n = len(values)
+    pick = lambda q: values[min(n - 1, int(q * n))]
+    return {"count": n, "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": values[-1]}
+
+def _rank(key):
+    name = key.split(".", 1)[-1]
+    return (ORDER.index(name) if name in ORDER else len(ORDER), key)
+
+def summarize(traces, slowest=10):
+    """Percentiles per span and for the whole path, plus the slowest traces spelled out."""
+    per_span, totals, rows = defaultdict(list), [], []
+    for tid, spans in traces.items():
+        total, parts = breakdown(spans)
+        totals.append(total)
+        rows.append((total, tid, parts))
+        for key, ms in parts:
+            per_span[key].append(ms)
+    rows.sort(reverse=True)
+    return {"traces": len(traces),
+            "total_ms": percentiles(totals) if totals else {"count": 0},
+            "spans_ms": {k: percentiles(per_span[k]) for k in sorted(per_span, key=_rank)},
+            "slowest": [{"trace": tid, "total_ms": total, "spans": parts} for total, tid, parts in rows[:slowest]]}
+
+def show(summary, out=sys.stdout):
+    print(f"{summary['traces']} traces", file=out)
+    t = summary["total_ms"]
+    if t.get("count"):
+        print(f"{'total':24s} p50 {t['p50']:9.3f}  p95 {t['p95']:9.3f}  p99 {t['p99']:9.3f}  max {t['max']:9.3f} ms", file=out)
+    for key, p in summary["spans_ms"].items():
+        print(f"{key:24s} p50 {p['p50']:9.3f}  p95 {p['p95']:9.3f}  p99 {p['p99']:9.3f}  max {p['max']:9.3f} ms  (n={p['count']})", file=out)
+    for s in summary["slowest"]:
+        print(f"\n{s['trace']}  {s['total_ms']:.3f} ms", file=out)
+        for key, ms in s["spans"]:
+            print(f"    {key:24s} {ms:9.3f} ms", file=out)
+
+def main():
+    ap = argparse.ArgumentParser(description="Stitch WebTalk trace rings into per-message latency breakdowns.")
+    ap.add_argument("--offset", type=int, default=0, help="WEBTALK_PORT_OFFSET of the stack")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--slowest", type=int, default=10, help="spell out this many of the slowest traces")
+    ap.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = ap.parse_args()
+    errors = {}
+    summary = summarize(stitch(collect(args.offset, args.host, errors=errors)), args.slowest)
+    for node, e in errors.items():
+        print(f"[tracestitch] {node} unreachable: {e}", file=sys.stderr)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        show(summary)
+
+if __name__ == "__main__":
+    main()
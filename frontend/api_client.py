@@ -0,0 +1,127 @@
+# frontend/api_client.py
+import os, sys, threading, time, random
+import requests
+from requests.adapters import HTTPAdapter
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+import metrics
+
+# every frontend -> REST API call goes through one ApiClient
+
+class ApiUnavailable(Exception):
+    """The API could not be reached (timeout, refused, 5xx) or the breaker is open."""
+
+class CircuitOpen(ApiUnavailable):
+    pass
+
+class CircuitBreaker:
+    """
+    closed -> open after `threshold` consecutive failures; while open every
+    call fails fast. After `reset_after` seconds one trial call is let
+    through (half-open): success closes the breaker, failure re-opens it.
+    """
+    def __init__(self, threshold=5, reset_after=5.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_after and not self.trial:
+                self.trial = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    self.stats["opened"] += 1
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+class ApiClient:
+    """
+    Shared HTTP client for the REST API: one keep-alive connection pool,
+    connect/read timeouts on every call, bounded retries with full jitter
+    for idempotent calls only, a circuit breaker, and per-endpoint latency
+    histograms. Raises ApiUnavailable instead of hanging a worker.
+    """
+    def __init__(self, base, timeout=(0.5, 3.0), retries=2, backoff=0.05, pool_size=16, breaker=None):
+        self.base = base.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.latency = {}            # "METHOD /path" -> (Histogram, error Counter) in metrics
+
+    def get(self, path, **kw):
+        return self.request("GET", path, idempotent=True, **kw)
+
+    def post(self, path, idempotent=False, **kw):
+        return self.request("POST", path, idempotent=idempotent, **kw)
+
+    def _hist(self, endpoint):
+        h = self.latency.get(endpoint)
+        if h is None:
+            h = self.latency[endpoint] = (
+                metrics.histogram("webtalk_frontend_api_seconds", "REST API call latency seen by the frontend", endpoint=endpoint),
+                metrics.counter("webtalk_frontend_api_errors_total", "REST API calls that failed or got a 5xx", endpoint=endpoint))
+        return h
+
+    def request(self, method, path, idempotent=False, **kw):
+        endpoint = f"{method} {path}"
+        hist, errors = self._hist(endpoint)
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                raise CircuitOpen(f"{endpoint}: API circuit open")
+            t0 = time.perf_counter()
+            try:
+                r = self.session.request(method, self.base + path, timeout=self.timeout, **kw)
+                err = None if r.status_code < 500 else f"HTTP {r.status_code}"
+            except requests.RequestException as e:      # also ChunkedEncodingError etc. mid-body
+                r, err = None, e
+            except BaseException:
+                self.breaker.failure()       # never leave a half-open trial claimed
+                raise
+            hist.since(t0)
+            if err is None:
+                self.breaker.success()
+                return r
+            errors.inc()
+            self.breaker.failure()
+            if attempt + 1 < attempts:
+                time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+        if r is not None:
+            return r                 # a 5xx after the last attempt: let the caller see it
+        raise ApiUnavailable(f"{endpoint}: {err}")
+
+    def snapshot(self):
+        return {"breaker": dict(self.breaker.stats, state=self.breaker.state()),
+                "endpoints": {k: dict(h.snapshot(), errors=e.value) for k, (h, e) in list(self.latency.items())}}
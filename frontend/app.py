@@ -1,19 +1,38 @@
-from flask import Flask, render_template, request, redirect, url_for, session
-from flask_socketio import SocketIO, emit, disconnect
-import requests
-import socket
-import threading
-import json
+from flask import Flask, Response, render_template, request, redirect, url_for, session, jsonify
+from flask_socketio import SocketIO, emit
+import os, sys, threading, time
+from chat_link import ChatLinkPool
+from api_client import ApiClient, ApiUnavailable
+
+# change notifications are published by the REST API (backend/api/events.py)
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "api")
+if API_DIR not in sys.path:
+    sys.path.insert(0, API_DIR)
+import events
+import metrics             # backend/ is on the path via chat_link
+import tracing
 
 app = Flask(__name__)
 app.secret_key = "supersecretkey"
 socketio = SocketIO(app, cors_allowed_origins="*")
 
-API_BASE = "http://127.0.0.1:7000"   # your REST API
-LB_ADDR  = ("127.0.0.1", 5000)       # load balancer tcp
+API_BASE = f"http://127.0.0.1:{7000 + events.PORT_OFFSET}"   # your REST API
+LB_ADDR  = ("127.0.0.1", 5000 + events.PORT_OFFSET)       # load balancer tcp
+CHAT_LINKS = 4                       # multiplexed links to the chat tier per worker
+EVENTS_ADDR = ("127.0.0.1", 6210 + events.PORT_OFFSET)    # API change notifications (see events.DEFAULT_SUBSCRIBERS)
+# API events pushed to the browsers of the users they name, instead of the page polling
+RELAYED_EVENTS = {"chat_request", "group_request", "chat_changed"}
 
-# Map Socket.IO session id -> { 'username': str, 'sock': tcp-socket, 'rx': thread }
+api = ApiClient(API_BASE)             # the only path from this process to the API
+
+# Map Socket.IO session id -> { 'username': str, 'mux': chat-tier session id }
 clients = {}
+mux_to_sid = {}                      # chat-tier session id -> Socket.IO session id
+user_sids = {}                       # username -> set of Socket.IO session ids (one per tab)
+
+FRAMES_OUT = metrics.counter("webtalk_frontend_frames_total", "Chat frames pushed to browsers")
+NOTIFIES = metrics.counter("webtalk_frontend_notify_total", "API change notifications pushed to browsers")
+metrics.gauge("webtalk_frontend_sessions", "Registered browser sessions in this worker", fn=lambda: len(clients))
 
 # ---------------- HTTP pages ----------------
 @app.route("/")
@@ -27,7 +46,10 @@ def signup():
     if request.method == "POST":
         u = request.form["username"].strip()
         p = request.form["password"].strip()
-        r = requests.post(f"{API_BASE}/signup", json={"username": u, "password": p})
+        try:
+            r = api.post("/signup", json={"username": u, "password": p})   # not retried: creates a user
+        except ApiUnavailable:
+            return render_template("signup.html", error="Service unavailable, please try again shortly.")
         if r.ok and r.json().get("ok"):
             return redirect(url_for("home"))
         return render_template("signup.html", error="Signup failed. Try a different username.")
@@ -37,7 +59,10 @@ def signup():
 def login():
     u = request.form.get("username", "").strip()
     p = request.form.get("password", "").strip()
-    r = requests.post(f"{API_BASE}/login", json={"username": u, "password": p})
+    try:
+        r = api.post("/login", idempotent=True, json={"username": u, "password": p})
+    except ApiUnavailable:
+        return render_template("index.html", error="Service unavailable, please try again shortly.")
     if r.ok and r.json().get("ok"):
         session["username"] = u
         return redirect(url_for("chat_page"))
@@ -54,33 +79,79 @@ def chat_page():
         return redirect(url_for("home"))
     return render_template("chat.html", username=session["username"])
 
+@app.route("/stats")
+def stats():
+    return jsonify({"api": api.snapshot()})
+
+@app.route("/metrics")
+def metrics_page():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/traces")
+def traces_page():
+    return Response(tracing.dump(), content_type="application/json")
+
 # ------------- Socket.IO <-> TCP bridge -------------
 
-def tcp_reader_loop(sid):
-    """Read messages from LB TCP socket and push to that user's Socket.IO client."""
-    try:
-        sock = clients[sid]["sock"]
-        while True:
-            data = sock.recv(4096)
-            if not data:
-                break
-            # deliver raw lines back to the browser
-            socketio.emit("message", data.decode(errors="ignore"), room=sid)
-    except Exception as e:
-        socketio.emit("message", f"[gateway] connection closed: {e}", room=sid)
-    finally:
-        # cleanup
-        c = clients.get(sid)
-        if c:
-            try:
-                c["sock"].close()
-            except:
-                pass
-        clients.pop(sid, None)
-        try:
-            disconnect(sid=sid)
-        except:
-            pass
+def on_chat_frame(mux, obj):
+    """A decoded frame from the chat tier for one session: push it to that browser."""
+    sid = mux_to_sid.get(mux)
+    if sid:
+        FRAMES_OUT.inc()
+        ctx = obj.pop("trace", None)
+        if ctx:
+            tracing.span(ctx, "delivery", tracing.last(ctx))    # chat server -> here
+        socketio.emit("message", obj, room=sid)
+
+def on_chat_closed(mux):
+    sid = mux_to_sid.pop(mux, None)
+    if sid:
+        forget(sid)
+        socketio.emit("message", "[gateway] chat session closed by server", room=sid)
+
+def forget(sid):
+    c = clients.pop(sid, None)
+    if c:
+        sids = user_sids.get(c["username"])
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                user_sids.pop(c["username"], None)
+    return c
+
+def on_api_event(ev):
+    """An API change notification: push it to every open tab of the users it names."""
+    if ev.get("event") not in RELAYED_EVENTS:
+        return
+    for user in ev.get("users") or ():
+        for sid in list(user_sids.get(user, ())):
+            NOTIFIES.inc()
+            socketio.emit("notify", ev, room=sid)
+
+_links = None
+_links_lock = threading.Lock()
+
+def chat_links():
+    # started lazily so the debug reloader's watcher process opens no links
+    global _links
+    with _links_lock:
+        if _links is None:
+            _links = ChatLinkPool(LB_ADDR, CHAT_LINKS, on_chat_frame, on_chat_closed).start()
+            events.listen(EVENTS_ADDR, on_api_event)
+        return _links
+
+def send_to_chat(c, obj):
+    chat_links().send(c["mux"], obj)
+
+def trace(obj, data, t_in):
+    """Start a trace on a sampled share of outgoing messages (backend/tracing.py)."""
+    if tracing.sampled():
+        ctx = obj["trace"] = tracing.start("frontend")
+        tracing.span(ctx, "frontend", t_in, tracing.last(ctx))
+        sent = data.get("sent_at")          # browser clock: only meaningful when it is in sync
+        if isinstance(sent, (int, float)):
+            tracing.span(ctx, "browser", sent / 1000, t_in)
+    return obj
 
 @socketio.on("connect")
 def on_connect():
@@ -89,57 +160,37 @@ def on_connect():
 
 @socketio.on("disconnect")
 def on_disconnect():
-    c = clients.pop(request.sid, None)
+    c = forget(request.sid)
     if c:
-        try:
-            c["sock"].close()
-        except:
-            pass
+        mux_to_sid.pop(c["mux"], None)
+        chat_links().close(c["mux"])
 
 @socketio.on("register")
 def on_register(username):
     """
     Browser calls this once after /chat loads.
-    We open a PERSISTENT TCP socket to the load balancer, send username handshake,
-    and start a thread to read messages from LB and emit to this socket.io client.
+    Opens a session for this user on one of the worker's shared chat links;
+    frames for it are routed back here by session id.
     """
     sid = request.sid
     # if already registered, ignore
     if sid in clients:
         return
 
-    # open TCP to LB
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(LB_ADDR)
-    except Exception as e:
+        mux = chat_links().open(username)
+    except OSError as e:
         emit("message", f"[gateway] cannot reach load balancer: {e}")
         return
 
-    # LB expects: it immediately asks for username; send username
-    try:
-        # read LB's "Enter username:" prompt if any (non-fatal if not read)
-        s.settimeout(0.2)
-        try:
-            _ = s.recv(1024)
-        except:
-            pass
-        s.settimeout(None)
-        s.sendall((username + "\n").encode())
-    except Exception as e:
-        emit("message", f"[gateway] register failed: {e}")
-        try: s.close()
-        except: pass
-        return
-
-    # Save & start reader thread
-    t = threading.Thread(target=tcp_reader_loop, args=(sid,), daemon=True)
-    clients[sid] = {"username": username, "sock": s, "rx": t}
-    t.start()
+    clients[sid] = {"username": username, "mux": mux}
+    mux_to_sid[mux] = sid
+    user_sids.setdefault(username, set()).add(sid)
     emit("gateway", f"registered as {username}")
 
 @socketio.on("send_pm")
 def on_send_pm(data):
+    t_in = time.time()
     sid = request.sid
     c = clients.get(sid)
     if not c:
@@ -153,14 +204,16 @@ def on_send_pm(data):
         return
 
     obj = {"type": "private", "target": to, "message": text}
+    trace(obj, data, t_in)
     try:
-        c["sock"].sendall((json.dumps(obj) + "\n").encode())
+        send_to_chat(c, obj)
     except Exception as e:
         emit("message", f"[gateway] send failed: {e}")
 
 
 @socketio.on("send_group")
 def on_send_group(data):
+    t_in = time.time()
     sid = request.sid
     c = clients.get(sid)
     if not c:
@@ -170,33 +223,19 @@ def on_send_group(data):
     gid = data.get("group_id")
     gname = data.get("group_name", "")
     text = data.get("text", "").strip()
-    me = c["username"]
 
     if not gid or not text:
         emit("message", "[gateway] missing group_id/text")
         return
 
+    # one frame; the chat server fans out to members from its membership cache
+    obj = {"type": "group", "target": gid, "group_name": gname, "message": text}
+    trace(obj, data, t_in)
     try:
-        r = requests.get(f"{API_BASE}/group/members", params={"group_id": gid}, timeout=3)
-        members = r.json().get("members", [])
+        send_to_chat(c, obj)
     except Exception as e:
-        emit("message", f"[gateway] cannot fetch group members: {e}")
-        return
-
-    delivered = 0
-    for m in members:
-        if m == me:
-            continue
-        obj = {"type": "private", "target": m, "message": f"[#{gname}] {me}: {text}"}
-        try:
-            c["sock"].sendall((json.dumps(obj) + "\n").encode())
-            delivered += 1
-        except:
-            pass
-
-    emit("message", f"[gateway] group '{gname}' fan-out to {delivered} member(s)")
-
+        emit("message", f"[gateway] send failed: {e}")
 
 
 if __name__ == "__main__":
-    socketio.run(app, host="127.0.0.1", port=8080, debug=True)
+    socketio.run(app, host="127.0.0.1", port=8080 + events.PORT_OFFSET, debug=True)
@@ -0,0 +1,135 @@
+# frontend/chat_link.py
+import os, sys, socket, threading, itertools, time
+
+# the wire codec lives with the chat servers
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+import wire
+import logs
+
+log = logs.get("gateway")
+
+HELLO = (wire.HELLO_V2 + "\n").encode()
+
+class ChatLink:
+    """
+    One long-lived multiplexed link to the load balancer speaking the binary
+    v2 protocol (backend/wire.py). Carries any number of user sessions; if
+    the link drops it reconnects and re-opens every session it carried.
+    """
+    def __init__(self, pool, idx):
+        self.pool = pool
+        self.idx = idx
+        self.sock = None
+        self.lock = threading.Lock()
+        self.sessions = {}            # sid -> username
+        self.ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _handshake(self, s):
+        """Offer v2 and wait for the server to accept it. Returns bytes read past the reply."""
+        s.sendall(HELLO)
+        data = b""
+        while b"\n" not in data:
+            chunk = s.recv(1024)
+            if not chunk:
+                raise OSError("chat server closed during handshake")
+            data += chunk
+        line, rest = data.split(b"\n", 1)
+        if line.strip().decode(errors="ignore") != wire.HELLO_V2:
+            raise OSError(f"chat server does not speak {wire.HELLO_V2}")
+        return rest
+
+    def _connect(self):
+        backoff = 0.2
+        while True:
+            try:
+                s = socket.create_connection(self.pool.addr, timeout=3)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                rest = self._handshake(s)
+                s.settimeout(None)
+                with self.lock:
+                    opens = b"".join(wire.frame(wire.OPEN, sid, u.encode()) for sid, u in self.sessions.items())
+                    if opens:
+                        s.sendall(opens)
+                    self.sock = s
+                self.ready.set()
+                return s, rest
+            except OSError as e:
+                log.warning("link %d cannot reach chat tier: %s", self.idx, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 5.0)
+
+    def write(self, data, open_sid=None, username=None):
+        if not self.ready.wait(timeout=3):
+            raise OSError("chat tier unreachable")
+        with self.lock:
+            if self.sock is None:
+                raise OSError("chat link reconnecting")
+            if open_sid is not None:
+                # registered under the lock so a concurrent reconnect can't open it twice
+                self.sessions[open_sid] = username
+            self.sock.sendall(data)
+
+    def _run(self):
+        while True:
+            s, rest = self._connect()
+            reader = wire.FrameReader(s, rest)
+            try:
+                while True:
+                    for kind, sid, payload in reader.frames():
+                        if kind == wire.MSG:
+                            self.pool.on_frame(sid, wire.decode(payload))
+                        elif kind == wire.CLOSED:
+                            self.sessions.pop(sid, None)
+                            self.pool.on_closed(sid)
+                    if not reader.fill():
+                        break
+            except (OSError, ValueError):
+                pass
+            self.ready.clear()
+            with self.lock:
+                self.sock = None
+            try: s.close()
+            except OSError: pass
+            log.warning("link %d lost, reconnecting (%d session(s))", self.idx, len(self.sessions))
+
+class ChatLinkPool:
+    """
+    A small fixed set of ChatLinks shared by every browser session in this
+    frontend worker, so chat-tier connections scale with workers, not users.
+    on_frame(sid, obj) and on_closed(sid) are called from link threads.
+    """
+    def __init__(self, addr, size, on_frame, on_closed):
+        self.addr = addr
+        self.on_frame = on_frame
+        self.on_closed = on_closed
+        self.ids = itertools.count(1)
+        self.links = [ChatLink(self, i) for i in range(size)]
+
+    def start(self):
+        for link in self.links:
+            link.start()
+        return self
+
+    def _link(self, sid):
+        return self.links[sid % len(self.links)]
+
+    def open(self, username):
+        sid = next(self.ids)
+        self._link(sid).write(wire.frame(wire.OPEN, sid, username.encode()), open_sid=sid, username=username)
+        return sid
+
+    def send(self, sid, obj):
+        self._link(sid).write(wire.frame(wire.MSG, sid, wire.encode(obj)))
+
+    def close(self, sid):
+        link = self._link(sid)
+        if link.sessions.pop(sid, None) is not None:
+            try:
+                link.write(wire.frame(wire.CLOSE, sid))
+            except OSError:
+                pass
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Local parallel map-reduce for the chat analytics jobs, no Hadoop needed.
+
+    python localmr.py -i logs/*.txt -o out/ --mapper mapper.py --reducer reducer.py
+    python localmr.py -i logs/*.txt -o out/ --mapper localmr:first_token --reducer localmr:sum_counts
+
+A mapper/reducer is either a Hadoop-streaming script (a path ending in .py,
+run unchanged with the chunk on stdin) or a "module:function" callable:
+    mapper(line) -> iterable of (key, value)
+    reducer(key, values) -> iterable of (key, value)
+The combiner takes the reducer's form and pre-aggregates each map task's
+output; it defaults to the reducer for callables.
+
+Input files are split into newline-aligned chunks and read via mmap by a
+process pool. Map output is hash-partitioned into spill files; each reduce
+task only sorts (streaming) or groups (callables) its own partition, so
+there is no global sort. --baseline also runs the classic
+"mapper | sort | reducer" pipeline and compares results and timing.
+"""
+import argparse, glob, importlib, mmap, os, pickle, shutil, subprocess, sys, tempfile, time, zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+CHUNK_SIZE = 32 << 20
+
+# ---------------- built-in job: count the first token per line ----------------
+
+def first_token(line):
+    parts = line.split(None, 1)
+    if parts:
+        yield parts[0], 1
+
+def sum_counts(key, values):
+    yield key, sum(int(v) for v in values)
+
+# ---------------- job description ----------------
+
+def is_script(spec):
+    return isinstance(spec, str) and spec.endswith(".py")
+
+def load_callable(spec):
+    if callable(spec):
+        return spec
+    module, _, name = spec.partition(":")
+    here = os.path.dirname(os.path.abspath(__file__))
+    if here not in sys.path:
+        sys.path.insert(0, here)
+    return getattr(importlib.import_module(module), name)
+
+def partition_of(key, partitions):
+    # crc32, not hash(): str hashes differ between worker processes
+    return zlib.crc32(key.encode() if isinstance(key, str) else pickle.dumps(key)) % partitions
+
+def split_chunks(paths, chunk_size=CHUNK_SIZE):
+    """[(path, start, end)] byte ranges that each end on a line boundary."""
+    chunks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if size == 0:
+            continue
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < size:
+                end = min(start + chunk_size, size)
+                if end < size:
+                    nl = mm.find(b"\n", end - 1)
+                    end = size if nl < 0 else nl + 1
+                chunks.append((path, start, end))
+                start = end
+    return chunks
+
+def read_chunk(path, start, end):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[start:end]
+
+def run_script(script, data):
+    p = subprocess.run([sys.executable, script], input=data, stdout=subprocess.PIPE)
+    if p.returncode != 0:
+        raise RuntimeError(f"{script} exited with status {p.returncode}")
+    return p.stdout
+
+# ---------------- map side ----------------
+
+def map_task(task_id, chunk, job, workdir):
+    mapper, combiner, partitions = job["mapper"], job["combiner"], job["partitions"]
+    data = read_chunk(*chunk)
+    if is_script(mapper):
+        out = run_script(mapper, data)
+        if combiner:
+            # streaming combiners expect their input grouped, like a reducer
+            out = run_script(combiner, b"".join(sorted(out.splitlines(keepends=True))))
+        buckets = [[] for _ in range(partitions)]
+        for line in out.splitlines(keepends=True):
+            key = line.split(b"\t", 1)[0]
+            buckets[zlib.crc32(key) % partitions].append(line)
+        for p, lines in enumerate(buckets):
+            if lines:
+                with open(os.path.join(workdir, f"map-{task_id:05d}-{p:05d}"), "wb") as f:
+                    f.writelines(lines)
+        return len(data)
+
+    mapper = load_callable(mapper)
+    groups = defaultdict(list)
+    for raw in data.split(b"\n"):
+        if raw:
+            for k, v in mapper(raw.decode("utf-8", "replace")):
+                groups[k].append(v)
+    if combiner:
+        combine = load_callable(combiner)
+        combined = defaultdict(list)
+        for k, vs in groups.items():
+            for ck, cv in combine(k, vs):
+                combined[ck].append(cv)
+        groups = combined
+    buckets = [{} for _ in range(partitions)]
+    for k, vs in groups.items():
+        buckets[partition_of(k, partitions)][k] = vs
+    for p, bucket in enumerate(buckets):
+        if bucket:
+            with open(os.path.join(workdir, f"map-{task_id:05d}-{p:05d}"), "wb") as f:
+                pickle.dump(bucket, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return len(data)
+
+# ---------------- reduce side ----------------
+
+def reduce_task(p, job, workdir, outdir):
+    spills = sorted(glob.glob(os.path.join(workdir, f"map-*-{p:05d}")))
+    out_path = os.path.join(outdir, f"part-{p:05d}")
+    reducer = job["reducer"]
+    if is_script(reducer):
+        lines = []
+        for s in spills:
+            with open(s, "rb") as f:
+                lines.extend(f.read().splitlines(keepends=True))
+        lines.sort()                     # one partition only
+        out = run_script(reducer, b"".join(lines)) if lines else b""
+        with open(out_path, "wb") as f:
+            f.write(out)
+        return out.count(b"\n")
+
+    reduce_fn = load_callable(reducer)
+    groups = defaultdict(list)
+    for s in spills:
+        with open(s, "rb") as f:
+            for k, vs in pickle.load(f).items():
+                groups[k].extend(vs)
+    n = 0
+    with open(out_path, "w", encoding="utf-8") as f:
+        for k in sorted(groups, key=str):
+            for rk, rv in reduce_fn(k, groups[k]):
+                f.write(f"{rk}\t{rv}\n")
+                n += 1
+    return n
+
+# ---------------- driver ----------------
+
+def run(inputs, outdir, mapper, reducer, combiner=None, workers=None, partitions=None, chunk_size=CHUNK_SIZE):
+    """Run one job; returns a stats dict. Output is outdir/part-NNNNN, one file per partition."""
+    workers = workers or os.cpu_count() or 1
+    partitions = partitions or workers
+    if combiner is None and not is_script(reducer):
+        combiner = reducer
+    job = {"mapper": mapper, "reducer": reducer, "combiner": combiner, "partitions": partitions}
+    os.makedirs(outdir, exist_ok=True)
+    for old in glob.glob(os.path.join(outdir, "part-*")):
+        os.remove(old)
+    t0 = time.perf_counter()
+    chunks = split_chunks(inputs, chunk_size)
+    workdir = tempfile.mkdtemp(prefix="localmr-")
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            in_bytes = sum(pool.map(map_task, range(len(chunks)), chunks,
+                                    [job] * len(chunks), [workdir] * len(chunks)))
+            t_map = time.perf_counter()
+            records = sum(pool.map(reduce_task, range(partitions), [job] * partitions,
+                                   [workdir] * partitions, [outdir] * partitions))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    t1 = time.perf_counter()
+    return {"chunks": len(chunks), "partitions": partitions, "workers": workers, "bytes": in_bytes,
+            "records": records, "map_s": round(t_map - t0, 3), "reduce_s": round(t1 - t_map, 3),
+            "total_s": round(t1 - t0, 3), "mb_per_s": round(in_bytes / (1 << 20) / max(t1 - t0, 1e-9), 1)}
+
+def run_baseline(inputs, mapper, reducer):
+    """The Hadoop-streaming contract on one core: mapper | sort | reducer."""
+    t0 = time.perf_counter()
+    data = b"".join(open(p, "rb").read() for p in inputs)
+    mapped = run_script(mapper, data)
+    out = run_script(reducer, b"".join(sorted(mapped.splitlines(keepends=True))))
+    return out, round(time.perf_counter() - t0, 3)
+
+def read_output(outdir):
+    lines = []
+    for part in sorted(glob.glob(os.path.join(outdir, "part-*"))):
+        with open(part, "rb") as f:
+            lines.extend(f.read().splitlines())
+    return sorted(lines)
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    ap = argparse.ArgumentParser(description="Run a map-reduce job on this machine.")
+    ap.add_argument("-i", "--input", nargs="+", required=True, help="input files (globs allowed)")
+    ap.add_argument("-o", "--output", required=True, help="output directory")
+    ap.add_argument("--mapper", default=os.path.join(here, "mapper.py"), help="script.py or module:function")
+    ap.add_argument("--reducer", default=os.path.join(here, "reducer.py"), help="script.py or module:function")
+    ap.add_argument("--combiner", help="script.py or module:function (callables default to the reducer)")
+    ap.add_argument("-j", "--workers", type=int, default=None)
+    ap.add_argument("-p", "--partitions", type=int, default=None)
+    ap.add_argument("--chunk-mb", type=int, default=CHUNK_SIZE >> 20)
+    ap.add_argument("--baseline", action="store_true", help="also run mapper | sort | reducer and compare")
+    args = ap.parse_args()
+
+    inputs = sorted({p for pattern in args.input for p in (glob.glob(pattern) or [pattern])})
+    stats = run(inputs, args.output, args.mapper, args.reducer, args.combiner,
+                args.workers, args.partitions, args.chunk_mb << 20)
+    print(f"[localmr] {stats}")
+    if args.baseline:
+        if not (is_script(args.mapper) and is_script(args.reducer)):
+            sys.exit("--baseline needs streaming scripts for --mapper and --reducer")
+        out, secs = run_baseline(inputs, args.mapper, args.reducer)
+        same = sorted(out.splitlines()) == read_output(args.output)
+        print(f"[localmr] baseline {secs}s vs {stats['total_s']}s "
+              f"({secs / max(stats['total_s'], 1e-9):.1f}x), outputs {'match' if same else 'DIFFER'}")
+
+if __name__ == "__main__":
+    main()
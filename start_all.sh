@@ -0,0 +1,14 @@
+#!/bin/sh
+# Linux counterpart of start_all.ps1. Each chat node runs as CHAT_WORKERS
+# processes under backend/supervisor.py (default: half the CPUs each).
+cd "$(dirname "$0")"
+CPUS=$(nproc)
+W=${CHAT_WORKERS:-$(( CPUS / 2 > 0 ? CPUS / 2 : 1 ))}
+(cd backend/api && exec python app.py) &
+(cd backend && exec python backup_server.py) &
+(cd backend && exec python supervisor.py chat_server_primary.py -n "$W") &
+(cd backend && exec python supervisor.py chat_server_replica.py -n "$W") &
+(cd backend && exec python load_balancer.py) &
+(cd frontend && exec python app.py) &
+trap 'kill $(jobs -p) 2>/dev/null' INT TERM
+wait